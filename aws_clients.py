@@ -0,0 +1,183 @@
+import os
+import sys
+import json
+import time
+import logging
+import threading
+
+# AWS clients shared by all handlers. Modules bind LazyClient proxies at import time and
+# the botocore client behind one is built on first use, so a cold start only pays for the
+# clients its code path actually touches. All clients share one tuned botocore Config.
+#
+# DynamoDB goes through the low-level client with the same Python <-> DynamoDB type
+# conversion boto3's resource layer installs, so Table keeps the resource's call style
+# (plain Python values, boto3.dynamodb.conditions, batch_writer) without building the
+# much slower resource model.
+#
+# STORAGE_BACKEND=local swaps all of them for local_backend.py (files, SQLite and in-process
+# queues), so the pipeline runs without AWS.
+#
+# python aws_clients.py [handler ...] reports the cold-start cost of each handler.
+
+# 'aws' or 'local'
+STORAGE_BACKEND = os.environ.get('STORAGE_BACKEND', 'aws')
+
+# Connections kept per client; handlers using thread pools share them
+MAX_POOL_CONNECTIONS = int(os.environ.get('AWS_MAX_POOL_CONNECTIONS', '50'))
+CONNECT_TIMEOUT = float(os.environ.get('AWS_CONNECT_TIMEOUT', '2'))
+READ_TIMEOUT = float(os.environ.get('AWS_READ_TIMEOUT', '10'))
+# Attempts per call; adaptive retries also rate-limit the client when it is being throttled
+MAX_ATTEMPTS = int(os.environ.get('AWS_MAX_ATTEMPTS', '5'))
+
+logger = logging.getLogger()
+
+_clients = {}  # name -> botocore client
+_lock = threading.Lock()
+_init_timings = {}  # init step -> milliseconds, in the order they happened
+
+
+def _record(step, start):
+    _init_timings[step] = round((time.perf_counter() - start) * 1000, 3)
+
+
+def init_report():
+    # Import and client construction time spent so far in this container, per step
+    return dict(_init_timings)
+
+
+def _build(name):
+    start = time.perf_counter()
+    if STORAGE_BACKEND == 'local':
+        import local_backend
+        client = local_backend.client(name)
+        _record(f"client {name}", start)
+        return client
+    import boto3
+    if 'import boto3' not in _init_timings:
+        _record('import boto3', start)
+    from botocore.config import Config
+    config = Config(
+        max_pool_connections=MAX_POOL_CONNECTIONS,
+        connect_timeout=CONNECT_TIMEOUT,
+        read_timeout=READ_TIMEOUT,
+        tcp_keepalive=True,
+        retries={'mode': 'adaptive', 'max_attempts': MAX_ATTEMPTS}
+    )
+    start = time.perf_counter()
+    if name == 'dynamodb_document':
+        client = boto3.client('dynamodb', config=config)
+        _add_document_transforms(client)
+    else:
+        client = boto3.client(name, config=config)
+    _record(f"client {name}", start)
+    logger.info(f"Created {name} client in {_init_timings[f'client {name}']} ms")
+    return client
+
+
+def _add_document_transforms(client):
+    # The handlers boto3's DynamoDB resource registers on its client
+    from boto3.dynamodb.transform import TransformationInjector, copy_dynamodb_params
+    injector = TransformationInjector()
+    events = client.meta.events
+    events.register('provide-client-params.dynamodb', copy_dynamodb_params, unique_id='dynamodb-create-params-copy')
+    events.register('before-parameter-build.dynamodb', injector.inject_condition_expressions,
+                    unique_id='dynamodb-condition-expression')
+    events.register('before-parameter-build.dynamodb', injector.inject_attribute_value_input,
+                    unique_id='dynamodb-attr-value-input')
+    events.register('after-call.dynamodb', injector.inject_attribute_value_output,
+                    unique_id='dynamodb-attr-value-output')
+
+
+def client(name):
+    # Memoized client: 's3', 'sqs', or 'dynamodb_document' (low-level DynamoDB with Python types)
+    # - or their local_backend counterparts
+    existing = _clients.get(name)
+    if existing is not None:
+        return existing
+    with _lock:
+        if name not in _clients:
+            _clients[name] = _build(name)
+        return _clients[name]
+
+
+class LazyClient:
+    # Stands in for a boto3 client; the client is created on first attribute access
+
+    def __init__(self, name):
+        self._name = name
+
+    def __getattr__(self, attribute):
+        return getattr(client(self._name), attribute)
+
+
+class Table:
+    # The subset of boto3's dynamodb.Table used by the handlers, on the document client
+
+    def __init__(self, name):
+        self.name = name
+
+    def get_item(self, **kwargs):
+        return client('dynamodb_document').get_item(TableName=self.name, **kwargs)
+
+    def put_item(self, **kwargs):
+        return client('dynamodb_document').put_item(TableName=self.name, **kwargs)
+
+    def update_item(self, **kwargs):
+        return client('dynamodb_document').update_item(TableName=self.name, **kwargs)
+
+    def delete_item(self, **kwargs):
+        return client('dynamodb_document').delete_item(TableName=self.name, **kwargs)
+
+    def query(self, **kwargs):
+        return client('dynamodb_document').query(TableName=self.name, **kwargs)
+
+    def scan(self, **kwargs):
+        return client('dynamodb_document').scan(TableName=self.name, **kwargs)
+
+    def batch_writer(self, overwrite_by_pkeys=None):
+        from boto3.dynamodb.table import BatchWriter
+        return BatchWriter(self.name, client('dynamodb_document'), overwrite_by_pkeys=overwrite_by_pkeys)
+
+
+s3 = LazyClient('s3')
+sqs = LazyClient('sqs')
+# Service-level DynamoDB calls (batch_get_item, ...) with Python types
+dynamodb = LazyClient('dynamodb_document')
+
+
+def table(name):
+    return Table(name)
+
+
+def cold_start_report(handler):
+    # Run in a fresh interpreter: time the handler's import, then build the clients it binds
+    start = time.perf_counter()
+    module = __import__(handler)
+    report = {'import handler': round((time.perf_counter() - start) * 1000, 3),
+              'pyzstd imported': 'pyzstd' in sys.modules}
+    for value in vars(module).values():
+        if isinstance(value, LazyClient):
+            client(value._name)
+        elif isinstance(value, Table):
+            client('dynamodb_document')
+    report.update(init_report())
+    return report
+
+
+if __name__ == '__main__':
+    import subprocess
+    handlers = sys.argv[1:] or ['upload_notes', 'bulk_upload_notes', 'compress_notes', 'retrieve_note',
+                                'bulk_retrieve_notes', 'get_metrics']
+    here = os.path.dirname(os.path.abspath(__file__))
+    env = dict(os.environ)
+    env.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+    for handler in handlers:
+        output = subprocess.run(
+            [sys.executable, '-c', f"import json, aws_clients; print(json.dumps(aws_clients.cold_start_report({handler!r})))"],
+            cwd=here, env=env, capture_output=True, text=True)
+        if output.returncode != 0:
+            print(f"{handler}: failed\n{output.stderr}")
+            continue
+        report = json.loads(output.stdout.strip().splitlines()[-1])
+        steps = ', '.join(f"{step}={ms} ms" for step, ms in report.items() if step != 'pyzstd imported')
+        print(f"{handler}: {steps}, pyzstd imported={report['pyzstd imported']}")
@@ -0,0 +1,381 @@
+import os
+import sys
+import json
+import time
+import base64
+import random
+import logging
+import argparse
+import shutil
+import tempfile
+import importlib
+from concurrent.futures import ThreadPoolExecutor
+
+# Offline end-to-end benchmark: drives the Lambda handlers in-process against moto's
+# in-memory S3, DynamoDB and SQS (or the local disk/SQLite backend), on a synthetic corpus,
+# and reports throughput and p50/p95/p99 latency per stage. No AWS account or network
+# access is needed:
+#
+#   pip install moto
+#   python benchmark.py --notes 200 --versions 5 --sizes lognormal:4096:1.5 --concurrency 8
+#   python benchmark.py --algo ADAPTIVE --keyframe-interval 8 --json results.json
+#   python benchmark.py --backend local
+
+STAGES = ['upload', 'compress', 'retrieve', 'retrieve_warm', 'retrieve_range', 'retrieve_zstd', 'bulk_retrieve', 'metrics']
+
+WORDS = ("the of and to in is was for that with on as by at from this be are have it not or an which "
+         "note meeting agenda action item follow up project deadline review budget team plan design "
+         "customer release feature bug fix deploy service latency storage compress version draft todo "
+         "summary decision owner status risk question answer idea research result data report week").split()
+
+logger = logging.getLogger()
+
+
+class Corpus:
+    # Deterministic synthetic notes: markdown-ish paragraphs, lists and headings from a small
+    # vocabulary, plus edits between versions so delta compression sees realistic changes
+
+    def __init__(self, seed):
+        self.rng = random.Random(seed)
+
+    def sentence(self):
+        words = [self.rng.choice(WORDS) for _ in range(self.rng.randint(5, 18))]
+        return ' '.join(words).capitalize() + self.rng.choice(['.', '.', '.', '?', '!'])
+
+    def block(self):
+        kind = self.rng.random()
+        if kind < 0.1:
+            return '## ' + self.sentence().rstrip('.?!')
+        if kind < 0.3:
+            return '\n'.join(f"- {self.sentence()}" for _ in range(self.rng.randint(2, 6)))
+        return ' '.join(self.sentence() for _ in range(self.rng.randint(2, 6)))
+
+    def text(self, size):
+        blocks = []
+        total = 0
+        while total < size:
+            block = self.block()
+            blocks.append(block)
+            total += len(block) + 2
+        return '\n\n'.join(blocks)[:size]
+
+    def edit(self, content):
+        # Next version: a few blocks inserted, replaced or deleted
+        blocks = content.split('\n\n')
+        for _ in range(self.rng.randint(1, 4)):
+            position = self.rng.randrange(len(blocks) + 1)
+            action = self.rng.random()
+            if action < 0.5 or not blocks:
+                blocks.insert(position, self.block())
+            elif action < 0.8:
+                blocks[min(position, len(blocks) - 1)] = self.block()
+            elif len(blocks) > 1:
+                del blocks[min(position, len(blocks) - 1)]
+        return '\n\n'.join(blocks)
+
+
+def size_sampler(spec, rng):
+    # lognormal:MEDIAN:SIGMA | uniform:MIN:MAX | fixed:SIZE | mix:SIZE,SIZE,...
+    kind, _, args = spec.partition(':')
+    if kind == 'lognormal':
+        median, sigma = args.split(':')
+        return lambda: max(16, min(4 * 1024 * 1024, int(rng.lognormvariate(0, float(sigma)) * int(median))))
+    if kind == 'uniform':
+        low, high = args.split(':')
+        return lambda: rng.randint(int(low), int(high))
+    if kind == 'fixed':
+        return lambda: int(args)
+    if kind == 'mix':
+        sizes = [int(size) for size in args.split(',')]
+        return lambda: rng.choice(sizes)
+    raise ValueError(f"Unknown size distribution: {spec}")
+
+
+def percentile(values, q):
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(q * (len(ordered) - 1))))]
+
+
+class Stage:
+    # Latencies of one stage; ops are handler invocations, bytes the note content they moved
+
+    def __init__(self, name):
+        self.name = name
+        self.latencies = []
+        self.bytes = 0
+        self.errors = 0
+        self.seconds = 0.0
+
+    def summary(self):
+        ms = [latency * 1000 for latency in self.latencies]
+        return {
+            'ops': len(ms),
+            'errors': self.errors,
+            'seconds': self.seconds,
+            'ops_per_s': len(ms) / self.seconds if self.seconds else None,
+            'mb_per_s': self.bytes / (1024 * 1024) / self.seconds if self.seconds else None,
+            'p50_ms': percentile(ms, 0.50),
+            'p95_ms': percentile(ms, 0.95),
+            'p99_ms': percentile(ms, 0.99),
+            'max_ms': max(ms) if ms else None
+        }
+
+
+def run_stage(stage, calls, concurrency):
+    # calls: list of (function, content_bytes); a call fails by raising or returning a non-200 response
+    def timed(call):
+        function, size = call
+        start = time.perf_counter()
+        try:
+            response = function()
+            ok = response is None or response.get('statusCode', 200) == 200
+        except Exception as e:
+            logger.warning(f"{stage.name} call failed: {e}")
+            ok = False
+        return time.perf_counter() - start, size, ok
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        for latency, size, ok in executor.map(timed, calls):
+            stage.latencies.append(latency)
+            if ok:
+                stage.bytes += size
+            else:
+                stage.errors += 1
+    stage.seconds += time.perf_counter() - start
+    return stage
+
+
+def setup_environment(args):
+    # Handlers read their configuration at import time, so the environment and the moto
+    # backends must exist before they are imported. Returns a cleanup function.
+    os.environ.update({
+        'AWS_DEFAULT_REGION': 'us-east-1', 'AWS_ACCESS_KEY_ID': 'benchmark', 'AWS_SECRET_ACCESS_KEY': 'benchmark',
+        'NOTES_BUCKET': 'benchmark-notes', 'NOTES_TABLE': 'benchmark-notes',
+        'COMPRESSION_ALGO': args.algo,
+        'INLINE_MAX_BYTES': str(args.inline_max_bytes),
+        'INGEST_COMPRESS_MAX_BYTES': str(args.ingest_compress_max_bytes),
+        'PACK_MAX_NOTE_BYTES': str(args.pack_max_note_bytes),
+        'DEDUPE_MIN_BYTES': str(args.dedupe_min_bytes),
+        'COMPRESS_STREAM_MIN_BYTES': str(args.stream_min_bytes),
+        'DELTA_KEYFRAME_INTERVAL': str(args.keyframe_interval),
+        'READ_METRICS_FLUSH_INTERVAL': '3600',  # flushed explicitly before the metrics stage
+        'METRICS_FORMAT': 'off'  # per-invocation records would be printed between the results
+    })
+    if args.backend == 'local':
+        directory = tempfile.mkdtemp(prefix='notes-benchmark-')
+        os.environ.update({'STORAGE_BACKEND': 'local', 'LOCAL_STORAGE_DIR': directory,
+                           'NOTES_QUEUE_URL': 'local://queue/benchmark-notes'})
+        cleanup = lambda: shutil.rmtree(directory, ignore_errors=True)
+    else:
+        from moto import mock_aws
+        mock = mock_aws()
+        mock.start()
+        import boto3
+        boto3.client('s3').create_bucket(Bucket='benchmark-notes')
+        boto3.client('dynamodb').create_table(
+            TableName='benchmark-notes',
+            KeySchema=[{'AttributeName': 'note_id', 'KeyType': 'HASH'}, {'AttributeName': 'version', 'KeyType': 'RANGE'}],
+            AttributeDefinitions=[{'AttributeName': 'note_id', 'AttributeType': 'S'}, {'AttributeName': 'version', 'AttributeType': 'S'}],
+            BillingMode='PAY_PER_REQUEST')
+        os.environ['NOTES_QUEUE_URL'] = boto3.client('sqs').create_queue(QueueName='benchmark-notes')['QueueUrl']
+        cleanup = mock.stop
+    if args.algo in ('TRAINED_ZSTD', 'ADAPTIVE'):
+        # Publish a dictionary trained on the same generator, as train.py would
+        import pyzstd
+        import aws_clients
+        corpus = Corpus(args.seed + 1)
+        samples = [corpus.text(2048).encode('utf-8') for _ in range(500)]
+        aws_clients.s3.put_object(Bucket='benchmark-notes', Key='notes/zstd_dictionary',
+                                  Body=pyzstd.train_dict(samples, 16 * 1024).dict_content)
+    return cleanup
+
+
+def drain_queue(sqs, queue_url):
+    messages = []
+    while True:
+        batch = sqs.receive_message(QueueUrl=queue_url, MaxNumberOfMessages=10).get('Messages', [])
+        if not batch:
+            return messages
+        messages += batch
+
+
+def scan_items(table):
+    kwargs = {}
+    while True:
+        response = table.scan(**kwargs)
+        yield from response.get('Items', [])
+        if 'LastEvaluatedKey' not in response:
+            return
+        kwargs['ExclusiveStartKey'] = response['LastEvaluatedKey']
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the note handlers in-process against moto or the local backend")
+    parser.add_argument('--notes', type=int, default=100)
+    parser.add_argument('--versions', type=int, default=5)
+    parser.add_argument('--sizes', default='lognormal:4096:1.5', help="lognormal:MEDIAN:SIGMA, uniform:MIN:MAX, fixed:SIZE or mix:SIZE,...")
+    parser.add_argument('--concurrency', type=int, default=8, help="concurrent handler invocations")
+    parser.add_argument('--reads', type=int, default=2, help="full reads per version in the retrieve stages")
+    parser.add_argument('--algo', default='ZSTD', choices=['NONE', 'ZSTD', 'TRAINED_ZSTD', 'ADAPTIVE'])
+    parser.add_argument('--keyframe-interval', type=int, default=0)
+    parser.add_argument('--inline-max-bytes', type=int, default=4096)
+    parser.add_argument('--ingest-compress-max-bytes', type=int, default=0,
+                        help="compress notes up to this size in upload_notes instead of through the queue")
+    parser.add_argument('--pack-max-note-bytes', type=int, default=0,
+                        help="store compressed versions up to this size in shared pack objects")
+    parser.add_argument('--dedupe-min-bytes', type=int, default=0,
+                        help="deduplicate notes of at least this size by content hash")
+    parser.add_argument('--stream-min-bytes', type=int, default=16 * 1024 * 1024,
+                        help="compress notes of at least this size while streaming them through a multipart upload")
+    parser.add_argument('--backend', default='moto', choices=['moto', 'local'],
+                        help="moto's in-memory AWS, or local_backend (files, SQLite, in-process queue)")
+    parser.add_argument('--stages', nargs='+', default=STAGES, choices=STAGES)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--json', help="also write the results to this file")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.WARNING, format='%(levelname)s %(message)s')
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    cleanup = setup_environment(args)
+    import aws_clients
+    import note_blobs
+    handlers = {name: importlib.import_module(name) for name in
+                ['upload_notes', 'compress_notes', 'retrieve_note', 'bulk_retrieve_notes', 'get_metrics']}
+    # The handlers log every step at INFO; keep that out of the measurements
+    logger.setLevel(logging.WARNING)
+
+    rng = random.Random(args.seed)
+    corpus = Corpus(args.seed)
+    next_size = size_sampler(args.sizes, rng)
+    notes = {}  # (note_id, version) -> content
+    for n in range(args.notes):
+        content = corpus.text(next_size())
+        for version in range(1, args.versions + 1):
+            notes[(f"bench_{n}", str(version))] = content
+            content = corpus.edit(content)
+    keys = list(notes)
+    total_bytes = sum(len(content.encode('utf-8')) for content in notes.values())
+    results = {}
+
+    def record(stage):
+        results[stage.name] = stage.summary()
+
+    # Versions of a note are uploaded in order, so delta bases exist before they are needed
+    if 'upload' in args.stages:
+        upload = handlers['upload_notes']
+        stage = Stage('upload')
+        for version in range(1, args.versions + 1):
+            calls = [(lambda key=key: upload.lambda_handler({'httpMethod': 'PUT', 'body': json.dumps(
+                {'note_id': key[0], 'version': key[1], 'content': notes[key], 'title': key[0]})}),
+                len(notes[key].encode('utf-8'))) for key in keys if key[1] == str(version)]
+            run_stage(stage, calls, args.concurrency)
+        record(stage)
+
+    if 'compress' in args.stages:
+        compress = handlers['compress_notes']
+        messages = drain_queue(aws_clients.sqs, os.environ['NOTES_QUEUE_URL'])
+        records = [{'messageId': message['MessageId'], 'body': message['Body']} for message in messages]
+        sizes = {key: len(content.encode('utf-8')) for key, content in notes.items()}
+
+        def batch_size(batch):
+            return sum(sizes.get((body['note_id'], body['version']), 0) for body in (json.loads(r['body']) for r in batch))
+
+        def invoke(batch):
+            response = compress.lambda_handler({'Records': batch})
+            return {'statusCode': 500 if response['batchItemFailures'] else 200}
+
+        # One invocation per SQS batch of 10, as the event source mapping delivers them
+        batches = [records[i:i + 10] for i in range(0, len(records), 10)]
+        record(run_stage(Stage('compress'), [(lambda batch=batch: invoke(batch), batch_size(batch)) for batch in batches],
+                         args.concurrency))
+
+    retrieve = handlers['retrieve_note']
+
+    def read(key, headers=None, **params):
+        return retrieve.lambda_handler({'queryStringParameters': dict(note_id=key[0], version=key[1], **params),
+                                        'headers': headers or {}})
+
+    def zstd_read(key):
+        # Passthrough responses are decompressed here, as a client would
+        response = read(key, {'Accept-Encoding': 'zstd'})
+        if response['statusCode'] == 200 and response.get('isBase64Encoded'):
+            import pyzstd
+            if pyzstd.decompress(base64.b64decode(response['body'])).decode('utf-8') != notes[key]:
+                raise ValueError(f"content mismatch for {key}")
+        return response
+
+    def verified_read(key):
+        response = read(key)
+        if response['statusCode'] == 200 and json.loads(response['body'])['content'] != notes[key]:
+            raise ValueError(f"content mismatch for {key}")
+        return response
+
+    read_order = [key for key in keys for _ in range(args.reads)]
+    rng.shuffle(read_order)
+    if 'retrieve' in args.stages:
+        # Every version's first read misses the warm-container cache; content is verified
+        record(run_stage(Stage('retrieve'), [(lambda key=key: verified_read(key), len(notes[key].encode('utf-8')))
+                                             for key in read_order], args.concurrency))
+    if 'retrieve_warm' in args.stages:
+        record(run_stage(Stage('retrieve_warm'), [(lambda key=key: read(key), len(notes[key].encode('utf-8')))
+                                                  for key in read_order], args.concurrency))
+    if 'retrieve_range' in args.stages:
+        record(run_stage(Stage('retrieve_range'), [(lambda key=key: read(key, offset=str(len(notes[key]) // 2), length='1024'),
+                                                    1024) for key in read_order], args.concurrency))
+    if 'retrieve_zstd' in args.stages:
+        # Accept-Encoding: zstd; plain-zstd notes come back as stored (or as a presigned URL)
+        record(run_stage(Stage('retrieve_zstd'), [(lambda key=key: zstd_read(key), len(notes[key].encode('utf-8')))
+                                                  for key in read_order], args.concurrency))
+    if 'bulk_retrieve' in args.stages:
+        bulk = handlers['bulk_retrieve_notes']
+        pages = [keys[i:i + 50] for i in range(0, len(keys), 50)]
+        record(run_stage(Stage('bulk_retrieve'), [(lambda page=page: bulk.lambda_handler({'body': json.dumps(
+            {'notes': [{'note_id': note_id, 'version': version} for note_id, version in page]})}),
+            sum(len(notes[key].encode('utf-8')) for key in page)) for page in pages], args.concurrency))
+
+    if 'metrics' in args.stages:
+        # Buffered read metrics and upload rollups are otherwise added after later invocations
+        retrieve.metrics_buffer.flush()
+        handlers['upload_notes'].rollup_buffer.flush()
+        metrics = handlers['get_metrics']
+        note_ids = sorted({note_id for note_id, _ in keys})
+        calls = [(lambda: metrics.lambda_handler({'httpMethod': 'GET'}), 0),
+                 (lambda: metrics.lambda_handler({'httpMethod': 'GET', 'queryStringParameters': {'list': 'all'}}), 0)]
+        calls += [(lambda note_id=note_id: metrics.lambda_handler({'httpMethod': 'GET', 'queryStringParameters': {'note_id': note_id}}), 0)
+                  for note_id in note_ids]
+        record(run_stage(Stage('metrics'), calls, args.concurrency))
+
+    # Stored size as reported by the service itself
+    stored_bytes = 0
+    for item in scan_items(aws_clients.table('benchmark-notes')):
+        if item.get('deduplicated') or note_blobs.is_blob_item(item):
+            continue  # a blob's bytes are counted on the version that stored it
+        if item.get('compression_ratio') is not None and item.get('uncompressed_size') is not None:
+            stored_bytes += float(item['compression_ratio']) * int(item['uncompressed_size'])
+        elif item.get('s3_key'):
+            stored_bytes += len(notes[(item['note_id'], item['version'])].encode('utf-8'))
+    report = {
+        'config': {key: value for key, value in vars(args).items() if key != 'json'},
+        'corpus': {'versions': len(keys), 'bytes': total_bytes},
+        'storage_ratio': stored_bytes / total_bytes if total_bytes else None,
+        'stages': results
+    }
+    cleanup()
+
+    print(f"{len(keys)} versions, {total_bytes / (1024 * 1024):.1f} MiB, algo={args.algo}, "
+          f"storage ratio={report['storage_ratio']:.3f}")
+    print(f"{'stage':<15} {'ops':>6} {'err':>4} {'ops/s':>9} {'MB/s':>8} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'max ms':>8}")
+    for name, s in results.items():
+        print(f"{name:<15} {s['ops']:>6} {s['errors']:>4} {s['ops_per_s'] or 0:>9.1f} {s['mb_per_s'] or 0:>8.2f} "
+              f"{s['p50_ms'] or 0:>8.2f} {s['p95_ms'] or 0:>8.2f} {s['p99_ms'] or 0:>8.2f} {s['max_ms'] or 0:>8.2f}")
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as f:
+            json.dump(report, f, indent=2)
+    return 1 if any(s['errors'] for s in results.values()) else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,277 @@
+import os
+import json
+import time
+from botocore.exceptions import ClientError
+from concurrent.futures import ThreadPoolExecutor
+import logging
+import instrumentation
+import post_invocation
+import note_codec
+import note_packs
+from version_chain import VersionNotFound
+from retrieve_note import dynamodb, s3, note_cache, metrics_buffer, reader, S3_BUCKET, DDB_TABLE, READ_CACHE_MAX_BYTES, READ_CACHE_MODE
+
+# Bulk variant of retrieve_note: many (note_id, version) pairs in one request, sharing the
+# warm-container cache, delta reader and metrics buffer of retrieve_note.
+# Maximum pairs accepted per request
+BULK_RETRIEVE_MAX_NOTES = int(os.environ.get('BULK_RETRIEVE_MAX_NOTES', '100'))
+# Response payload bytes taken by results; the rest is returned as 'unprocessed' (Lambda responses are capped at 6 MB)
+BULK_RETRIEVE_MAX_BYTES = int(os.environ.get('BULK_RETRIEVE_MAX_BYTES', str(4 * 1024 * 1024)))
+# Concurrent S3 reads and decompressions per request (the S3 client's connection pool is shared)
+BULK_RETRIEVE_MAX_WORKERS = int(os.environ.get('BULK_RETRIEVE_MAX_WORKERS', '10'))
+# Packed versions closer than this in the same pack are read with one ranged GET
+PACK_READ_GAP_BYTES = int(os.environ.get('BULK_RETRIEVE_PACK_GAP_BYTES', str(64 * 1024)))
+# DynamoDB BatchGetItem limit
+DDB_BATCH_SIZE = 100
+BATCH_GET_ATTEMPTS = 5
+
+# Set up logging for Lambda/CloudWatch
+logger = logging.getLogger()
+logger.setLevel(instrumentation.LOG_LEVEL)
+
+
+def batch_get_items(keys):
+    # Returns (items by (note_id, version), keys still unprocessed after BATCH_GET_ATTEMPTS)
+    items = {}
+    unresolved = []
+    for start in range(0, len(keys), DDB_BATCH_SIZE):
+        request = {DDB_TABLE: {'Keys': [{'note_id': note_id, 'version': version}
+                                        for note_id, version in keys[start:start + DDB_BATCH_SIZE]]}}
+        for attempt in range(BATCH_GET_ATTEMPTS):
+            with instrumentation.stage('ddb_read'):
+                response = dynamodb.batch_get_item(RequestItems=request)
+            for item in response.get('Responses', {}).get(DDB_TABLE, []):
+                items[(item['note_id'], item['version'])] = item
+            request = response.get('UnprocessedKeys')
+            if not request:
+                break
+            time.sleep(0.05 * 2 ** attempt)
+        if request:
+            unresolved += [(key['note_id'], key['version']) for key in request[DDB_TABLE]['Keys']]
+    return items, unresolved
+
+
+def stored_size(item):
+    if item.get('uncompressed_size') is not None:
+        return int(item['uncompressed_size'])
+    return None  # presigned upload not compressed yet (or written before sizes were recorded)
+
+
+def payload_size(result):
+    # Bytes a result adds to the Lambda response: the body is JSON with non-ASCII escaped, and
+    # is itself encoded as a JSON string in the response payload
+    return len(json.dumps(json.dumps(result)))
+
+
+def too_large(note_id, version):
+    return {'note_id': note_id, 'version': version, 'status': 'too_large',
+            'error': f'Note exceeds the {BULK_RETRIEVE_MAX_BYTES} byte response limit; read it with GET /retrieve'}
+
+
+def pack_reads(keys, items):
+    # Groups packed versions into ranged GETs: [(pack_key, start, end, [keys])], one per run of
+    # versions in a pack separated by at most PACK_READ_GAP_BYTES. Only runs of two or more.
+    by_pack = {}
+    for key in keys:
+        item = items.get(key)
+        if item is not None and note_packs.is_packed(item):
+            by_pack.setdefault(item['compressed_key'], []).append((int(item['pack_offset']), int(item['pack_length']), key))
+    reads = []
+    for pack_key, spans in by_pack.items():
+        spans.sort()
+        runs = [[spans[0]]]
+        for span in spans[1:]:
+            previous = runs[-1][-1]
+            if span[0] - (previous[0] + previous[1]) > PACK_READ_GAP_BYTES:
+                runs.append([])
+            runs[-1].append(span)
+        reads += [(pack_key, run[0][0], max(offset + length for offset, length, _ in run) - 1, [key for _, _, key in run])
+                  for run in runs if len(run) > 1]
+    return reads
+
+
+def read_pack_range(read, items):
+    # Stored bytes of each version in one coalesced read; {} if the read fails (versions are then read one by one)
+    pack_key, start, end, keys = read
+    try:
+        with instrumentation.stage('s3_get'):
+            data = s3.get_object(Bucket=S3_BUCKET, Key=pack_key, Range=f"bytes={start}-{end}")['Body'].read()
+    except ClientError as e:
+        logger.warning(f"Failed to read {pack_key} bytes {start}-{end}: {e.response['Error']['Message']}")
+        return {}
+    stored = {}
+    for key in keys:
+        offset = int(items[key]['pack_offset']) - start
+        stored[key] = data[offset:offset + int(items[key]['pack_length'])]
+    return stored
+
+
+def load_note(note_id, version, item, cached_data, stored=None):
+    # Content of one version, decompressed in this worker thread; stored is its stored bytes if already read
+    start = time.perf_counter()
+    decompression_latency = None
+    reconstruction_latency = None
+    if cached_data is not None and not (READ_CACHE_MODE == 'compressed' and note_codec.item_codec(item) != note_codec.CODEC_NONE):
+        note_bytes = cached_data
+    else:
+        if cached_data is not None:
+            stored, is_final = cached_data, True
+        elif stored is not None:
+            is_final = True
+        else:
+            with instrumentation.stage('s3_get'):
+                item, stored, is_final = reader.read_stored(note_id, version, item)
+        if is_final:
+            base_content = None
+            if item.get('delta_base') is not None:
+                reconstruction_start = time.perf_counter()
+                with instrumentation.stage('reconstruct'):
+                    base_content = reader.load(note_id, item['delta_base'])
+                reconstruction_latency = (time.perf_counter() - reconstruction_start) * 1000
+            decompression_start = time.perf_counter()
+            with instrumentation.stage('decompress'):
+                note_bytes = note_codec.decompress(item, stored, base_content)
+            decompression_latency = (time.perf_counter() - decompression_start) * 1000
+            if cached_data is None and READ_CACHE_MAX_BYTES > 0:
+                note_cache.put((note_id, version), item, stored if READ_CACHE_MODE == 'compressed' else note_bytes)
+        else:
+            note_bytes = stored  # still waiting in the compression queue
+            decompression_latency = 0
+    metrics_buffer.record(note_id, version, size=item.get('uncompressed_size'), decompression_latency=decompression_latency,
+                          read_latency=(time.perf_counter() - start) * 1000,
+                          reconstruction_latency=reconstruction_latency)
+    return item, note_bytes
+
+
+def parse_keys(notes):
+    keys = []
+    for note in notes:
+        note_id, version = note['note_id'], str(note['version'])
+        if not isinstance(note_id, str) or not note_id or not version:
+            raise ValueError("each note needs a note_id and version")
+        keys.append((note_id, version))
+    return keys
+
+
+@instrumentation.instrumented('bulk_retrieve_notes')
+@post_invocation.handler
+def lambda_handler(event, context=None):
+    method = event.get('httpMethod', 'POST')
+    if method != 'POST':
+        logger.error(f"Invalid method: {method}")
+        return {
+            'statusCode': 405,
+            'body': json.dumps({'error': 'Method Not Allowed'})
+        }
+    try:
+        with instrumentation.stage('parse'):
+            body = event['body'] if isinstance(event['body'], dict) else json.loads(event['body'])
+        keys = parse_keys(body['notes'])
+        if not keys:
+            raise ValueError("notes must be a non-empty array")
+        if len(keys) > BULK_RETRIEVE_MAX_NOTES:
+            raise ValueError(f"at most {BULK_RETRIEVE_MAX_NOTES} notes per request")
+    except Exception as e:
+        logger.error(f"Invalid input: {e}")
+        return {
+            'statusCode': 400,
+            'body': json.dumps({'error': f'Invalid input: {e}'})
+        }
+    instrumentation.annotate(notes=len(keys))
+
+    # 1. Resolve metadata: the warm-container cache first, then BatchGetItem for the rest
+    cached = {}
+    if READ_CACHE_MAX_BYTES > 0:
+        for key in keys:
+            entry = note_cache.get(key)
+            if entry is not None:
+                cached[key] = entry
+    missing = list(dict.fromkeys(key for key in keys if key not in cached))
+    try:
+        items, unresolved = batch_get_items(missing) if missing else ({}, [])
+    except ClientError as e:
+        logger.error(f"Failed to fetch metadata from DynamoDB: {e.response['Error']['Message']}")
+        return {
+            'statusCode': 500,
+            'body': json.dumps({'error': f'Failed to fetch metadata: {e.response["Error"]["Message"]}'})
+        }
+    for key, (item, _) in cached.items():
+        items[key] = item
+
+    # 2. Take versions in request order until their uncompressed sizes reach the response size
+    # cap. Encoding never makes content smaller, so a version larger than the cap never fits. A
+    # version of unknown size could be any size, so it is only taken first, alone.
+    results = {}
+    selected = []
+    unprocessed = []
+    total_size = 0
+    for key in dict.fromkeys(keys):
+        item = items.get(key)
+        size = stored_size(item) if item is not None else 0
+        if size is not None and size > BULK_RETRIEVE_MAX_BYTES:
+            results[key] = too_large(*key)
+            continue
+        if selected and (unprocessed or size is None or total_size is None or total_size + size > BULK_RETRIEVE_MAX_BYTES):
+            unprocessed.append(key)
+            continue
+        selected.append(key)
+        total_size = None if size is None else total_size + size
+
+    # 3. Read and decompress the selected versions concurrently
+    def fetch(key):
+        note_id, version = key
+        item = items.get(key)
+        if item is None:
+            if key in unresolved:
+                return {'note_id': note_id, 'version': version, 'status': 'failed', 'error': 'Metadata read throttled'}
+            return {'note_id': note_id, 'version': version, 'status': 'not_found', 'error': 'Note not found'}
+        try:
+            item, note_bytes = load_note(note_id, version, item, cached[key][1] if key in cached else None, prefetched.get(key))
+        except VersionNotFound:
+            return {'note_id': note_id, 'version': version, 'status': 'not_found', 'error': 'Note content not found'}
+        except ClientError as e:
+            logger.error(f"Failed to fetch note_id={note_id}, version={version} from S3: {e.response['Error']['Message']}")
+            return {'note_id': note_id, 'version': version, 'status': 'failed',
+                    'error': f'Failed to fetch note from S3: {e.response["Error"]["Message"]}'}
+        except Exception as e:
+            logger.error(f"Failed to decompress note_id={note_id}, version={version}: {e}")
+            return {'note_id': note_id, 'version': version, 'status': 'failed', 'error': f'Failed to decompress note: {e}'}
+        return {'note_id': note_id, 'version': version, 'status': 'ok', 'title': item.get('title', ''),
+                'content': str(note_bytes, 'utf-8')}
+
+    with ThreadPoolExecutor(max_workers=max(1, min(BULK_RETRIEVE_MAX_WORKERS, len(selected)))) as executor:
+        # Versions sharing a pack are read together first
+        prefetched = {}
+        reads = pack_reads([key for key in selected if key not in cached], items)
+        for stored in executor.map(instrumentation.bind(lambda read: read_pack_range(read, items)), reads):
+            prefetched.update(stored)
+        fetched = dict(zip(selected, executor.map(instrumentation.bind(fetch), selected)))
+
+    # Escaping can make the encoded results larger than their content: keep them within the cap,
+    # returning the rest as unprocessed
+    with instrumentation.stage('serialize'):
+        total_size = 0
+        for index, key in enumerate(selected):
+            size = payload_size(fetched[key])
+            if size > BULK_RETRIEVE_MAX_BYTES:
+                results[key] = too_large(*key)
+            elif total_size + size > BULK_RETRIEVE_MAX_BYTES:
+                unprocessed[:0] = selected[index:]
+                break
+            else:
+                results[key] = fetched[key]
+                total_size += size
+
+    # 4. Per-version results in request order; resend 'unprocessed' to continue
+    failed = sum(1 for result in results.values() if result['status'] != 'ok')
+    instrumentation.annotate(cache_hits=len(cached), failed=failed, unprocessed=len(unprocessed))
+    with instrumentation.stage('serialize'):
+        body = json.dumps({
+            'results': [results[key] for key in dict.fromkeys(keys) if key in results],
+            'failed': failed,
+            'unprocessed': [{'note_id': note_id, 'version': version} for note_id, version in unprocessed]
+        })
+    return {
+        'statusCode': 200,
+        'body': body
+    }
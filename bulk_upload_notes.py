@@ -0,0 +1,197 @@
+import os
+import json
+from botocore.exceptions import ClientError
+from concurrent.futures import ThreadPoolExecutor
+import logging
+import instrumentation
+import post_invocation
+import metric_rollups
+import note_blobs
+import note_codec
+from upload_notes import s3, table, sqs, S3_BUCKET, SQS_QUEUE_URL, \
+	note_key, inline_item, metadata_item, compression_message, is_inline, content_digest, is_reserved_id, rollup_buffer
+
+# Bulk variant of upload_notes: one request stores many notes (or versions) at once.
+# Maximum notes accepted per request
+BULK_MAX_NOTES = int(os.environ.get('BULK_MAX_NOTES', '500'))
+# Concurrent S3 uploads per request
+BULK_MAX_WORKERS = int(os.environ.get('BULK_MAX_WORKERS', '10'))
+# DynamoDB BatchWriteItem and SQS SendMessageBatch limits
+DDB_BATCH_SIZE = 25
+SQS_BATCH_SIZE = 10
+
+# Set up logging for Lambda/CloudWatch
+logger = logging.getLogger()
+logger.setLevel(instrumentation.LOG_LEVEL)
+
+
+def chunks(items, size):
+	for start in range(0, len(items), size):
+		yield items[start:start + size]
+
+
+def parse_note(note):
+	# Returns (note_id, version, title, note_data); raises on invalid input
+	note_id = note['note_id']
+	if not isinstance(note_id, str) or not note_id:
+		raise ValueError("note_id must be a non-empty string")
+	if is_reserved_id(note_id):
+		raise ValueError(f"note_id must not start with {note_blobs.BLOB_ID_PREFIX} or {metric_rollups.ROLLUP_ID_PREFIX}")
+	version = str(note.get('version', '1'))
+	title = note.get('title', '')
+	return note_id, version, title, note['content'].encode('utf-8')
+
+
+def claim_blob(entry):
+	# Content already stored as a blob is referenced instead of uploaded and queued
+	try:
+		shared = note_blobs.claim(table, entry['digest'])
+	except ClientError as e:
+		logger.warning(f"Failed to look up blob {entry['digest']}: {e.response['Error']['Message']}")
+		return False
+	if shared is None:
+		return False
+	entry['s3_key'] = shared.pop('compressed_key')
+	entry['item']['compressed_key'] = entry['s3_key']
+	entry['item'].update(shared)
+	entry['deduplicated'] = True
+	return True
+
+
+def put_content(entry):
+	if entry['digest'] is not None and claim_blob(entry):
+		return
+	try:
+		with instrumentation.stage('s3_put'):
+			s3.put_object(Bucket=S3_BUCKET, Key=entry['s3_key'], Body=entry['note_data'])
+	except ClientError as e:
+		entry['error'] = f"Failed to store note in S3: {e.response['Error']['Message']}"
+
+
+def write_items(entries):
+	# One batch writer per BatchWriteItem-sized chunk, so a failure only fails that chunk.
+	# batch_writer resubmits unprocessed items itself.
+	for chunk in chunks(entries, DDB_BATCH_SIZE):
+		try:
+			with instrumentation.stage('ddb_write'), table.batch_writer(overwrite_by_pkeys=['note_id', 'version']) as batch:
+				for entry in chunk:
+					batch.put_item(Item=entry['item'])
+		except ClientError as e:
+			logger.error(f"Failed to write metadata batch to DynamoDB: {e.response['Error']['Message']}")
+			for entry in chunk:
+				entry['error'] = f"Failed to store metadata in DynamoDB: {e.response['Error']['Message']}"
+
+
+def enqueue(entries):
+	for chunk in chunks(entries, SQS_BATCH_SIZE):
+		messages = [{
+			'Id': str(index),
+			'MessageBody': compression_message(entry['note_id'], entry['version'], entry['s3_key'])
+		} for index, entry in enumerate(chunk)]
+		try:
+			with instrumentation.stage('sqs_send'):
+				response = sqs.send_message_batch(QueueUrl=SQS_QUEUE_URL, Entries=messages)
+		except ClientError as e:
+			logger.error(f"Failed to enqueue SQS batch: {e.response['Error']['Message']}")
+			for entry in chunk:
+				entry['error'] = f"Failed to enqueue SQS message: {e.response['Error']['Message']}"
+			continue
+		for failure in response.get('Failed', []):
+			chunk[int(failure['Id'])]['error'] = f"Failed to enqueue SQS message: {failure.get('Message', failure['Code'])}"
+
+
+@instrumentation.instrumented('bulk_upload_notes')
+@post_invocation.handler
+def lambda_handler(event, context=None):
+	method = event.get('httpMethod', 'POST')
+	if method not in ('POST', 'PUT'):
+		logger.error(f"Invalid method: {method}")
+		return {
+			'statusCode': 405,
+			'body': json.dumps({'error': 'Method Not Allowed'})
+		}
+	try:
+		with instrumentation.stage('parse'):
+			body = event['body'] if isinstance(event['body'], dict) else json.loads(event['body'])
+		notes = body['notes']
+		if not isinstance(notes, list) or not notes:
+			raise ValueError("notes must be a non-empty array")
+		if len(notes) > BULK_MAX_NOTES:
+			raise ValueError(f"at most {BULK_MAX_NOTES} notes per request")
+	except Exception as e:
+		logger.error(f"Invalid input: {e}")
+		return {
+			'statusCode': 400,
+			'body': json.dumps({'error': f'Invalid input: {e}'})
+		}
+	instrumentation.annotate(method=method, notes=len(notes))
+
+	# Entries keep request order; each collects its item, S3 key and the first error it hits
+	entries = []
+	for note in notes:
+		try:
+			note_id, version, title, note_data = parse_note(note)
+		except Exception as e:
+			entries.append({'note_id': note.get('note_id') if isinstance(note, dict) else None,
+							'version': None, 's3_key': None, 'error': f'Invalid input: {e}'})
+			continue
+		entry = {'note_id': note_id, 'version': version, 'note_data': note_data, 'error': None,
+				 'digest': None, 'deduplicated': False}
+		entry['item'] = None
+		if is_inline(note_data):
+			try:
+				entry['item'] = inline_item(note_id, version, title, note_data)
+				entry['s3_key'] = None
+			except Exception as e:
+				# e.g. the trained dictionary could not be loaded; stored in S3 and compressed from the queue
+				logger.warning(f"Inline compression failed for note_id={note_id}, version={version}, queueing it: {e}")
+		if entry['item'] is None:
+			entry['s3_key'] = note_key(note_id, version)
+			entry['item'] = metadata_item(note_id, version, title, entry['s3_key'], len(note_data))
+			entry['digest'] = content_digest(note_data)
+		entries.append(entry)
+
+	# 1. Store content of non-inline notes in S3, concurrently, unless it is already stored as a blob
+	uploads = [entry for entry in entries if entry['error'] is None and entry['s3_key']]
+	if uploads:
+		with ThreadPoolExecutor(max_workers=min(BULK_MAX_WORKERS, len(uploads))) as executor:
+			list(executor.map(instrumentation.bind(put_content), uploads))
+
+	# 2. Store metadata (and inline notes) in DynamoDB with batched writes
+	writes = [entry for entry in entries if entry['error'] is None]
+	write_items(writes)
+
+	# Inline and deduplicated notes are stored in final form; their rollup changes are added after
+	# the response. Batch writes can't return the items they replace, so overwrites are left to
+	# rebuild_rollups.py.
+	for entry in writes:
+		if entry['error'] is None:
+			rollup_buffer.add(metric_rollups.changes(entry['note_id'], entry['item']))
+
+	# 3. Enqueue compression jobs in SQS batches
+	if note_codec.is_compressing():
+		jobs = [entry for entry in writes if entry['error'] is None and entry['s3_key'] and not entry['deduplicated']]
+		if jobs:
+			enqueue(jobs)
+
+	# 4. Per-note results, in request order
+	results = []
+	for entry in entries:
+		result = {'note_id': entry['note_id'], 'version': entry['version'], 's3_key': entry['s3_key']}
+		if entry['error']:
+			result.update({'status': 'failed', 'error': entry['error']})
+		else:
+			result['status'] = 'updated' if method == 'PUT' else 'uploaded'
+		results.append(result)
+	failed = sum(1 for result in results if result['status'] == 'failed')
+	instrumentation.annotate(failed=failed, deduplicated=sum(1 for entry in entries if entry.get('deduplicated')))
+	if failed:
+		logger.warning(f"Bulk {method} stored {len(results) - failed} notes, {failed} failed")
+	return {
+		'statusCode': 200,
+		'body': json.dumps({
+			'message': f'{len(results) - failed} notes stored, {failed} failed',
+			'failed': failed,
+			'results': results
+		})
+	}
@@ -1,8 +1,9 @@
-import requests
+import asyncio
 import logging
 import time
 import random
-import json
+import requests
+from notes_client import AsyncNotesClient, NotesAPIError, content_digest
 
 API_GATEWAY_URL = "https://d22dme7p69.execute-api.ap-south-1.amazonaws.com/production_retrieve/notes"  # Update with your actual endpoint
 RETRIEVE_NOTE_URL = "https://d22dme7p69.execute-api.ap-south-1.amazonaws.com/production_retrieve/retrieve"  # Update with your actual endpoint for retrieval
@@ -25,143 +26,54 @@ logger = logging.getLogger()
 logger.setLevel(logging.INFO)
 logging.basicConfig(level=logging.INFO,filename="squeezenotes.log",encoding='utf-8')
 
-filepath = "/Users/nikhilniranjan/andromeda/training-files/"
 data_files_count = 10
-training_set_count = 10000
 min_note_size = 100
 max_note_size = 100000
-sample_text = []
-samples = []
-
-
-# Download sample text
-for i in range(len(SAMPLE_URLS)):
-    response = requests.get(SAMPLE_URLS[i])
-    sample_text.append(response.text)
-    #print(len(sample_text[i]))
-
-
-results = []
-note_table = {}  # (note_id, version) -> content
-note_ids = []
 num_notes = 100
 num_versions = 5
-# num_notes_to_read = 10 #100 not used
-sleep_time = 60
+# Requests in flight (and pooled keep-alive connections)
+concurrency = 16
+
+results = []
+# (note_id, version) -> (sha256, size) of the content written; reads are verified against it
+note_digests = {}
 
-# Download sample text
-#response = requests.get(SAMPLE_URL)
-#sample_text = response.text
 
-# 1. Create notes of varying lengths
-for i in range(num_notes):
+def sample_note(sample_text):
+    # Random excerpt of one of the sample texts
     selected_sample = random.randint(0, data_files_count - 1)
-    note_id = f"note_{int(time.time())}_{i}"
     note_length = random.randint(min_note_size, max_note_size)
-    #vary start point randomly
+    # vary start point randomly
     start_point = random.randint(0, len(sample_text[selected_sample]) - note_length)
-    content = sample_text[selected_sample][start_point:start_point + note_length]
-    payload = {
-        "note_id": note_id,
-        "version": "1",
-        "content": content,
-        "title": f"Note {i}"
-    }
+    return sample_text[selected_sample][start_point:start_point + note_length]
+
+
+async def write_note(client, note_id, version, content, title):
+    action = "create" if version == "1" else "update"
     try:
-        api_response = requests.post(API_GATEWAY_URL, json=payload)
-        logger.info(f"Create note {note_id} response: status={api_response.status_code}")
-        results.append({"action": "create", "note_id": note_id, "statusCode": api_response.status_code})
-        note_table[(note_id, "1")] = content #version number is 1 on creation
-        note_ids.append(note_id)
-    except Exception as e:
-        logger.error(f"Error creating note {note_id}: {e}")
-
-# 2. Update all notes a few times
-for version in range(2, num_versions + 1):
-    for note_id in note_ids:
-        selected_sample = random.randint(0, data_files_count - 1)
-        note_length = random.randint(min_note_size, max_note_size)
-        start_point = random.randint(0, len(sample_text[selected_sample]) - note_length)
-        content = sample_text[selected_sample][start_point:start_point + note_length]
-        payload = {
-            "note_id": note_id,
-            "version": str(version),
-            "content": content,
-            "title": f"Note {note_id} v{version}"
-        }
-        try:
-            api_response = requests.put(API_GATEWAY_URL, json=payload)
-            logger.info(f"Update note {note_id} v{version} response: status={api_response.status_code}")
-            results.append({"action": "update", "note_id": note_id, "version": version, "statusCode": api_response.status_code})
-            note_table[(note_id, str(version))] = content
-        except Exception as e:
-            logger.error(f"Error updating note {note_id} v{version}: {e}")
-
-
-time.sleep(sleep_time) # Wait for a while
-
-# 3. Retrieve random notes and compare contents with retry logic
-max_retries = 3
-retry_delay = 1  # seconds
-for note_id in range(num_notes):
-    for version in range(1, num_versions + 1):
-        note_id = random.choice(note_ids)
-        version = str(random.randint(1, num_versions))
-        params = {"note_id": note_id, "version": version}
-        for attempt in range(1, max_retries + 1):
-            try:
-                response = requests.get(RETRIEVE_NOTE_URL, params=params)
-                logger.info(f"Retrieve note {note_id} v{version} attempt {attempt}: status={response.status_code}")
-                if response.status_code == 200:
-                    body = response.json()
-                    retrieved_content = body.get("content", "")
-                    original_content = note_table.get((note_id, version), None)
-                    match = (retrieved_content == original_content)
-                    results.append({"action": "retrieve_compare", "note_id": note_id, "version": version, "match": match, "attempt": attempt})
-                    break
-                else:
-                    logger.info(f"Note {note_id} v{version} not found on attempt {attempt}. Retrying in {retry_delay} seconds...")
-                    if attempt < max_retries:
-                        time.sleep(retry_delay)
-                        continue
-                    results.append({"action": "retrieve_compare", "note_id": note_id, "version": version, "statusCode": response.status_code, "attempt": attempt})
-                    break
-            except Exception as e:
-                logger.error(f"Error retrieving note {note_id} v{version} (attempt {attempt}): {e}")
-                if attempt == max_retries:
-                    results.append({"action": "retrieve_compare", "note_id": note_id, "version": version, "error": str(e), "attempt": attempt})
-                else:
-                    time.sleep(retry_delay)
-
-
-# 4. Get metrics from metrics endpoint and process results
-logger.info(f"Requesting metrics from API Gateway: {METRICS_URL}")
-try:
-    metrics_response = requests.get(METRICS_URL)
-    logger.info(f"Metrics response: status={metrics_response.status_code}, body={metrics_response.text}")
-    results.append({"action": "get_metrics", "statusCode": metrics_response.status_code, "body": metrics_response.text})
-
-    # Parse metrics JSON
-    metrics = json.loads(metrics_response.text)
-    body = metrics.get('body')
-    body_struct = json.loads(body)
-    list_metrics = body_struct.get("notes_metrics", [])
-    #print("length of the list is ", len(list_metrics))
-
-    '''
-    metrics = metrics_response.json()
-    #print(metrics_json)
-    returned_metrics = metrics.get("body", {})
-    print(returned_metrics)
-    print("\n********\n")
-    first_metric = returned_metrics[0]
-    #if (list_metrics == None):
-    #    print("Empty list!\n")
-    #print(list_metrics[0]["note_id"])
-    #print("length of the list is ", len(list_metrics))
-    print('foobar')
-    print(first_metric)
-    '''
+        await client.put_note(note_id, version, content, title=title, update=version != "1")
+        logger.info(f"{action} note {note_id} v{version}: ok")
+        results.append({"action": action, "note_id": note_id, "version": version, "statusCode": 200})
+        note_digests[(note_id, version)] = content_digest(content)
+    except NotesAPIError as e:
+        logger.error(f"Error in {action} of note {note_id} v{version}: {e}")
+        results.append({"action": action, "note_id": note_id, "version": version, "statusCode": e.status})
+
+
+async def compare_note(client, note_id, version):
+    # Streams the version, compares its hash with what was written; 404s are retried with
+    # backoff until the version is compressed
+    try:
+        digest = await client.note_digest(note_id, version, wait=True)
+        match = digest == note_digests.get((note_id, version))
+        logger.info(f"Retrieve note {note_id} v{version}: match={match}")
+        results.append({"action": "retrieve_compare", "note_id": note_id, "version": version, "match": match})
+    except NotesAPIError as e:
+        logger.error(f"Error retrieving note {note_id} v{version}: {e}")
+        results.append({"action": "retrieve_compare", "note_id": note_id, "version": version, "statusCode": e.status, "error": e.message})
+
+
+def report_metrics(list_metrics):
     # Write all metrics fields to file
     with open("metrics_notes.txt", "w") as f:
         f.write("note_id,version,uncompressed_size,compression_ratio,decompression_latency,read_latency\n")
@@ -173,7 +85,7 @@ try:
             decompression_latency = round(entry.get("decompression_latency"), 3) if entry.get("decompression_latency") is not None else ""
             read_latency = round(entry.get("read_latency"), 3) if entry.get("read_latency") is not None else ""
             f.write(f"{note_id},{version},{uncompressed_size},{compression_ratio},{decompression_latency},{read_latency}\n")
-    logger.info(f"Wrote metrics details to metrics_notes.txt")
+    logger.info("Wrote metrics details to metrics_notes.txt")
 
     # Calculate averages
     compression_ratios = [entry.get("compression_ratio") for entry in list_metrics if isinstance(entry.get("compression_ratio"), (int, float))]
@@ -198,8 +110,45 @@ try:
     print(f"Average decompression latency: {avg_decompression_latency}")
     print(f"Average read latency: {avg_read_latency}")
     print(f"Overall storage savings from compression: {storage_savings}")
-except Exception as e:
-    logger.error(f"Error requesting or processing metrics: {e}")
-    results.append({"action": "get_metrics", "statusCode": 500, "body": f"Error requesting metrics: {e}"})
 
-logger.info(f"Client execution complete. Results: {results}")
+
+async def main():
+    # Download sample text
+    with requests.Session() as session:
+        sample_text = [session.get(url).text for url in SAMPLE_URLS]
+
+    endpoints = {"notes": API_GATEWAY_URL, "retrieve": RETRIEVE_NOTE_URL, "metrics": METRICS_URL}
+    # Reads of versions still being compressed are retried: 10 attempts, backoff from 0.5 s doubling up to 10 s
+    async with AsyncNotesClient(endpoints=endpoints, concurrency=concurrency, attempts=10, backoff_base=0.5) as client:
+        # 1. Create notes of varying lengths
+        note_ids = [f"note_{int(time.time())}_{i}" for i in range(num_notes)]
+        await asyncio.gather(*(write_note(client, note_id, "1", sample_note(sample_text), f"Note {i}")
+                               for i, note_id in enumerate(note_ids)))
+        note_ids = [note_id for note_id in note_ids if (note_id, "1") in note_digests]
+
+        # 2. Update all notes a few times; versions of a note are written in order
+        for version in range(2, num_versions + 1):
+            await asyncio.gather(*(write_note(client, note_id, str(version), sample_note(sample_text), f"Note {note_id} v{version}")
+                                   for note_id in note_ids))
+
+        # 3. Retrieve random notes and compare content hashes
+        await asyncio.gather(*(compare_note(client, random.choice(note_ids), str(random.randint(1, num_versions)))
+                               for _ in range(num_notes * num_versions)))
+
+        # 4. Get metrics from metrics endpoint and process results
+        logger.info(f"Requesting metrics from API Gateway: {METRICS_URL}")
+        try:
+            list_metrics = await client.list_metrics(list='all')
+            results.append({"action": "get_metrics", "statusCode": 200})
+            report_metrics(list_metrics)
+        except Exception as e:
+            logger.error(f"Error requesting or processing metrics: {e}")
+            results.append({"action": "get_metrics", "statusCode": 500, "body": f"Error requesting metrics: {e}"})
+
+    mismatches = sum(1 for result in results if result.get("match") is False)
+    print(f"Retrieved {sum(1 for result in results if result['action'] == 'retrieve_compare')} versions, {mismatches} mismatches")
+    logger.info(f"Client execution complete. Results: {results}")
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
@@ -0,0 +1,138 @@
+import os
+import sys
+import json
+import time
+import logging
+import argparse
+from collections import Counter
+from botocore.exceptions import ClientError
+import aws_clients
+import instrumentation
+import note_blobs
+
+# Garbage collection of deduplicated content (see note_blobs.py). Blob reference counts are
+# taken when a version claims a blob but never released, since versions are overwritten in
+# place, so they can only overstate. This job marks the blobs that version items still refer
+# to, rewrites each blob's count to its marked references and deletes unreferenced blobs that
+# were not claimed for COLLECT_BLOBS_GRACE_SECONDS. A claim taken after the scan changes
+# last_claimed, which the conditional delete checks, so a blob is never deleted under a new
+# reference. Runs on a schedule (lambda_handler) or from the command line:
+#
+#   python collect_blobs.py --dry-run
+
+DDB_TABLE = os.environ.get('NOTES_TABLE', 'your-notes-table')
+S3_BUCKET = os.environ.get('NOTES_BUCKET', 'your-notes-bucket')
+# Unreferenced blobs claimed or written more recently than this are kept: their version item
+# may not be written yet. Must exceed the upload and compress_notes Lambda timeouts.
+COLLECT_BLOBS_GRACE_SECONDS = int(os.environ.get('COLLECT_BLOBS_GRACE_SECONDS', '3600'))
+
+logger = logging.getLogger()
+logger.setLevel(instrumentation.LOG_LEVEL)
+
+
+def scan_references(table):
+    # Returns (blob items, references per digest)
+    blobs = []
+    references = Counter()
+    kwargs = {
+        'FilterExpression': 'attribute_exists(#b) OR begins_with(#n, :prefix)',
+        'ProjectionExpression': '#n, #v, #b, #k, #r, #c, #s',
+        'ExpressionAttributeNames': {'#n': 'note_id', '#v': 'version', '#b': 'blob', '#k': 'compressed_key',
+                                     '#r': 'references', '#c': 'last_claimed', '#s': 'compressed_size'},
+        'ExpressionAttributeValues': {':prefix': note_blobs.BLOB_ID_PREFIX}
+    }
+    while True:
+        response = table.scan(**kwargs)
+        for item in response.get('Items', []):
+            if note_blobs.is_blob_item(item):
+                blobs.append(item)
+            else:
+                references[item['blob']] += 1
+        if 'LastEvaluatedKey' not in response:
+            return blobs, references
+        kwargs['ExclusiveStartKey'] = response['LastEvaluatedKey']
+
+
+def delete_blob(s3, table, blob, digest):
+    # The item goes first, so no version can claim the blob once its object is deleted
+    try:
+        table.delete_item(
+            Key=note_blobs.blob_item_key(digest),
+            ConditionExpression='#c = :seen',
+            ExpressionAttributeNames={'#c': 'last_claimed'},
+            ExpressionAttributeValues={':seen': blob['last_claimed']})
+    except ClientError as e:
+        if e.response['Error']['Code'] == 'ConditionalCheckFailedException':
+            return False
+        raise
+    # Reservations that were never published have no object
+    if blob.get('compressed_key'):
+        s3.delete_object(Bucket=S3_BUCKET, Key=blob['compressed_key'])
+    return True
+
+
+def recount(table, blob, digest, count):
+    try:
+        table.update_item(
+            Key=note_blobs.blob_item_key(digest),
+            UpdateExpression='SET #r = :count',
+            ConditionExpression='#c = :seen',
+            ExpressionAttributeNames={'#r': 'references', '#c': 'last_claimed'},
+            ExpressionAttributeValues={':count': count, ':seen': blob['last_claimed']})
+    except ClientError as e:
+        if e.response['Error']['Code'] != 'ConditionalCheckFailedException':
+            raise
+
+
+def collect(dry_run=False, now=None):
+    s3 = aws_clients.s3
+    table = aws_clients.table(DDB_TABLE)
+    with instrumentation.stage('ddb_read'):
+        blobs, references = scan_references(table)
+    cutoff = (time.time() if now is None else now) - COLLECT_BLOBS_GRACE_SECONDS
+    stats = {
+        'blobs': len(blobs),
+        'references': sum(references.values()),
+        'blobs_deleted': 0,
+        'bytes_deleted': 0,
+        'blobs_recounted': 0,
+        'dry_run': dry_run
+    }
+    for blob in blobs:
+        digest = blob['note_id'][len(note_blobs.BLOB_ID_PREFIX):]
+        count = references.get(digest, 0)
+        if count == 0 and int(blob.get('last_claimed') or 0) < cutoff:
+            deleted = True
+            if not dry_run:
+                with instrumentation.stage('s3_delete'):
+                    deleted = delete_blob(s3, table, blob, digest)
+            if deleted:
+                stats['blobs_deleted'] += 1
+                stats['bytes_deleted'] += int(blob.get('compressed_size') or 0)
+        elif count and count != int(blob.get('references') or 0):
+            if not dry_run:
+                with instrumentation.stage('ddb_write'):
+                    recount(table, blob, digest, count)
+            stats['blobs_recounted'] += 1
+    return stats
+
+
+@instrumentation.instrumented('collect_blobs')
+def lambda_handler(event, context=None):
+    stats = collect(dry_run=bool((event or {}).get('dry_run')))
+    instrumentation.annotate(**{key: value for key, value in stats.items() if key != 'dry_run'})
+    logger.info(f"Blob collection: {json.dumps(stats)}")
+    return stats
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Delete deduplicated blobs no version refers to")
+    parser.add_argument('--dry-run', action='store_true', help="report what would be deleted")
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s %(message)s')
+    print(json.dumps(collect(dry_run=args.dry_run), indent=2))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,211 @@
+import os
+import re
+import sys
+import json
+import time
+import logging
+import argparse
+from botocore.exceptions import ClientError
+import aws_clients
+import instrumentation
+import note_packs
+from get_metrics import version_sort_key
+
+# Compaction of pack files (see note_packs.py). Packs are immutable, so the space of versions
+# that left a pack is only reclaimed by rewriting it: packs whose live bytes fell below
+# COMPACT_MIN_LIVE_RATIO, and packs smaller than COMPACT_SMALL_PACK_BYTES, are rewritten
+# together into new packs of up to COMPACT_TARGET_PACK_BYTES. The live versions are laid out
+# hottest note first (by recorded reads), each note's versions next to each other, so a note's
+# history is one ranged GET. Items are moved with a conditional update, so a version that is
+# rewritten concurrently keeps its new location. Packs left without live versions are deleted
+# by the next run. Runs on a schedule (lambda_handler) or from the command line:
+#
+#   python compact_packs.py --dry-run
+
+DDB_TABLE = os.environ.get('NOTES_TABLE', 'your-notes-table')
+S3_BUCKET = os.environ.get('NOTES_BUCKET', 'your-notes-bucket')
+# Packs younger than this are left alone: their items may not point at them yet, and readers
+# holding an old item still find the version where it was
+COMPACT_GRACE_SECONDS = int(os.environ.get('COMPACT_GRACE_SECONDS', '3600'))
+# Packs with a smaller share of live bytes are rewritten
+COMPACT_MIN_LIVE_RATIO = float(os.environ.get('COMPACT_MIN_LIVE_RATIO', '0.5'))
+# Packs smaller than this are merged with each other
+COMPACT_SMALL_PACK_BYTES = int(os.environ.get('COMPACT_SMALL_PACK_BYTES', str(1024 * 1024)))
+# Size of the packs written by compaction
+COMPACT_TARGET_PACK_BYTES = int(os.environ.get('COMPACT_TARGET_PACK_BYTES', str(8 * 1024 * 1024)))
+# Bytes of source packs read per run, so one run fits in a Lambda's memory and time limit
+COMPACT_MAX_READ_BYTES = int(os.environ.get('COMPACT_MAX_READ_BYTES', str(256 * 1024 * 1024)))
+
+PACK_TIME = re.compile(r'/(\d{13})-[0-9a-f]+\.pack$')
+
+logger = logging.getLogger()
+logger.setLevel(instrumentation.LOG_LEVEL)
+
+
+def pack_created(key):
+    # Creation time encoded in the key by note_packs.new_pack_key, None for foreign objects
+    match = PACK_TIME.search(key)
+    return int(match.group(1)) / 1000 if match else None
+
+
+def list_packs(s3):
+    packs = {}
+    kwargs = {'Bucket': S3_BUCKET, 'Prefix': note_packs.PACK_PREFIX}
+    while True:
+        response = s3.list_objects_v2(**kwargs)
+        for obj in response.get('Contents', []):
+            packs[obj['Key']] = obj['Size']
+        if not response.get('IsTruncated'):
+            return packs
+        kwargs['ContinuationToken'] = response['NextContinuationToken']
+
+
+def packed_items(table):
+    # Every version stored in a pack, with the read count of its note's versions
+    items = []
+    kwargs = {
+        'FilterExpression': 'begins_with(#k, :prefix) AND attribute_exists(#o)',
+        'ProjectionExpression': '#n, #v, #k, #o, #l, #r',
+        'ExpressionAttributeNames': {'#n': 'note_id', '#v': 'version', '#k': 'compressed_key', '#o': 'pack_offset',
+                                     '#l': 'pack_length', '#r': 'read_count'},
+        'ExpressionAttributeValues': {':prefix': note_packs.PACK_PREFIX}
+    }
+    while True:
+        response = table.scan(**kwargs)
+        items.extend(response.get('Items', []))
+        if 'LastEvaluatedKey' not in response:
+            return items
+        kwargs['ExclusiveStartKey'] = response['LastEvaluatedKey']
+
+
+def plan(packs, items, now):
+    # Returns (packs to delete, packs to rewrite, live items by pack)
+    live = {}
+    for item in items:
+        live.setdefault(item['compressed_key'], []).append(item)
+    deletes, rewrites = [], []
+    read_bytes = 0
+    for key, size in sorted(packs.items()):
+        created = pack_created(key)
+        if created is None or now - created < COMPACT_GRACE_SECONDS:
+            continue
+        live_bytes = sum(int(item['pack_length']) for item in live.get(key, []))
+        if not live_bytes:
+            deletes.append(key)
+        elif (live_bytes < size * COMPACT_MIN_LIVE_RATIO or size < COMPACT_SMALL_PACK_BYTES) and read_bytes + size <= COMPACT_MAX_READ_BYTES:
+            rewrites.append(key)
+            read_bytes += size
+    if len(rewrites) == 1 and sum(int(item['pack_length']) for item in live[rewrites[0]]) >= packs[rewrites[0]] * COMPACT_MIN_LIVE_RATIO:
+        rewrites = []  # a single small pack has nothing to merge with
+    return deletes, rewrites, live
+
+
+def note_reads(items):
+    reads = {}
+    for item in items:
+        count = int(item.get('read_count') or 0)
+        reads[item['note_id']] = reads.get(item['note_id'], 0) + count
+    return reads
+
+
+def layout(items):
+    # Hottest notes first, each note's versions together and in version order
+    reads = note_reads(items)
+    return sorted(items, key=lambda item: (-reads[item['note_id']], item['note_id'], version_sort_key(item['version'])))
+
+
+def move(table, item, pack_key, offset):
+    # Points a version at its copy in the new pack, unless it moved since it was scanned
+    try:
+        table.update_item(
+            Key={'note_id': item['note_id'], 'version': item['version']},
+            UpdateExpression='SET #k = :key, #o = :offset, #l = :length',
+            ConditionExpression='#k = :old_key AND #o = :old_offset',
+            ExpressionAttributeNames={'#k': 'compressed_key', '#o': 'pack_offset', '#l': 'pack_length'},
+            ExpressionAttributeValues={':key': pack_key, ':offset': offset, ':length': int(item['pack_length']),
+                                       ':old_key': item['compressed_key'], ':old_offset': item['pack_offset']})
+        return True
+    except ClientError as e:
+        if e.response['Error']['Code'] == 'ConditionalCheckFailedException':
+            return False
+        raise
+
+
+def rewrite(s3, table, rewrites, live, stats):
+    sources = {}
+    for key in rewrites:
+        with instrumentation.stage('s3_get'):
+            sources[key] = s3.get_object(Bucket=S3_BUCKET, Key=key)['Body'].read()
+    entries = layout([item for key in rewrites for item in live[key]])
+    while entries:
+        batch, size = [], 0
+        while entries and (not batch or size + int(entries[0]['pack_length']) <= COMPACT_TARGET_PACK_BYTES):
+            batch.append(entries.pop(0))
+            size += int(batch[-1]['pack_length'])
+        blobs = []
+        for item in batch:
+            offset = int(item['pack_offset'])
+            blobs.append(sources[item['compressed_key']][offset:offset + int(item['pack_length'])])
+        pack, spans = note_packs.build_pack(blobs)
+        pack_key = note_packs.new_pack_key()
+        with instrumentation.stage('s3_put'):
+            s3.put_object(Bucket=S3_BUCKET, Key=pack_key, Body=pack)
+        stats['packs_written'] += 1
+        stats['bytes_written'] += len(pack)
+        for item, (offset, _) in zip(batch, spans):
+            with instrumentation.stage('ddb_write'):
+                moved = move(table, item, pack_key, offset)
+            stats['versions_moved' if moved else 'versions_skipped'] += 1
+
+
+def compact(dry_run=False, now=None):
+    s3 = aws_clients.s3
+    table = aws_clients.table(DDB_TABLE)
+    with instrumentation.stage('s3_list'):
+        packs = list_packs(s3)
+    with instrumentation.stage('ddb_read'):
+        items = packed_items(table)
+    deletes, rewrites, live = plan(packs, items, time.time() if now is None else now)
+    stats = {
+        'packs': len(packs),
+        'pack_bytes': sum(packs.values()),
+        'live_bytes': sum(int(item['pack_length']) for item in items),
+        'packs_deleted': len(deletes),
+        'bytes_deleted': sum(packs[key] for key in deletes),
+        'packs_rewritten': len(rewrites),
+        'bytes_rewritten': sum(packs[key] for key in rewrites),
+        'packs_written': 0,
+        'bytes_written': 0,
+        'versions_moved': 0,
+        'versions_skipped': 0,
+        'dry_run': dry_run
+    }
+    if dry_run:
+        return stats
+    for key in deletes:
+        with instrumentation.stage('s3_delete'):
+            s3.delete_object(Bucket=S3_BUCKET, Key=key)
+    if rewrites:
+        rewrite(s3, table, rewrites, live, stats)
+    return stats
+
+
+@instrumentation.instrumented('compact_packs')
+def lambda_handler(event, context=None):
+    stats = compact(dry_run=bool((event or {}).get('dry_run')))
+    instrumentation.annotate(**{key: value for key, value in stats.items() if key != 'dry_run'})
+    logger.info(f"Compaction: {json.dumps(stats)}")
+    return stats
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Rewrite sparse and small pack files")
+    parser.add_argument('--dry-run', action='store_true', help="report what would be deleted and rewritten")
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s %(message)s')
+    print(json.dumps(compact(dry_run=args.dry_run), indent=2))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
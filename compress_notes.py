@@ -2,138 +2,493 @@ import os
 #import os
 #os.environ["ZSTD_USE_BACKEND"] = "cffi"
 import json
-import boto3
-import pyzstd as zstd
-#import zstandard as zstd
-#from compression import zstd
+import time
+import hashlib
 from botocore.exceptions import ClientError
 from decimal import Decimal, getcontext
 import logging
+from urllib.parse import unquote_plus
+from concurrent.futures import ThreadPoolExecutor
+import aws_clients
+import instrumentation
+import metric_rollups
+import note_blobs
+import note_codec
+import note_frames
+import note_packs
+import version_cache
+import version_chain
+from upload_notes import parse_upload_key
 
 # Environment variables (set in Lambda console or SAM/CloudFormation)
 S3_BUCKET = os.environ.get('NOTES_BUCKET', 'your-notes-bucket')
 DDB_TABLE = os.environ.get('NOTES_TABLE', 'your-notes-table')
-SQS_QUEUE_URL = os.environ.get('NOTES_QUEUE_URL', 'https://sqs.region.amazonaws.com/123456789012/your-queue')
-#COMPRESSION_ALGO = "TRAINED_ZSTD"
-#COMPRESSION_ALGO = "NONE"
-COMPRESSION_ALGO = "ZSTD"
+# Upper bound on records of one SQS batch processed concurrently
+MAX_WORKERS = int(os.environ.get('COMPRESS_MAX_WORKERS', '8'))
+# Codec policy for new versions is note_codec.COMPRESSION_ALGO (COMPRESSION_ALGO env variable)
+# Byte budget for recently seen versions kept as delta bases (DELTA_KEYFRAME_INTERVAL mode)
+DELTA_BASE_CACHE_BYTES = int(os.environ.get('DELTA_BASE_CACHE_BYTES', str(32 * 1024 * 1024)))
+# Versions of at least this many bytes are compressed while they are read and written with a
+# multipart upload, so memory stays bounded whatever their size (0 disables)
+STREAM_MIN_BYTES = int(os.environ.get('COMPRESS_STREAM_MIN_BYTES', str(16 * 1024 * 1024)))
+# Uncompressed bytes read and compressed at a time by a streamed version, and the size of its
+# upload parts (S3 requires at least 5 MiB for all but the last part)
+STREAM_PART_BYTES = max(int(os.environ.get('COMPRESS_STREAM_PART_BYTES', str(8 * 1024 * 1024))), 5 * 1024 * 1024)
+# Threads compressing the frames of a streamed version; Lambda's vCPUs grow with its memory size
+STREAM_WORKERS = int(os.environ.get('COMPRESS_STREAM_WORKERS', str(os.cpu_count() or 1)))
 
 
-s3 = boto3.client('s3')
-dynamodb = boto3.resource('dynamodb')
-sqs = boto3.client('sqs')
-
-table = dynamodb.Table(DDB_TABLE)
+s3 = aws_clients.s3
+table = aws_clients.table(DDB_TABLE)
 
 # Set up logging for Lambda/CloudWatch
 logger = logging.getLogger()
-logger.setLevel(logging.INFO)
+logger.setLevel(instrumentation.LOG_LEVEL)
 
-def get_dictionary_data():
-    response = s3.get_object(Bucket=S3_BUCKET, Key='notes/zstd_dictionary')
-    dictionary_data = response['Body'].read()
-    return dictionary_data
+# Consecutive versions of a note usually arrive close together, so keep recent contents around
+base_cache = version_cache.VersionCache(DELTA_BASE_CACHE_BYTES)
+reader = version_chain.VersionReader(table, s3, S3_BUCKET, cache=base_cache)
 
+def load_delta_base(note_id, version):
+	# Returns (base_version, base_content, chain_depth), or (None, None, None) to write a keyframe.
+	# The depth follows the base's own: keyframes forced off schedule (a missing base, a streamed
+	# or raw base) restart the chain.
+	base_version = version_chain.delta_base_version(version)
+	if base_version is None:
+		return None, None, None
+	try:
+		with instrumentation.stage('reconstruct'):
+			base_item, base_content = reader.load_version(note_id, base_version)
+	except version_chain.VersionNotFound:
+		logger.info(f"Delta base v{base_version} of note_id={note_id} not found, writing a keyframe")
+		return None, None, None
+	if not base_content:
+		return None, None, None
+	return base_version, base_content, int(base_item.get('chain_depth') or 0) + 1
 
-def lambda_handler(event, context=None):
-	# SQS event: event['Records'] is a list of SQS messages
-	#TBD: remove for loop
-	for record in event.get('Records', []):
-		try:
-			body = json.loads(record['body'])
-			note_id = body['note_id']
-			version = str(body.get('version', '1'))
-			s3_key = body['s3_key']
-			logger.info(f"Processing note_id={note_id}, version={version}, s3_key={s3_key}")
-		except Exception as e:
-			logger.error(f"Malformed SQS message: {e}")
-			continue
 
-		# 1. Fetch note from S3
+def encode_note(note_id, version, note_data):
+	# Returns (encoding, stored_bytes, attributes): the codec, level, dictionary and delta base are
+	# chosen per note (see note_codec), and attributes are what the version item records about
+	# the stored form, which tells retrieve_note how to decode it. Also used by upload_notes to
+	# compress at ingest.
+	original_size = len(note_data) if note_data is not None else 0
+	if not isinstance(original_size, int) or original_size < 0:
+		logger.warning(f"original_size invalid for note_id={note_id}, version={version}. Setting to 0.")
+		original_size = 0
+	base_version, base_content, chain_depth = load_delta_base(note_id, version)
+	with instrumentation.stage('compress'):
+		encoding = note_codec.choose_encoding(note_data, base_version, base_content)
+		if encoding.codec == note_codec.CODEC_NONE:
+			compressed, frames = note_data, None
+		else:
+			# Independent frames let retrieve_note serve byte ranges without reading the whole object
+			compressed, frames = note_frames.compress_frames(note_data, encoding.compress)
+
+	return encoding, compressed, stored_attributes(encoding, original_size, len(compressed), frames, chain_depth)
+
+
+def stored_attributes(encoding, original_size, compressed_size, frames, chain_depth=None):
+	# What the version item records about the stored form
+	attributes = {
+		'compression_status': 'compressed',
+		'compression_ratio': Decimal(compressed_size) / Decimal(original_size) if original_size > 0 else None,
+		'uncompressed_size': original_size,
+		'compressed_size': compressed_size,
+		'compressed_at': int(time.time())  # with last_read, how long the version has been cold
+	}
+	attributes.update(encoding.metadata())
+	if frames is not None:
+		attributes['frames'] = frames
+	if encoding.base_version is not None:
+		# Earlier versions read to reconstruct this one
+		attributes['chain_depth'] = chain_depth
+	return attributes
+
+
+def read_window(body, size):
+	# Up to size bytes of a streaming body; shorter only at its end
+	chunks = []
+	length = 0
+	while length < size:
+		chunk = body.read(size - length)
+		if not chunk:
+			break
+		chunks.append(chunk)
+		length += len(chunk)
+	return b''.join(chunks)
+
+
+def stream_note(note_id, version, s3_key, body, size):
+	# Compresses a large version window by window while reading it, the frames of each window in
+	# parallel on STREAM_WORKERS threads, and writes the frames with a multipart upload, so only
+	# about two windows and one part are in memory at a time. Streamed versions are always
+	# keyframes: a delta would need the whole base in memory. Returns (encoding, compressed_key,
+	# attributes, digest); digest is the content hash if the version is deduplicated.
+	window_bytes = max(1, STREAM_PART_BYTES // note_frames.FRAME_SIZE) * note_frames.FRAME_SIZE
+	with instrumentation.stage('s3_get'):
+		window = read_window(body, window_bytes)
+	with instrumentation.stage('compress'):
+		encoding = note_codec.choose_encoding(window, size=size)
+	if encoding.codec == note_codec.CODEC_NONE:
+		body.close()
+		return encoding, s3_key, stored_attributes(encoding, size, size, None), None
+
+	hasher = hashlib.sha256() if note_blobs.is_dedupable(size) else None
+	# Hashed content may become a blob, so it is written where overwriting the version cannot reach it
+	compressed_key = note_blobs.streamed_blob_key() if hasher is not None else s3_key.replace('.txt', '.zst')
+	with instrumentation.stage('s3_put'):
+		upload_id = s3.create_multipart_upload(Bucket=S3_BUCKET, Key=compressed_key)['UploadId']
+	parts, buffered, frames = [], [], []
+	original_size = compressed_size = 0
+
+	def upload_part():
+		with instrumentation.stage('s3_put'):
+			response = s3.upload_part(Bucket=S3_BUCKET, Key=compressed_key, UploadId=upload_id,
+									  PartNumber=len(parts) + 1, Body=b''.join(buffered))
+		parts.append({'PartNumber': len(parts) + 1, 'ETag': response['ETag']})
+		buffered.clear()
+
+	try:
+		with ThreadPoolExecutor(max_workers=max(1, STREAM_WORKERS)) as executor:
+			while window:
+				if hasher is not None:
+					hasher.update(window)
+				view = memoryview(window)
+				chunks = [view[start:start + note_frames.FRAME_SIZE] for start in range(0, len(window), note_frames.FRAME_SIZE)]
+				with instrumentation.stage('compress'):
+					compressed = list(executor.map(encoding.compress, chunks))
+				for chunk, frame in zip(chunks, compressed):
+					frames.append([compressed_size, len(frame), len(chunk)])
+					compressed_size += len(frame)
+				original_size += len(window)
+				buffered += compressed
+				if sum(len(frame) for frame in buffered) >= STREAM_PART_BYTES:
+					upload_part()
+				with instrumentation.stage('s3_get'):
+					window = read_window(body, window_bytes)
+		if buffered or not parts:
+			upload_part()
+		with instrumentation.stage('s3_put'):
+			s3.complete_multipart_upload(Bucket=S3_BUCKET, Key=compressed_key, UploadId=upload_id,
+										 MultipartUpload={'Parts': parts})
+	except Exception:
 		try:
-			logger.info(f"Fetching note from S3: bucket={S3_BUCKET}, key={s3_key}")
-			s3_obj = s3.get_object(Bucket=S3_BUCKET, Key=s3_key)
-			note_data = s3_obj['Body'].read()
-			logger.info(f"Successfully fetched note from S3: {s3_key}")
+			s3.abort_multipart_upload(Bucket=S3_BUCKET, Key=compressed_key, UploadId=upload_id)
 		except ClientError as e:
-			logger.error(f"Failed to fetch note from S3: {e.response['Error']['Message']}")
-			continue
+			logger.warning(f"Failed to abort upload of {compressed_key}: {e.response['Error']['Message']}")
+		raise
+	attributes = stored_attributes(encoding, original_size, compressed_size, frames)
+	return encoding, compressed_key, attributes, hasher.hexdigest() if hasher is not None else None
 
-		# 2. Compress note with zstd and calculate compression ratio
-		try:
-			logger.info(f"Compressing note_id={note_id}, version={version}")
-			original_size = len(note_data) if note_data is not None else 0
-			if not isinstance(original_size, int) or original_size < 0:
-				logger.warning(f"original_size invalid for note_id={note_id}, version={version}. Setting to 0.")
-				original_size = 0
-			if COMPRESSION_ALGO == "ZSTD":
-				compressed = zstd.compress(note_data)
-			elif COMPRESSION_ALGO == "TRAINED_ZSTD":
-				dict_data = get_dictionary_data()  # Function to fetch your trained dictionary data
-				zstd_dict = zstd.ZstdDict(dict_data)
-				compressor = zstd.ZstdCompressor(zstd_dict=zstd_dict)
-				compressed = compressor.compress(note_data)
-				
-			compressed_size = len(compressed)
-			if original_size > 0:
-				compression_ratio = Decimal(compressed_size) / Decimal(original_size)
-			else:
-				compression_ratio = None
-			logger.info(f"Compression successful for note_id={note_id}, version={version}. Ratio: {compression_ratio}, original_size: {original_size}")
-		except Exception as e:
-			logger.error(f"Compression failed for note_id={note_id}, version={version}: {e}")
+
+def remember_base(note_id, version, note_data, attributes):
+	# Call once the version is stored: it is likely the delta base of the next version
+	if version_chain.KEYFRAME_INTERVAL > 1 and note_data is not None:
+		item = {'note_id': note_id, 'version': version}
+		if attributes.get('chain_depth') is not None:
+			item['chain_depth'] = attributes['chain_depth']
+		base_cache.put((note_id, version), item, note_data)
+
+
+def version_state(note_id, version):
+	# The version's compression_status and s3_key, or None if it has no item
+	with instrumentation.stage('ddb_read'):
+		response = table.get_item(
+			Key={'note_id': note_id, 'version': version},
+			ProjectionExpression='compression_status, s3_key',
+			ConsistentRead=True
+		)
+	return response.get('Item')
+
+
+def parse_jobs(record):
+	# Returns [(note_id, version, s3_key)] from a message sent by upload_notes, or from the S3
+	# object-created notification of a presigned upload (see upload_notes.upload_key)
+	body = json.loads(record['body'])
+	if body.get('Event') == 's3:TestEvent':
+		return []  # sent by S3 when the notification is configured
+	if 'Records' not in body:
+		return [(body['note_id'], str(body.get('version', '1')), body['s3_key'])]
+	jobs = []
+	for s3_record in body['Records']:
+		if not s3_record.get('eventName', '').startswith('ObjectCreated:'):
 			continue
+		s3_key = unquote_plus(s3_record['s3']['object']['key'])  # keys in S3 events are URL-encoded
+		note_id, version = parse_upload_key(s3_key)
+		jobs.append((note_id, version, s3_key))
+	return jobs
+
 
-		# 3. Write compressed note back to S3 (new key)
-		compressed_key = s3_key.replace('.txt', '.zst')
+def prepare_record(record):
+	# Returns (ok, jobs): the versions of one SQS message that still need storing, compressed.
+	# ok is False when the message should be retried.
+	try:
+		versions = parse_jobs(record)
+	except Exception as e:
+		logger.error(f"Malformed SQS message: {e}")
+		return False, []
+	ok = True
+	jobs = []
+	for note_id, version, s3_key in versions:
+		job_ok, job = prepare_job(note_id, version, s3_key)
+		ok = ok and job_ok
+		if job is not None:
+			jobs.append(job)
+	return ok, jobs
+
+
+def prepare_job(note_id, version, s3_key):
+	# Steps 1-2 for one version. Returns (ok, job); job is None when there is nothing to store.
+	try:
+		state = version_state(note_id, version)
+	except ClientError as e:
+		logger.error(f"Failed to read compression status from DynamoDB: {e.response['Error']['Message']}")
+		return False, None
+	if state is not None and state.get('compression_status') == 'compressed':
+		# SQS delivers at least once; a redelivered message may refer to a version that is already done
+		logger.info(f"Skipping note_id={note_id}, version={version}: already compressed")
+		return True, None
+	if s3_key.startswith('uploads/') and (state is None or state.get('s3_key') != s3_key):
+		logger.warning(f"Ignoring upload {s3_key}: no version reserved for it")
+		return True, None
+
+	# 1. Fetch note from S3
+	try:
+		with instrumentation.stage('s3_get'):
+			s3_obj = s3.get_object(Bucket=S3_BUCKET, Key=s3_key)
+			streamed = 0 < STREAM_MIN_BYTES <= s3_obj['ContentLength']
+			if not streamed:
+				note_data = s3_obj['Body'].read()
+	except ClientError as e:
+		logger.error(f"Failed to fetch note from S3: {e.response['Error']['Message']}")
+		return False, None
+	if streamed:
+		return prepare_streamed_job(note_id, version, s3_key, s3_obj)
+
+	job = {'note_id': note_id, 'version': version, 's3_key': s3_key, 'note_data': note_data, 'digest': None}
+	if note_blobs.is_dedupable(len(note_data)):
+		# Content stored before is referenced instead of compressed again
+		job['digest'] = note_blobs.content_hash(note_data)
 		try:
-			logger.info(f"Writing compressed note to S3: bucket={S3_BUCKET}, key={compressed_key}")
-			s3.put_object(Bucket=S3_BUCKET, Key=compressed_key, Body=compressed)
-			logger.info(f"Successfully wrote compressed note to S3: {compressed_key}")
-			# Delete the uncompressed note after successful compression
-			logger.info(f"Deleting uncompressed note from S3: bucket={S3_BUCKET}, key={s3_key}")
-			s3.delete_object(Bucket=S3_BUCKET, Key=s3_key)
-			logger.info(f"Successfully deleted uncompressed note from S3: {s3_key}")
+			shared = note_blobs.claim(table, job['digest'])
 		except ClientError as e:
-			logger.error(f"Failed to write compressed note to S3 or delete uncompressed note: {e.response['Error']['Message']}")
-			continue
+			logger.warning(f"Failed to look up blob {job['digest']}: {e.response['Error']['Message']}")
+			shared = None
+		if shared is not None:
+			job.update(encoding=None, stored=None, compressed_key=shared.pop('compressed_key'), attributes=shared)
+			return True, job
+
+	# 2. Compress note and calculate compression ratio
+	try:
+		encoding, compressed, attributes = encode_note(note_id, version, note_data)
+	except Exception as e:
+		logger.error(f"Compression failed for note_id={note_id}, version={version}: {e}")
+		return False, None
+	if job['digest'] is not None:
+		attributes['content_hash'] = job['digest']
+	job.update(encoding=encoding, stored=compressed, attributes=attributes)
+	return True, job
 
-		# 4. Update DynamoDB metadata for the correct version, including compression ratio and uncompressed size
+
+def prepare_streamed_job(note_id, version, s3_key, s3_obj):
+	# Steps 1-3 for a version of at least STREAM_MIN_BYTES: it is read, compressed and written in
+	# one pass, then checked against stored content. A hit drops the new copy for the blob; new
+	# content becomes the blob itself.
+	try:
+		encoding, compressed_key, attributes, digest = stream_note(note_id, version, s3_key, s3_obj['Body'], s3_obj['ContentLength'])
+	except ClientError as e:
+		logger.error(f"Failed to stream note_id={note_id}, version={version} through S3: {e.response['Error']['Message']}")
+		return False, None
+	except Exception as e:
+		logger.error(f"Compression failed for note_id={note_id}, version={version}: {e}")
+		return False, None
+	job = {'note_id': note_id, 'version': version, 's3_key': s3_key, 'note_data': None, 'digest': digest,
+		   'encoding': encoding, 'stored': None, 'compressed_key': compressed_key, 'attributes': attributes, 'streamed': True}
+	if digest is None:
+		return True, job
+	attributes['content_hash'] = digest
+	try:
+		shared = note_blobs.claim(table, digest)
+	except ClientError as e:
+		logger.warning(f"Failed to look up blob {digest}: {e.response['Error']['Message']}")
+		shared = None
+	if shared is not None:
 		try:
-			logger.info(f"Updating DynamoDB metadata for note_id={note_id}, version={version} with compression ratio and uncompressed size")
-			update_expr = "SET compressed_key = :ck, compression_status = :s, compression_ratio = :cr, uncompressed_size = :us"
-			# Ensure uncompressed_size is always a valid integer
-			us_value = int(original_size) if original_size is not None else 0
-			expr_attr_vals = {
-				':ck': compressed_key,
-				':s': 'compressed',
-				':cr': compression_ratio,
-				':us': us_value
-			}
-			table.update_item(
+			with instrumentation.stage('s3_delete'):
+				s3.delete_object(Bucket=S3_BUCKET, Key=compressed_key)
+		except ClientError as e:
+			logger.warning(f"Failed to delete duplicate {compressed_key}: {e.response['Error']['Message']}")
+		job.update(encoding=None, compressed_key=shared.pop('compressed_key'), attributes=shared)
+		return True, job
+	try:
+		note_blobs.adopt(table, digest, compressed_key, attributes)
+	except ClientError as e:
+		logger.warning(f"Failed to register blob {digest}: {e.response['Error']['Message']}")
+	return True, job
+
+
+def is_deduplicated(job):
+	return job['encoding'] is None
+
+
+def is_stored(job):
+	# Already written by prepare_job: deduplicated and streamed versions
+	return 'compressed_key' in job
+
+
+def is_blob(job):
+	# New content that later copies can share (see note_blobs)
+	return job['digest'] is not None and note_blobs.is_shareable(job['attributes'])
+
+
+def is_packable(job):
+	return not is_stored(job) and not is_blob(job) and \
+		0 < len(job['stored']) <= note_packs.PACK_MAX_NOTE_BYTES and job['encoding'].codec != note_codec.CODEC_NONE
+
+
+def store_object(job):
+	# 3. Write compressed note back to S3 (new key). Notes stored raw keep their uploaded object.
+	if job['encoding'].codec == note_codec.CODEC_NONE:
+		job['compressed_key'] = job['s3_key']
+		return True
+	compressed_key = job['s3_key'].replace('.txt', '.zst')
+	try:
+		with instrumentation.stage('s3_put'):
+			s3.put_object(Bucket=S3_BUCKET, Key=compressed_key, Body=job['stored'])
+	except ClientError as e:
+		logger.error(f"Failed to write compressed note to S3: {e.response['Error']['Message']}")
+		return False
+	job['compressed_key'] = compressed_key
+	return True
+
+
+def store_blob(job):
+	# 3. Shareable content is written as a blob; if another writer holds the digest, as a copy
+	try:
+		compressed_key = note_blobs.store(s3, S3_BUCKET, table, job['digest'], job['stored'], job['attributes'])
+	except ClientError as e:
+		logger.error(f"Failed to write blob {job['digest']}: {e.response['Error']['Message']}")
+		return False
+	if compressed_key is None:
+		return store_object(job)
+	job['compressed_key'] = compressed_key
+	return True
+
+
+def store_pack(jobs):
+	# 3. Small versions of the batch share one pack object instead of one object each
+	pack_key = note_packs.new_pack_key()
+	data, spans = note_packs.build_pack([job['stored'] for job in jobs])
+	try:
+		with instrumentation.stage('s3_put'):
+			s3.put_object(Bucket=S3_BUCKET, Key=pack_key, Body=data)
+	except ClientError as e:
+		logger.error(f"Failed to write pack {pack_key} to S3: {e.response['Error']['Message']}")
+		return False
+	for job, (offset, length) in zip(jobs, spans):
+		job['compressed_key'] = pack_key
+		job['attributes'].update(pack_offset=offset, pack_length=length)
+	logger.info(f"Packed {len(jobs)} versions into {pack_key} ({len(data)} bytes)")
+	return True
+
+
+def finish_job(job):
+	note_id, version, s3_key, compressed_key = job['note_id'], job['version'], job['s3_key'], job['compressed_key']
+	# 4. Update DynamoDB metadata for the correct version, including compression ratio and uncompressed size
+	try:
+		update_expr = "SET compressed_key = :ck, #status = :st"
+		expr_attr_vals = {
+			':ck': compressed_key,
+			':st': 'uploaded'  # presigned uploads are 'awaiting_upload' until their content arrives
+		}
+		expr_attr_names = {'#status': 'status'}
+		for name, value in job['attributes'].items():
+			update_expr += f", #{name} = :{name}"
+			expr_attr_names[f"#{name}"] = name
+			expr_attr_vals[f":{name}"] = value
+		with instrumentation.stage('ddb_write'):
+			response = table.update_item(
 				Key={'note_id': note_id, 'version': version},
 				UpdateExpression=update_expr,
-				ExpressionAttributeValues=expr_attr_vals
+				ExpressionAttributeNames=expr_attr_names,
+				ExpressionAttributeValues=expr_attr_vals,
+				ReturnValues='UPDATED_OLD'
 			)
-			logger.info(f"Successfully updated DynamoDB for note_id={note_id}, version={version} with compression ratio {compression_ratio} and uncompressed size {original_size}")
-		except ClientError as e:
-			logger.error(f"Failed to update DynamoDB: {e.response['Error']['Message']}")
-			continue
+	except ClientError as e:
+		logger.error(f"Failed to update DynamoDB: {e.response['Error']['Message']}")
+		return False
+	# Rollups are updated once per batch; the old values only count if a redelivery stored the version first
+	job['rollups'] = metric_rollups.changes(note_id, job['attributes'], response.get('Attributes'))
 
-		logger.info(f"Note {note_id} (version {version}) compressed and updated successfully.")
-  
-		#Delete SQS message after successful processing
+	# 5. Delete the uncompressed note only once the metadata points at the compressed copy,
+	# so a retried message can always find its input
+	if compressed_key != s3_key:
 		try:
-			logger.info(f"Deleting SQS message: queue_url={SQS_QUEUE_URL}, note_id={note_id}, version={version}")
-			sqs.delete_message(
-				QueueUrl=SQS_QUEUE_URL,
-				ReceiptHandle=record['receiptHandle']
-			)
-			logger.info(f"Successfully enqueued SQS message for note_id={note_id}, version={version}")
+			with instrumentation.stage('s3_delete'):
+				s3.delete_object(Bucket=S3_BUCKET, Key=s3_key)
 		except ClientError as e:
-			logger.error(f"Failed to enqueue SQS message: {e.response['Error']['Message']}")
-			return {
-				'statusCode': 500,
-				'body': json.dumps({'error': f"Failed to enqueue SQS message: {e.response['Error']['Message']}"})
-			}
+			# The version is already compressed, so retrying the message would only skip it
+			logger.warning(f"Failed to delete uncompressed note {s3_key}: {e.response['Error']['Message']}")
+
+	remember_base(note_id, version, job['note_data'], job['attributes'])
+	if is_deduplicated(job):
+		logger.info(f"Deduplicated note_id={note_id}, version={version}: blob {job['digest']}")
+	else:
+		logger.info(f"Compressed note_id={note_id}, version={version}: {job['attributes']['uncompressed_size']} -> {job['attributes']['compressed_size']} bytes, encoding: {job['encoding'].metadata()}")
+	return True
+
+
+@instrumentation.instrumented('compress_notes')
+def lambda_handler(event, context=None):
+	# SQS event: event['Records'] is a list of SQS messages. Records are compressed concurrently,
+	# small versions are then written to one shared pack (PACK_MAX_NOTE_BYTES) and the others to
+	# their own objects. Failed records are reported back to Lambda, which keeps only those on
+	# the queue (requires ReportBatchItemFailures on the event source mapping).
+	records = event.get('Records', [])
+	if not records:
+		return {'batchItemFailures': []}
+
+	def safely(step, default):
+		def run(argument):
+			try:
+				return step(argument)
+			except Exception as e:
+				logger.error(f"Unexpected error in {step.__name__}: {e}")
+				return default
+		return instrumentation.bind(run)
+
+	with ThreadPoolExecutor(max_workers=min(MAX_WORKERS, len(records))) as executor:
+		prepared = list(executor.map(safely(prepare_record, (False, [])), records))
+		jobs = [job for _, record_jobs in prepared for job in record_jobs]
+		for job in jobs:
+			job['packed'] = is_packable(job)
+		packed = [job for job in jobs if job['packed']]
+		packed_ok = store_pack(packed) if packed else True
+
+		def store(job):
+			if is_stored(job):
+				stored = True
+			elif job['packed']:
+				stored = packed_ok
+			else:
+				stored = store_blob(job) if is_blob(job) else store_object(job)
+			return stored and finish_job(job)
+		stored = list(executor.map(safely(store, False), jobs))
+
+	rollups = {}
+	for job in jobs:
+		metric_rollups.merge(rollups, job.get('rollups', {}))
+	metric_rollups.apply(table, rollups)
+
+	results = iter(stored)
+	failures = []
+	for record, (ok, record_jobs) in zip(records, prepared):
+		# every job's result must be consumed, in order, even once the record has failed
+		jobs_ok = [next(results) for _ in record_jobs]
+		if not (ok and all(jobs_ok)):
+			failures.append({'itemIdentifier': record['messageId']})
 
+	instrumentation.annotate(records=len(records), packed=len(packed), deduplicated=sum(1 for job in jobs if is_deduplicated(job)),
+							 streamed=sum(1 for job in jobs if job.get('streamed')))
+	return {'batchItemFailures': failures}
@@ -1,19 +1,255 @@
 import os
 import json
-import boto3
+import base64
 from botocore.exceptions import ClientError
+from concurrent.futures import ThreadPoolExecutor
 import logging
+import aws_clients
+import instrumentation
+import metric_rollups
+import note_blobs
+from read_metrics import LatencyStats, stats_attribute
 
 # Environment variables (set in Lambda console or SAM/CloudFormation)
 DDB_TABLE = os.environ.get('NOTES_TABLE', 'your-notes-table')
+# Parallel segments used when the whole table has to be listed
+SCAN_SEGMENTS = int(os.environ.get('METRICS_SCAN_SEGMENTS', '4'))
+# Versions returned per page when listing a single note
+PAGE_SIZE = int(os.environ.get('METRICS_PAGE_SIZE', '100'))
+# Versions returned per page of the full-table listing (list=all)
+LIST_PAGE_SIZE = int(os.environ.get('METRICS_LIST_PAGE_SIZE', '1000'))
+# Largest page a client may ask for, to keep responses well below Lambda's 6 MB limit
+MAX_PAGE_SIZE = int(os.environ.get('METRICS_MAX_PAGE_SIZE', '1000'))
+# Most items read per Query call while listing a note
+QUERY_BATCH = 1000
 
-dynamodb = boto3.resource('dynamodb')
-table = dynamodb.Table(DDB_TABLE)
+table = aws_clients.table(DDB_TABLE)
+dynamodb = aws_clients.dynamodb
 
 # Set up logging for Lambda/CloudWatch
 logger = logging.getLogger()
-logger.setLevel(logging.INFO)
+logger.setLevel(instrumentation.LOG_LEVEL)
 
+# Only the attributes reported by this endpoint are read from DynamoDB
+LATENCY_METRICS = ['decompression_latency', 'read_latency', 'reconstruction_latency']
+METRIC_ATTRIBUTES = ['note_id', 'version', 'uncompressed_size', 'compression_ratio', 'codec', 'level', 'chain_depth',
+                     'compressed_size', 'content_hash', 'deduplicated', 'references', 'read_count', 'last_read',
+                     'storage_tier'] + LATENCY_METRICS + \
+    [stats_attribute(metric) for metric in LATENCY_METRICS]
+PROJECTION_NAMES = {f'#a{i}': name for i, name in enumerate(METRIC_ATTRIBUTES)}
+PROJECTION_EXPRESSION = ', '.join(PROJECTION_NAMES)
+
+
+def is_numeric_version(version):
+    # Decimal digits without leading zeros, so numeric order is (length, string) order
+    version = str(version)
+    return version.isascii() and version.isdigit() and (version == '0' or version[0] != '0')
+
+
+def version_sort_key(version):
+    # Versions are stored as strings; numbers come first in numeric order ("10" after "2"), then
+    # the other versions in string order
+    version = str(version)
+    return (0, len(version), version) if is_numeric_version(version) else (1, 0, version)
+
+
+def to_number(value):
+    return float(value) if value is not None else None
+
+
+def mean_latency(item, metric):
+    # Mean of the aggregated samples; versions read before the aggregates existed keep a plain mean
+    stats = item.get(stats_attribute(metric))
+    if stats:
+        return LatencyStats.from_item(stats).mean()
+    return to_number(item.get(metric))
+
+
+def to_metrics(item):
+    metrics = {
+        'note_id': item.get('note_id'),
+        'version': item.get('version'),
+        'uncompressed_size': to_number(item.get('uncompressed_size')),
+        'compression_ratio': to_number(item.get('compression_ratio')),
+        'codec': item.get('codec'),
+        'level': to_number(item.get('level')),
+        'decompression_latency': mean_latency(item, 'decompression_latency'),
+        'read_latency': mean_latency(item, 'read_latency'),
+        # Delta-compressed versions: earlier versions read to rebuild this one, and the time it took
+        'chain_depth': to_number(item.get('chain_depth')),
+        'reconstruction_latency': mean_latency(item, 'reconstruction_latency'),
+        # Stored as a reference to content another version stored first (see note_blobs)
+        'deduplicated': bool(item.get('deduplicated')),
+        # Access data recorded by retrieve_note, and the tier recompress_notes last moved the version to
+        'read_count': to_number(item.get('read_count')),
+        'last_read': to_number(item.get('last_read')),
+        'storage_tier': item.get('storage_tier')
+    }
+    # Distributions (count, mean, min, max, p50/p95/p99) aggregated by retrieve_note
+    for metric in LATENCY_METRICS:
+        stats = item.get(stats_attribute(metric))
+        metrics[stats_attribute(metric)] = LatencyStats.from_item(stats).summary() if stats else None
+    return metrics
+
+
+def dedupe_metrics(versions, blobs):
+    # Hit rate over the versions that were hashed, and the compressed bytes their references saved
+    hashed = [item for item in versions if item.get('content_hash') is not None]
+    hits = [item for item in hashed if item.get('deduplicated')]
+    return {
+        'hashed_versions': len(hashed),
+        'deduplicated_versions': len(hits),
+        'hit_rate': len(hits) / len(hashed) if hashed else None,
+        'blobs': len(blobs),
+        'blob_references': sum(int(blob.get('references') or 0) for blob in blobs),
+        'blob_bytes': sum(int(blob.get('compressed_size') or 0) for blob in blobs),
+        'bytes_saved': sum(int(item.get('compressed_size') or 0) for item in hits)
+    }
+
+
+def encode_token(state):
+    return base64.urlsafe_b64encode(json.dumps(state).encode('utf-8')).decode('ascii')
+
+
+def decode_token(token):
+    return json.loads(base64.urlsafe_b64decode(token.encode('ascii')))
+
+
+def query_versions(note_id, after, keep, wanted, stop=None):
+    # Versions of one note after `after` (None: from the first) in key (string) order whose
+    # version satisfies keep, up to wanted of them; reading ends at the first version that
+    # satisfies stop
+    items = []
+    values = {':note_id': note_id}
+    condition = '#a0 = :note_id'  # #a0 is note_id, #a1 version
+    if after is not None:
+        condition += ' AND #a1 > :after'
+        values[':after'] = after
+    kwargs = {
+        'KeyConditionExpression': condition,
+        'ProjectionExpression': PROJECTION_EXPRESSION,
+        'ExpressionAttributeNames': PROJECTION_NAMES,
+        'ExpressionAttributeValues': values
+    }
+    # Starts with what is still wanted and doubles: versions outside the range interleave with it
+    batch = wanted
+    while True:
+        kwargs['Limit'] = min(max(batch, wanted - len(items)), QUERY_BATCH)
+        batch *= 2
+        response = table.query(**kwargs)
+        for item in response.get('Items', []):
+            if stop is not None and stop(item['version']):
+                return items
+            if keep(item['version']):
+                items.append(item)
+                if len(items) == wanted:
+                    return items
+        if 'LastEvaluatedKey' not in response:
+            return items
+        kwargs['ExclusiveStartKey'] = response['LastEvaluatedKey']
+
+
+def numeric_versions(note_id, after, wanted):
+    # Numeric versions after `after` (None: from the first), in numeric order. Numbers of one
+    # length sort numerically as strings and lie between '1' + '0' * (length - 1) and
+    # '9' * length, so each length is one key range, read from `after` until wanted are found.
+    # Every longer number starts with a number of this length: a full read of the range that
+    # sees none shows there are no more lengths.
+    items = []
+    length = len(after) if after is not None else 1
+    while len(items) < wanted:
+        last = '9' * length
+        first = '1' + '0' * (length - 2) if length > 1 else None  # exclusive: just before the range
+        start = after if after is not None and len(after) == length else first
+        longer = False
+
+        def keep(version):
+            nonlocal longer
+            if not is_numeric_version(version):
+                return False
+            longer = longer or len(version) > length
+            return len(version) == length
+
+        items += query_versions(note_id, start, keep, wanted - len(items),
+                                stop=lambda version: version > last and not version.startswith(last))
+        if len(items) < wanted and not longer and start == first:
+            break
+        length += 1
+    return items
+
+
+def note_page(note_id, after, limit):
+    # One page of a note's versions in version_sort_key order, and the token of the next page
+    items = []
+    if after is None or is_numeric_version(after):
+        items = numeric_versions(note_id, after, limit)
+        after = None
+    if len(items) < limit:
+        items += query_versions(note_id, after, lambda version: not is_numeric_version(version), limit - len(items))
+    next_token = encode_token({'after': items[-1]['version']}) if len(items) == limit else None
+    return items, next_token
+
+
+def scan_page(segments, total, limit):
+    # One page of the full-table listing: the unfinished segments of a parallel scan (segment
+    # -> ExclusiveStartKey, None to start) each read their share of limit. Returns the items
+    # and the token of the next page.
+    share = max(1, limit // len(segments))
+
+    def read(segment):
+        kwargs = {
+            'Segment': segment,
+            'TotalSegments': total,
+            'ProjectionExpression': PROJECTION_EXPRESSION,
+            'ExpressionAttributeNames': PROJECTION_NAMES,
+            'Limit': share
+        }
+        if segments[segment] is not None:
+            kwargs['ExclusiveStartKey'] = segments[segment]
+        response = table.scan(**kwargs)
+        return segment, response.get('Items', []), response.get('LastEvaluatedKey')
+
+    items = []
+    remaining = {}
+    with ThreadPoolExecutor(max_workers=len(segments)) as executor:
+        for segment, found, last_key in executor.map(read, sorted(segments)):
+            items.extend(found)
+            if last_key is not None:
+                remaining[str(segment)] = last_key
+    next_token = encode_token({'segments': remaining, 'total': total}) if remaining else None
+    return items, next_token
+
+
+def rollup_response():
+    # GET /metrics: totals, averages, storage savings and latency percentiles from the rollups
+    scopes = [metric_rollups.GLOBAL_SCOPE] + metric_rollups.size_scopes()
+    try:
+        with instrumentation.stage('ddb_read'):
+            rollups = metric_rollups.read(dynamodb, DDB_TABLE, scopes)
+    except ClientError as e:
+        logger.error(f"Failed to read metric rollups from DynamoDB: {e.response['Error']['Message']}")
+        return {
+            'statusCode': 500,
+            'body': json.dumps({'error': f"Failed to fetch metrics: {e.response['Error']['Message']}"})
+        }
+    except RuntimeError as e:
+        logger.error(f"Failed to read metric rollups from DynamoDB: {e}")
+        return {
+            'statusCode': 503,
+            'body': json.dumps({'error': f"Failed to fetch metrics: {e}"})
+        }
+    with instrumentation.stage('serialize'):
+        body = json.dumps({
+            'summary': metric_rollups.summary(rollups[metric_rollups.GLOBAL_SCOPE]),
+            'size_buckets': {scope[len('size:'):]: metric_rollups.summary(rollups[scope]) for scope in scopes[1:]}
+        })
+    return {
+        'statusCode': 200,
+        'body': body
+    }
+
+
+@instrumentation.instrumented('get_metrics')
 def lambda_handler(event, context=None):
     # Only allow GET requests
     method = event.get('httpMethod', 'GET')
@@ -24,37 +260,66 @@ def lambda_handler(event, context=None):
             'body': json.dumps({'error': 'Method Not Allowed'})
         }
 
-    notes_metrics = []
+    params = event.get('queryStringParameters') or {}
+    note_id = params.get('note_id')
     try:
-        logger.info(f"Scanning DynamoDB table {DDB_TABLE} for metrics")
-        response = table.scan()
-        items = response.get('Items', [])
-        for item in items:
-            note_id = item.get('note_id')
-            version = item.get('version')
-            uncompressed_size = item.get('uncompressed_size')
-            compression_ratio = item.get('compression_ratio')
-            decompression_latency = item.get('decompression_latency')
-            read_latency = item.get('read_latency')
-            notes_metrics.append({
-                'note_id': note_id,
-                'version': version,
-                'uncompressed_size': float(uncompressed_size) if uncompressed_size is not None else None,
-                'compression_ratio': float(compression_ratio) if compression_ratio is not None else None,
-                'decompression_latency': float(decompression_latency) if decompression_latency is not None else None,
-                'read_latency': float(read_latency) if read_latency is not None else None
-            })
-        logger.info(f"Found {len(notes_metrics)} notes with metrics")
+        if params.get('list') not in (None, 'all'):
+            raise ValueError("list must be 'all'")
+        limit = int(params.get('limit', PAGE_SIZE if note_id else LIST_PAGE_SIZE))
+        if limit <= 0 or limit > MAX_PAGE_SIZE:
+            raise ValueError(f"limit must be between 1 and {MAX_PAGE_SIZE}")
+        token = decode_token(params['next_token']) if params.get('next_token') else None
+        if note_id:
+            after = str(token['after']) if token else None
+        else:
+            # segment -> where its scan continues; every segment starts unread
+            total = int(token['total']) if token else SCAN_SEGMENTS
+            segments = {int(segment): key for segment, key in token['segments'].items()} if token else dict.fromkeys(range(total))
+            if not segments or any(segment < 0 or segment >= total for segment in segments):
+                raise ValueError("invalid segments")
+    except Exception as e:
+        logger.error(f"Invalid pagination params: {e}")
+        return {
+            'statusCode': 400,
+            'body': json.dumps({'error': f'Invalid limit or next_token: {e}'})
+        }
+
+    if not note_id and params.get('list') is None:
+        return rollup_response()
+
+    dedupe = None
+    summary = None
+    try:
+        if note_id:
+            with instrumentation.stage('ddb_read'):
+                summary = metric_rollups.summary(table.get_item(Key=metric_rollups.rollup_key(f"note:{note_id}")).get('Item'))
+            # List versions of one note, in numeric version order, one page at a time
+            with instrumentation.stage('ddb_read'):
+                items, next_token = note_page(note_id, after, limit)
+        else:
+            with instrumentation.stage('ddb_read'):
+                versions, next_token = scan_page(segments, total, limit)
+            blobs = [item for item in versions if note_blobs.is_blob_item(item)]
+            versions = [item for item in versions if not note_blobs.is_blob_item(item) and not metric_rollups.is_rollup_item(item)]
+            dedupe = dedupe_metrics(versions, blobs)
+            items = sorted(versions, key=lambda item: (item.get('note_id'), version_sort_key(item.get('version'))))
+        notes_metrics = [to_metrics(item) for item in items]
+        instrumentation.annotate(versions=len(notes_metrics))
     except ClientError as e:
-        logger.error(f"Failed to scan DynamoDB: {e.response['Error']['Message']}")
+        logger.error(f"Failed to read metrics from DynamoDB: {e.response['Error']['Message']}")
         return {
             'statusCode': 500,
             'body': json.dumps({'error': f"Failed to fetch metrics: {e.response['Error']['Message']}"})
         }
 
+    body = {'notes_metrics': notes_metrics, 'next_token': next_token}
+    if note_id:
+        body['summary'] = summary
+    else:
+        body['dedupe'] = dedupe
+    with instrumentation.stage('serialize'):
+        body = json.dumps(body)
     return {
         'statusCode': 200,
-        'body': json.dumps({
-            'notes_metrics': notes_metrics
-        })
+        'body': body
     }
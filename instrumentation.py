@@ -0,0 +1,159 @@
+import os
+import sys
+import json
+import time
+import logging
+import threading
+import contextvars
+from functools import wraps
+
+# Per-invocation stage timings. Handlers wrap each step (DynamoDB read/write, S3 get/put,
+# compress, decompress, serialize, ...) in stage(); the totals are written as one compact
+# record when the invocation ends, instead of a log line per step.
+#
+# METRICS_FORMAT=emf writes the record in CloudWatch Embedded Metric Format, so every stage
+# becomes a metric (dimension: handler) without a PutMetricData call; 'log' writes the same
+# JSON through the logger and 'off' disables it.
+
+METRICS_FORMAT = os.environ.get('METRICS_FORMAT', 'emf')
+METRICS_NAMESPACE = os.environ.get('METRICS_NAMESPACE', 'Notes')
+# Level of the handlers' own log lines. They carry identifiers and sizes, never note content.
+LOG_LEVEL = os.environ.get('LOG_LEVEL', 'INFO').upper()
+
+logger = logging.getLogger()
+
+_current = contextvars.ContextVar('invocation', default=None)
+_cold_start = True
+
+
+class Invocation:
+    def __init__(self, handler):
+        self.handler = handler
+        self.start = time.perf_counter()
+        self.stages = {}  # stage -> [milliseconds, calls]
+        self.properties = {}
+        self._lock = threading.Lock()  # stages may run on a handler's worker threads
+
+    def add(self, stage, milliseconds):
+        with self._lock:
+            totals = self.stages.setdefault(stage, [0.0, 0])
+            totals[0] += milliseconds
+            totals[1] += 1
+
+    def record(self):
+        # The EMF document: metric values and properties are top-level keys
+        record = {
+            '_aws': {
+                'Timestamp': int(time.time() * 1000),
+                'CloudWatchMetrics': [{
+                    'Namespace': METRICS_NAMESPACE,
+                    'Dimensions': [['handler']],
+                    'Metrics': [{'Name': f"{stage}_ms", 'Unit': 'Milliseconds'} for stage in ['total', *self.stages]]
+                }]
+            },
+            'handler': self.handler,
+            'total_ms': round((time.perf_counter() - self.start) * 1000, 3)
+        }
+        for stage, (milliseconds, calls) in self.stages.items():
+            record[f"{stage}_ms"] = round(milliseconds, 3)
+            if calls > 1:
+                record[f"{stage}_calls"] = calls
+        record.update(self.properties)
+        return record
+
+
+class _Stage:
+    __slots__ = ('name', 'invocation', 'start')
+
+    def __init__(self, name, invocation):
+        self.name = name
+        self.invocation = invocation
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.invocation.add(self.name, (time.perf_counter() - self.start) * 1000)
+        return False
+
+
+class _NoStage:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+
+_NO_STAGE = _NoStage()
+
+
+def stage(name):
+    # with stage('s3_get'): ... - adds the block's duration to the current invocation, if any
+    invocation = _current.get()
+    if invocation is None:
+        return _NO_STAGE
+    return _Stage(name, invocation)
+
+
+def annotate(**properties):
+    # Identifiers and counters to include in the invocation record (never note content)
+    invocation = _current.get()
+    if invocation is not None:
+        invocation.properties.update(properties)
+
+
+def bind(function):
+    # For work handed to a thread pool: runs function with the caller's invocation current
+    invocation = _current.get()
+
+    @wraps(function)
+    def run(*args, **kwargs):
+        token = _current.set(invocation)
+        try:
+            return function(*args, **kwargs)
+        finally:
+            _current.reset(token)
+    return run
+
+
+def emit(record):
+    if METRICS_FORMAT == 'emf':
+        # Lambda forwards stdout to CloudWatch Logs, which extracts EMF metrics from JSON lines
+        sys.stdout.write(json.dumps(record, separators=(',', ':'), default=str) + '\n')
+        sys.stdout.flush()
+    elif METRICS_FORMAT == 'log':
+        logger.info(json.dumps(record, separators=(',', ':'), default=str))
+
+
+def instrumented(handler):
+    # Decorator for lambda_handler: times the invocation and emits its record
+    def decorate(function):
+        @wraps(function)
+        def run(event, context=None):
+            global _cold_start
+            if METRICS_FORMAT == 'off':
+                return function(event, context)
+            invocation = Invocation(handler)
+            invocation.properties['cold_start'] = _cold_start
+            _cold_start = False
+            if context is not None and getattr(context, 'aws_request_id', None):
+                invocation.properties['request_id'] = context.aws_request_id
+            token = _current.set(invocation)
+            response = None
+            try:
+                response = function(event, context)
+                return response
+            finally:
+                _current.reset(token)
+                if isinstance(response, dict):
+                    if 'statusCode' in response:
+                        invocation.properties['status_code'] = response['statusCode']
+                    if 'batchItemFailures' in response:
+                        invocation.properties['failed_records'] = len(response['batchItemFailures'])
+                else:
+                    invocation.properties['error'] = True
+                emit(invocation.record())
+        return run
+    return decorate
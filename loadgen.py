@@ -0,0 +1,240 @@
+import os
+import sys
+import json
+import time
+import random
+import asyncio
+import logging
+import argparse
+from benchmark import Corpus, size_sampler, percentile
+from notes_client import AsyncNotesClient, NotesAPIError, content_digest
+
+# Load generator for a deployed (or local_server.py) notes API, on the async client SDK. It
+# seeds --notes notes, waits until they are readable, then runs a mix of operations from
+# --concurrency workers for --duration seconds (or --requests operations) and reports achieved
+# requests per second and p50/p95/p99 latency per operation. Reads are verified against the
+# SHA-256 of what was written; only digests are kept, not note content. Without --rate the
+# workers send as fast as the service answers; with --rate the operations are scheduled at that
+# total rate and latency is measured from the scheduled start, so a saturated service shows up
+# as queueing delay instead of a lower send rate.
+#
+#   python loadgen.py --url http://127.0.0.1:8080 --concurrency 64 --duration 30
+#   python loadgen.py --url https://<api-id>.execute-api.<region>.amazonaws.com/<stage> \
+#       --mix read=8,write=1,bulk_read=0.5,metrics=0.1 --rate 200 --json load.json
+
+OPERATIONS = ['read', 'write', 'bulk_read', 'metrics']
+# Versions per bulk_read request
+BULK_READ_SIZE = 50
+
+logger = logging.getLogger()
+
+
+def parse_mix(spec):
+    # read=8,write=1,... -> {operation: weight}
+    mix = {}
+    for part in spec.split(','):
+        name, _, weight = part.partition('=')
+        if name.strip() not in OPERATIONS:
+            raise ValueError(f"Unknown operation: {name}")
+        mix[name.strip()] = float(weight or 1)
+    return mix
+
+
+class Operation:
+    # Latencies and outcomes of one operation type
+
+    def __init__(self, name):
+        self.name = name
+        self.latencies = []
+        self.bytes = 0
+        self.errors = 0
+        self.mismatches = 0
+        self.not_ready = 0
+
+    def summary(self, seconds):
+        ms = [latency * 1000 for latency in self.latencies]
+        return {
+            'ops': len(ms),
+            'errors': self.errors,
+            'mismatches': self.mismatches,
+            'not_ready': self.not_ready,
+            'rps': len(ms) / seconds if seconds else None,
+            'mb_per_s': self.bytes / (1024 * 1024) / seconds if seconds else None,
+            'p50_ms': percentile(ms, 0.50),
+            'p95_ms': percentile(ms, 0.95),
+            'p99_ms': percentile(ms, 0.99),
+            'max_ms': max(ms) if ms else None
+        }
+
+
+class LoadGenerator:
+    def __init__(self, client, args):
+        self.client = client
+        self.args = args
+        self.rng = random.Random(args.seed)
+        self.corpus = Corpus(args.seed)
+        self.next_size = size_sampler(args.sizes, self.rng)
+        self.prefix = f"load_{int(time.time())}"
+        self.digests = {}  # (note_id, version) -> (sha256, size) of what was written
+        self.latest = {}  # note_id -> last version written
+        self.readable = []  # versions known to be readable
+        self.operations = {name: Operation(name) for name in OPERATIONS}
+
+    async def write(self, note_id, version):
+        content = self.corpus.text(self.next_size())
+        await self.client.put_note(note_id, str(version), content, title=note_id, update=version > 1)
+        self.digests[(note_id, str(version))] = content_digest(content)
+        return len(content.encode('utf-8'))
+
+    async def seed(self):
+        note_ids = [f"{self.prefix}_{n}" for n in range(self.args.notes)]
+        await asyncio.gather(*(self.write(note_id, 1) for note_id in note_ids))
+        self.latest = {note_id: 1 for note_id in note_ids}
+        # Seeded versions are compressed asynchronously; wait for each before the load starts
+        results = await asyncio.gather(*(self.client.note_digest(note_id, '1', wait=True) for note_id in note_ids),
+                                       return_exceptions=True)
+        for note_id, result in zip(note_ids, results):
+            if isinstance(result, Exception):
+                logger.warning(f"Seeded note {note_id} not readable: {result}")
+            elif result != self.digests[(note_id, '1')]:
+                logger.warning(f"Seeded note {note_id} does not match what was written")
+            else:
+                self.readable.append((note_id, '1'))
+
+    async def run_operation(self, name):
+        # Returns bytes of note content moved; raises on failure
+        if name == 'write':
+            note_id = self.rng.choice(list(self.latest))
+            self.latest[note_id] += 1
+            version = self.latest[note_id]
+            size = await self.write(note_id, version)
+            self.readable.append((note_id, str(version)))
+            return size
+        if name == 'read':
+            key = self.rng.choice(self.readable)
+            digest = await self.client.note_digest(*key)
+            if digest != self.digests[key]:
+                self.operations[name].mismatches += 1
+            return digest[1]
+        if name == 'bulk_read':
+            keys = self.rng.sample(self.readable, min(BULK_READ_SIZE, len(self.readable)))
+            results = await self.client.get_notes(keys)
+            size = 0
+            for result in results:
+                if result.get('status') != 'ok':
+                    continue
+                digest = content_digest(result.get('content', ''))
+                if digest != self.digests.get((result['note_id'], result['version'])):
+                    self.operations[name].mismatches += 1
+                size += digest[1]
+            return size
+        await self.client.metrics()
+        return 0
+
+    async def worker(self, schedule, deadline):
+        names = list(self.args.mix)
+        weights = [self.args.mix[name] for name in names]
+        while True:
+            scheduled = schedule()
+            if scheduled is None:
+                return
+            if scheduled > time.perf_counter():
+                await asyncio.sleep(scheduled - time.perf_counter())
+            start = scheduled if self.args.rate else time.perf_counter()
+            if deadline is not None and start >= deadline:
+                return
+            name = self.rng.choices(names, weights)[0]
+            operation = self.operations[name]
+            try:
+                operation.bytes += await self.run_operation(name)
+            except NotesAPIError as e:
+                # A version written during the run may still be waiting for compression
+                if e.status == 404 and name == 'read':
+                    operation.not_ready += 1
+                else:
+                    logger.warning(f"{name} failed: {e}")
+                    operation.errors += 1
+            except Exception as e:
+                logger.warning(f"{name} failed: {e}")
+                operation.errors += 1
+            operation.latencies.append(time.perf_counter() - start)
+
+    async def run(self):
+        seed_start = time.perf_counter()
+        await self.seed()
+        seeded = time.perf_counter() - seed_start
+        if not self.readable:
+            raise RuntimeError("no seeded note is readable")
+        start = time.perf_counter()
+        deadline = start + self.args.duration if not self.args.requests else None
+        issued = 0
+
+        def schedule():
+            # Start time of the next operation, None once --requests have been issued
+            nonlocal issued
+            if self.args.requests and issued >= self.args.requests:
+                return None
+            issued += 1
+            return start + (issued - 1) / self.args.rate if self.args.rate else 0
+        await asyncio.gather(*(self.worker(schedule, deadline) for _ in range(self.args.concurrency)))
+        seconds = time.perf_counter() - start
+        operations = {name: operation.summary(seconds) for name, operation in self.operations.items() if operation.latencies}
+        latencies = [latency * 1000 for operation in self.operations.values() for latency in operation.latencies]
+        return {
+            'config': {key: value for key, value in vars(self.args).items() if key != 'json'},
+            'seed_seconds': seeded,
+            'seconds': seconds,
+            'total': {
+                'ops': len(latencies),
+                'errors': sum(operation.errors for operation in self.operations.values()),
+                'mismatches': sum(operation.mismatches for operation in self.operations.values()),
+                'rps': len(latencies) / seconds if seconds else None,
+                'p50_ms': percentile(latencies, 0.50),
+                'p95_ms': percentile(latencies, 0.95),
+                'p99_ms': percentile(latencies, 0.99),
+                'max_ms': max(latencies) if latencies else None
+            },
+            'operations': operations
+        }
+
+
+async def generate(args):
+    async with AsyncNotesClient(args.url, concurrency=args.concurrency, attempts=args.attempts) as client:
+        return await LoadGenerator(client, args).run()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Generate load against the notes API and report RPS and latency percentiles")
+    parser.add_argument('--url', default=os.environ.get('NOTES_API_URL'), help="base URL of the API (or NOTES_API_URL)")
+    parser.add_argument('--concurrency', type=int, default=32, help="requests in flight (and pooled connections)")
+    parser.add_argument('--duration', type=float, default=30, help="seconds of load")
+    parser.add_argument('--requests', type=int, default=0, help="stop after this many operations instead of --duration")
+    parser.add_argument('--rate', type=float, default=0, help="operations per second to schedule (0: as fast as possible)")
+    parser.add_argument('--mix', type=parse_mix, default='read=8,write=1,metrics=0.1',
+                        help=f"weights of {', '.join(OPERATIONS)}")
+    parser.add_argument('--notes', type=int, default=100, help="notes seeded before the load starts")
+    parser.add_argument('--sizes', default='lognormal:4096:1.5', help="lognormal:MEDIAN:SIGMA, uniform:MIN:MAX, fixed:SIZE or mix:SIZE,...")
+    parser.add_argument('--attempts', type=int, default=5, help="attempts per request, with exponential backoff and jitter")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--json', help="also write the results to this file")
+    args = parser.parse_args(argv)
+    if not args.url:
+        parser.error("--url (or NOTES_API_URL) is required")
+    logging.basicConfig(level=logging.WARNING, format='%(levelname)s %(message)s')
+
+    report = asyncio.run(generate(args))
+    total = report['total']
+    print(f"{total['ops']} operations in {report['seconds']:.1f}s ({total['rps']:.1f} req/s) at concurrency "
+          f"{args.concurrency}, {total['errors']} errors, {total['mismatches']} mismatches")
+    print(f"{'operation':<10} {'ops':>7} {'err':>5} {'req/s':>9} {'MB/s':>8} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'max ms':>8}")
+    for name, s in list(report['operations'].items()) + [('total', dict(total, mb_per_s=None))]:
+        print(f"{name:<10} {s['ops']:>7} {s['errors']:>5} {s['rps'] or 0:>9.1f} {s['mb_per_s'] or 0:>8.2f} "
+              f"{s['p50_ms'] or 0:>8.2f} {s['p95_ms'] or 0:>8.2f} {s['p99_ms'] or 0:>8.2f} {s['max_ms'] or 0:>8.2f}")
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as f:
+            json.dump(report, f, indent=2)
+    return 1 if total['errors'] or total['mismatches'] else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
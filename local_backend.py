@@ -0,0 +1,867 @@
+import os
+import re
+import json
+import mmap
+import time
+import uuid
+import zlib
+import pickle
+import sqlite3
+import hashlib
+import pathlib
+import logging
+import threading
+from decimal import Decimal
+from urllib.parse import quote, urlencode
+from botocore.exceptions import ClientError
+from boto3.dynamodb.types import TypeSerializer, TypeDeserializer, Binary
+
+# Local stand-ins for the S3, DynamoDB and SQS calls the handlers make, selected with
+# STORAGE_BACKEND=local (see aws_clients.py). Objects are files under LOCAL_STORAGE_DIR and
+# large ones are served through mmap without copying; object metadata and DynamoDB items
+# live in one SQLite database; queues are in-process. Responses and errors follow the
+# shapes of the boto3 calls they replace, so the handlers run unchanged.
+
+LOCAL_STORAGE_DIR = os.environ.get('LOCAL_STORAGE_DIR', 'local_storage')
+# Objects at least this large are returned as a memoryview over an mmap of the file;
+# smaller ones are read into bytes (each live mapping holds a file descriptor)
+MMAP_MIN_BYTES = int(os.environ.get('LOCAL_MMAP_MIN_BYTES', str(64 * 1024)))
+# Receives before a local queue message is dropped as undeliverable (SQS maxReceiveCount)
+MAX_RECEIVES = int(os.environ.get('LOCAL_QUEUE_MAX_RECEIVES', '5'))
+# Base URL of a server exposing the objects (local_server.py sets it); presigned URLs point there.
+# Without it, presigned GETs are file:// URLs and presigned PUTs are unsupported.
+PRESIGN_BASE_URL = os.environ.get('LOCAL_PRESIGN_BASE_URL')
+# Key schema of the notes table
+KEY_SCHEMA = ('note_id', 'version')
+
+logger = logging.getLogger()
+
+
+def _error(code, message, operation):
+    return ClientError({'Error': {'Code': code, 'Message': message}}, operation)
+
+
+class Store:
+    # Root directory plus the SQLite database shared by the local S3 and DynamoDB
+
+    def __init__(self, root):
+        self.root = root
+        os.makedirs(root, exist_ok=True)
+        self.db = sqlite3.connect(os.path.join(root, 'metadata.sqlite3'), check_same_thread=False, isolation_level=None)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('CREATE TABLE IF NOT EXISTS objects (bucket TEXT, key TEXT, size INTEGER, etag TEXT, '
+                        'attributes TEXT, PRIMARY KEY (bucket, key))')
+        self.db.execute('CREATE TABLE IF NOT EXISTS items (tbl TEXT, pk TEXT, sk TEXT, item BLOB, PRIMARY KEY (tbl, pk, sk))')
+        self.lock = threading.RLock()
+
+    def execute(self, sql, parameters=()):
+        # One connection is shared by all threads, so statements and their results are serialized
+        with self.lock:
+            return self.db.execute(sql, parameters).fetchall()
+
+
+class Body:
+    # StreamingBody look-alike over bytes or a memoryview
+
+    def __init__(self, data):
+        self._data = data
+        self._position = 0
+
+    def read(self, amt=None):
+        end = len(self._data) if amt is None else min(len(self._data), self._position + amt)
+        chunk = self._data[self._position:end]
+        self._position = end
+        return chunk
+
+    def iter_chunks(self, chunk_size=1024 * 1024):
+        while True:
+            chunk = self.read(chunk_size)
+            if not chunk:
+                return
+            yield chunk
+
+    def close(self):
+        pass
+
+
+class LocalS3:
+    # Objects in LOCAL_STORAGE_DIR/s3/<bucket>/<key>; writes are atomic renames
+
+    OBJECT_ATTRIBUTES = ('ContentType', 'ContentEncoding', 'Metadata', 'CacheControl')
+
+    def __init__(self, store):
+        self.store = store
+        # Multipart uploads in progress: upload id -> (bucket, key, attributes, {part number: path})
+        self._uploads = {}
+
+    def _path(self, bucket, key):
+        if not key or any(part in ('', '.', '..') for part in key.split('/')):
+            raise _error('InvalidKey', f"Unsupported key for local storage: {key}", 'PutObject')
+        return os.path.join(self.store.root, 's3', quote(bucket, safe=''), quote(key, safe='/'))
+
+    def put_object(self, Bucket, Key, Body=b'', **kwargs):
+        data = Body.read() if hasattr(Body, 'read') else Body
+        if isinstance(data, str):
+            data = data.encode('utf-8')
+        path = self._path(Bucket, Key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        temporary = f"{path}.{uuid.uuid4().hex}.tmp"
+        with open(temporary, 'wb') as f:
+            f.write(data)
+        etag = f'"{hashlib.md5(data).hexdigest()}"'
+        attributes = json.dumps({name: kwargs[name] for name in self.OBJECT_ATTRIBUTES if name in kwargs})
+        with self.store.lock:
+            os.replace(temporary, path)
+            self.store.execute('INSERT OR REPLACE INTO objects VALUES (?, ?, ?, ?, ?)',
+                                  (Bucket, Key, len(data), etag, attributes))
+        return {'ETag': etag}
+
+    def create_multipart_upload(self, Bucket, Key, **kwargs):
+        self._path(Bucket, Key)
+        upload_id = uuid.uuid4().hex
+        attributes = {name: kwargs[name] for name in self.OBJECT_ATTRIBUTES if name in kwargs}
+        with self.store.lock:
+            self._uploads[upload_id] = (Bucket, Key, attributes, {})
+        return {'Bucket': Bucket, 'Key': Key, 'UploadId': upload_id}
+
+    def _upload(self, upload_id, operation):
+        upload = self._uploads.get(upload_id)
+        if upload is None:
+            raise _error('NoSuchUpload', 'The specified upload does not exist.', operation)
+        return upload
+
+    def upload_part(self, Bucket, Key, UploadId, PartNumber, Body=b'', **kwargs):
+        data = Body.read() if hasattr(Body, 'read') else Body
+        parts = self._upload(UploadId, 'UploadPart')[3]
+        # Parts wait next to the object's final path, so completing is a rename on the same filesystem
+        path = f"{self._path(Bucket, Key)}.{UploadId}.{PartNumber}.part"
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'wb') as f:
+            f.write(data)
+        with self.store.lock:
+            parts[PartNumber] = path
+        return {'ETag': f'"{hashlib.md5(data).hexdigest()}"'}
+
+    def complete_multipart_upload(self, Bucket, Key, UploadId, MultipartUpload, **kwargs):
+        with self.store.lock:
+            bucket, key, attributes, parts = self._upload(UploadId, 'CompleteMultipartUpload')
+        numbers = [part['PartNumber'] for part in MultipartUpload['Parts']]
+        if any(number not in parts for number in numbers):
+            raise _error('InvalidPart', 'One or more of the specified parts could not be found.', 'CompleteMultipartUpload')
+        path = self._path(Bucket, Key)
+        temporary = f"{path}.{uuid.uuid4().hex}.tmp"
+        digests = []
+        size = 0
+        with open(temporary, 'wb') as f:
+            for number in numbers:
+                with open(parts[number], 'rb') as part:
+                    data = part.read()
+                f.write(data)
+                digests.append(hashlib.md5(data).digest())
+                size += len(data)
+        etag = f'"{hashlib.md5(b"".join(digests)).hexdigest()}-{len(numbers)}"'
+        with self.store.lock:
+            os.replace(temporary, path)
+            self.store.execute('INSERT OR REPLACE INTO objects VALUES (?, ?, ?, ?, ?)',
+                               (Bucket, Key, size, etag, json.dumps(attributes)))
+        self.abort_multipart_upload(Bucket, Key, UploadId)
+        return {'Bucket': Bucket, 'Key': Key, 'ETag': etag}
+
+    def abort_multipart_upload(self, Bucket, Key, UploadId, **kwargs):
+        with self.store.lock:
+            parts = self._upload(UploadId, 'AbortMultipartUpload')[3]
+            del self._uploads[UploadId]
+        for path in parts.values():
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+        return {}
+
+    def _head(self, bucket, key, operation):
+        rows = self.store.execute('SELECT size, etag, attributes FROM objects WHERE bucket = ? AND key = ?',
+                                  (bucket, key))
+        if not rows:
+            raise _error('NoSuchKey' if operation == 'GetObject' else '404', 'The specified key does not exist.', operation)
+        size, etag, attributes = rows[0]
+        response = {'ContentLength': size, 'ETag': etag}
+        response.update(json.loads(attributes))
+        response.setdefault('Metadata', {})
+        return response
+
+    def head_object(self, Bucket, Key, **kwargs):
+        return self._head(Bucket, Key, 'HeadObject')
+
+    def get_object(self, Bucket, Key, Range=None, **kwargs):
+        response = self._head(Bucket, Key, 'GetObject')
+        size = response['ContentLength']
+        start, end = 0, size - 1
+        if Range:
+            match = re.fullmatch(r'bytes=(\d*)-(\d*)', Range)
+            if match is None:
+                raise _error('InvalidArgument', f"Invalid Range: {Range}", 'GetObject')
+            if match.group(1):
+                start = int(match.group(1))
+                end = min(int(match.group(2)), size - 1) if match.group(2) else size - 1
+            else:
+                start = max(0, size - int(match.group(2)))
+            if start >= size:
+                raise _error('InvalidRange', 'The requested range is not satisfiable', 'GetObject')
+            response['ContentRange'] = f"bytes {start}-{end}/{size}"
+        length = max(0, end - start + 1)
+        with open(self._path(Bucket, Key), 'rb') as f:
+            if length >= MMAP_MIN_BYTES:
+                mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                data = memoryview(mapped)[start:end + 1]
+            else:
+                f.seek(start)
+                data = f.read(length)
+        response['ContentLength'] = length
+        response['Body'] = Body(data)
+        return response
+
+    def delete_object(self, Bucket, Key, **kwargs):
+        with self.store.lock:
+            self.store.execute('DELETE FROM objects WHERE bucket = ? AND key = ?', (Bucket, Key))
+            try:
+                os.remove(self._path(Bucket, Key))
+            except FileNotFoundError:
+                pass
+        return {}
+
+    def list_objects_v2(self, Bucket, Prefix='', MaxKeys=1000, ContinuationToken=None, StartAfter=None, **kwargs):
+        after = ContinuationToken or StartAfter or ''
+        rows = self.store.execute(
+            'SELECT key, size, etag FROM objects WHERE bucket = ? AND key > ? AND substr(key, 1, ?) = ? ORDER BY key LIMIT ?',
+            (Bucket, after, len(Prefix), Prefix, MaxKeys + 1))
+        response = {'KeyCount': min(len(rows), MaxKeys), 'IsTruncated': len(rows) > MaxKeys,
+                    'Contents': [{'Key': key, 'Size': size, 'ETag': etag} for key, size, etag in rows[:MaxKeys]]}
+        if response['IsTruncated']:
+            response['NextContinuationToken'] = rows[MaxKeys - 1][0]
+        return response
+
+    def create_bucket(self, Bucket, **kwargs):
+        return {}
+
+    def generate_presigned_url(self, ClientMethod, Params=None, ExpiresIn=3600, **kwargs):
+        # Local objects need no signature: a URL on PRESIGN_BASE_URL, or a file:// URL readable
+        # by clients on the same host
+        params = Params or {}
+        if PRESIGN_BASE_URL:
+            url = f"{PRESIGN_BASE_URL.rstrip('/')}/{quote(params['Bucket'], safe='')}/{quote(params['Key'], safe='/')}"
+            overrides = {'response-content-type': params.get('ResponseContentType'),
+                         'response-content-encoding': params.get('ResponseContentEncoding')}
+            query = urlencode({name: value for name, value in overrides.items() if value})
+            return f"{url}?{query}" if query else url
+        if ClientMethod != 'get_object':
+            raise ValueError(f"{ClientMethod} URLs need LOCAL_PRESIGN_BASE_URL")
+        self._head(params['Bucket'], params['Key'], 'HeadObject')
+        return pathlib.Path(self._path(params['Bucket'], params['Key'])).resolve().as_uri()
+
+
+# DynamoDB expressions: the subset of the grammar used by condition, key condition, filter,
+# projection and update expressions (paths, comparisons, AND/OR/NOT, BETWEEN, IN, functions,
+# SET with + and -, if_not_exists, list_append, REMOVE, ADD and DELETE).
+
+_TOKEN = re.compile(r'\s*(?:(<>|<=|>=|[=<>(),.\[\]+-])|([#:]?[A-Za-z_]\w*)|(\d+))')
+_MISSING = object()
+
+
+def _tokenize(expression):
+    tokens = []
+    position = 0
+    expression = expression.strip()
+    while position < len(expression):
+        match = _TOKEN.match(expression, position)
+        if match is None:
+            raise ValueError(f"Invalid expression near: {expression[position:]}")
+        tokens.append(match.group(1) or match.group(2) or match.group(3))
+        position = match.end()
+    return tokens
+
+
+class _Parser:
+    def __init__(self, expression, names, values):
+        self.tokens = _tokenize(expression)
+        self.position = 0
+        self.names = names or {}
+        self.values = values or {}
+
+    def peek(self, offset=0):
+        index = self.position + offset
+        return self.tokens[index] if index < len(self.tokens) else None
+
+    def keyword(self, *words):
+        token = self.peek()
+        return token is not None and token.upper() in words
+
+    def take(self, expected=None):
+        token = self.peek()
+        if token is None or (expected is not None and token.upper() != expected):
+            raise ValueError(f"Expected {expected or 'a token'}, got {token}")
+        self.position += 1
+        return token
+
+    def done(self):
+        return self.position >= len(self.tokens)
+
+    # Operands evaluate lazily: each is a function of the item
+
+    def path(self):
+        parts = []
+        while True:
+            token = self.take()
+            parts.append(self.names[token] if token.startswith('#') else token)
+            while self.peek() == '[':
+                self.take('[')
+                parts.append(int(self.take()))
+                self.take(']')
+            if self.peek() != '.':
+                return parts
+            self.take('.')
+
+    def operand(self):
+        token = self.peek()
+        if token.startswith(':'):
+            self.take()
+            value = self.values[token]
+            return lambda item: value
+        lowered = token.lower()
+        if self.peek(1) == '(' and lowered in ('size', 'if_not_exists', 'list_append'):
+            self.take()
+            self.take('(')
+            if lowered == 'size':
+                path = self.path()
+                self.take(')')
+                return lambda item: _size(_get(item, path))
+            first = self.path() if lowered == 'if_not_exists' else None
+            first_operand = self.operand() if first is None else None
+            self.take(',')
+            second = self.operand()
+            self.take(')')
+            if lowered == 'if_not_exists':
+                return lambda item: (lambda value: second(item) if value is _MISSING else value)(_get(item, first))
+            return lambda item: list(first_operand(item)) + list(second(item))
+        path = self.path()
+        return lambda item: _get(item, path)
+
+    def condition(self):
+        left = self.conjunction()
+        while self.keyword('OR'):
+            self.take()
+            right = self.conjunction()
+            left = (lambda a, b: lambda item: a(item) or b(item))(left, right)
+        return left
+
+    def conjunction(self):
+        left = self.negation()
+        while self.keyword('AND'):
+            self.take()
+            right = self.negation()
+            left = (lambda a, b: lambda item: a(item) and b(item))(left, right)
+        return left
+
+    def negation(self):
+        if self.keyword('NOT'):
+            self.take()
+            inner = self.negation()
+            return lambda item: not inner(item)
+        if self.peek() == '(':
+            self.take('(')
+            inner = self.condition()
+            self.take(')')
+            return inner
+        function = (self.peek() or '').lower()
+        if self.peek(1) == '(' and function in ('attribute_exists', 'attribute_not_exists', 'begins_with', 'contains', 'attribute_type'):
+            self.take()
+            self.take('(')
+            path = self.path()
+            argument = None
+            if self.peek() == ',':
+                self.take(',')
+                argument = self.operand()
+            self.take(')')
+            if function == 'attribute_exists':
+                return lambda item: _get(item, path) is not _MISSING
+            if function == 'attribute_not_exists':
+                return lambda item: _get(item, path) is _MISSING
+            if function == 'begins_with':
+                return lambda item: _begins_with(_get(item, path), argument(item))
+            if function == 'contains':
+                return lambda item: _contains(_get(item, path), argument(item))
+            return lambda item: _type(_get(item, path)) == argument(item)
+        left = self.operand()
+        if self.keyword('BETWEEN'):
+            self.take()
+            low = self.operand()
+            self.take('AND')
+            high = self.operand()
+            return lambda item: _compare(left(item), '>=', low(item)) and _compare(left(item), '<=', high(item))
+        if self.keyword('IN'):
+            self.take()
+            self.take('(')
+            options = [self.operand()]
+            while self.peek() == ',':
+                self.take(',')
+                options.append(self.operand())
+            self.take(')')
+            return lambda item: any(_compare(left(item), '=', option(item)) for option in options)
+        operator = self.take()
+        right = self.operand()
+        return lambda item: _compare(left(item), operator, right(item))
+
+    def value_expression(self):
+        left = self.operand()
+        if self.peek() in ('+', '-'):
+            operator = self.take()
+            right = self.operand()
+            if operator == '+':
+                return lambda item: left(item) + right(item)
+            return lambda item: left(item) - right(item)
+        return left
+
+
+def _get(item, path):
+    value = item
+    for part in path:
+        if isinstance(part, int):
+            if not isinstance(value, list) or part >= len(value):
+                return _MISSING
+        elif not isinstance(value, dict) or part not in value:
+            return _MISSING
+        value = value[part]
+    return value
+
+
+def _set(item, path, value):
+    target = item
+    for part in path[:-1]:
+        target = target[part]
+    if isinstance(path[-1], int) and path[-1] >= len(target):
+        target.append(value)
+    else:
+        target[path[-1]] = value
+
+
+def _remove(item, path):
+    target = _get(item, path[:-1]) if len(path) > 1 else item
+    if isinstance(target, dict):
+        target.pop(path[-1], None)
+    elif isinstance(target, list) and isinstance(path[-1], int) and path[-1] < len(target):
+        del target[path[-1]]
+
+
+def _comparable(value):
+    return value.value if isinstance(value, Binary) else value
+
+
+def _compare(left, operator, right):
+    if left is _MISSING or right is _MISSING:
+        return operator == '<>' and not (left is _MISSING and right is _MISSING)
+    left, right = _comparable(left), _comparable(right)
+    if operator == '=':
+        return left == right
+    if operator == '<>':
+        return left != right
+    try:
+        return {'<': left < right, '<=': left <= right, '>': left > right, '>=': left >= right}[operator]
+    except TypeError:
+        return False
+
+
+def _size(value):
+    if value is _MISSING:
+        return _MISSING
+    if isinstance(value, str):
+        return Decimal(len(value.encode('utf-8')))
+    return Decimal(len(_comparable(value)))
+
+
+def _begins_with(value, prefix):
+    value, prefix = _comparable(value), _comparable(prefix)
+    return isinstance(value, (str, bytes)) and type(value) is type(prefix) and value.startswith(prefix)
+
+
+def _contains(value, member):
+    if value is _MISSING:
+        return False
+    value, member = _comparable(value), _comparable(member)
+    if isinstance(value, str):
+        return isinstance(member, str) and member in value
+    return member in value
+
+
+def _type(value):
+    return next(iter(TypeSerializer().serialize(value))) if value is not _MISSING else None
+
+
+def _normalize(value):
+    # The types DynamoDB hands back: numbers as Decimal, bytes as Binary; floats are rejected
+    return TypeDeserializer().deserialize(TypeSerializer().serialize(value))
+
+
+def _expression(expression, names, values, is_key_condition=False):
+    # boto3.dynamodb.conditions objects, as the resource layer accepts them, become strings
+    if expression is None or isinstance(expression, str):
+        return expression, names or {}, values or {}
+    from boto3.dynamodb.conditions import ConditionExpressionBuilder
+    built = ConditionExpressionBuilder().build_expression(expression, is_key_condition=is_key_condition)
+    return (built.condition_expression, dict(names or {}, **built.attribute_name_placeholders),
+            dict(values or {}, **built.attribute_value_placeholders))
+
+
+def _condition(expression, names, values, is_key_condition=False):
+    expression, names, values = _expression(expression, names, values, is_key_condition)
+    if expression is None:
+        return lambda item: True
+    parser = _Parser(expression, names, {key: _normalize(value) for key, value in values.items()})
+    condition = parser.condition()
+    if not parser.done():
+        raise ValueError(f"Unexpected token in condition: {parser.peek()}")
+    return condition
+
+
+def _projection(expression, names):
+    if not expression:
+        return None
+    attributes = set()
+    for part in expression.split(','):
+        name = part.strip().split('.')[0].split('[')[0]
+        attributes.add((names or {}).get(name, name))
+    return attributes
+
+
+def _project(item, attributes):
+    if attributes is None:
+        return item
+    return {name: value for name, value in item.items() if name in attributes}
+
+
+def _apply_update(item, expression, names, values):
+    # Returns the names of the top-level attributes the update touched
+    parser = _Parser(expression, names, {key: _normalize(value) for key, value in (values or {}).items()})
+    actions = []
+    while not parser.done():
+        clause = parser.take().upper()
+        while True:
+            path = parser.path()
+            if clause == 'SET':
+                parser.take('=')
+                actions.append(('SET', path, parser.value_expression()))
+            elif clause in ('ADD', 'DELETE'):
+                actions.append((clause, path, parser.operand()))
+            elif clause == 'REMOVE':
+                actions.append(('REMOVE', path, None))
+            else:
+                raise ValueError(f"Unsupported update clause: {clause}")
+            if parser.peek() != ',':
+                break
+            parser.take(',')
+    # All operands see the item as it was before the update
+    original = pickle.loads(pickle.dumps(item))
+    for clause, path, operand in actions:
+        # As in DynamoDB, a nested path is only written into a map or list that exists
+        if clause in ('SET', 'ADD') and len(path) > 1 and not isinstance(_get(original, path[:-1]), (dict, list)):
+            raise _error('ValidationException', 'The document path provided in the update expression is invalid for update',
+                         'UpdateItem')
+    touched = set()
+    for clause, path, operand in actions:
+        touched.add(path[0])
+        if clause == 'SET':
+            _set(item, path, operand(original))
+        elif clause == 'REMOVE':
+            _remove(item, path)
+        else:
+            current = _get(item, path)
+            value = operand(original)
+            if clause == 'ADD':
+                if current is _MISSING:
+                    _set(item, path, value)
+                elif isinstance(value, Decimal):
+                    _set(item, path, current + value)
+                else:
+                    _set(item, path, current | value)
+            elif current is not _MISSING:
+                remaining = current - value
+                if remaining:
+                    _set(item, path, remaining)
+                else:
+                    _remove(item, path)
+    return touched
+
+
+class LocalDynamoDB:
+    # Items pickled in SQLite, keyed by table and KEY_SCHEMA; the document-client call style
+    # (Python values in and out) that aws_clients.Table and the handlers use
+
+    def __init__(self, store):
+        self.store = store
+
+    def _load(self, table, key):
+        rows = self.store.execute('SELECT item FROM items WHERE tbl = ? AND pk = ? AND sk = ?',
+                                  (table, key[KEY_SCHEMA[0]], key[KEY_SCHEMA[1]]))
+        return pickle.loads(rows[0][0]) if rows else None
+
+    def _save(self, table, item):
+        for name in KEY_SCHEMA:
+            if not isinstance(item.get(name), str):
+                raise _error('ValidationException', f"Missing or non-string key attribute {name}", 'PutItem')
+        self.store.execute('INSERT OR REPLACE INTO items VALUES (?, ?, ?, ?)',
+                              (table, item[KEY_SCHEMA[0]], item[KEY_SCHEMA[1]], pickle.dumps(item)))
+
+    def _check(self, item, condition, names, values, operation):
+        if condition is not None and not _condition(condition, names, values)(item or {}):
+            raise _error('ConditionalCheckFailedException', 'The conditional request failed', operation)
+
+    def get_item(self, TableName, Key, ProjectionExpression=None, ExpressionAttributeNames=None, **kwargs):
+        item = self._load(TableName, Key)
+        if item is None:
+            return {}
+        return {'Item': _project(item, _projection(ProjectionExpression, ExpressionAttributeNames))}
+
+    def put_item(self, TableName, Item, ConditionExpression=None, ExpressionAttributeNames=None,
+                 ExpressionAttributeValues=None, ReturnValues='NONE', **kwargs):
+        item = _normalize(dict(Item))
+        with self.store.lock:
+            old = self._load(TableName, item)
+            self._check(old, ConditionExpression, ExpressionAttributeNames, ExpressionAttributeValues, 'PutItem')
+            self._save(TableName, item)
+        return {'Attributes': old} if ReturnValues == 'ALL_OLD' and old else {}
+
+    def update_item(self, TableName, Key, UpdateExpression=None, ConditionExpression=None, ExpressionAttributeNames=None,
+                    ExpressionAttributeValues=None, ReturnValues='NONE', **kwargs):
+        with self.store.lock:
+            old = self._load(TableName, Key)
+            self._check(old, ConditionExpression, ExpressionAttributeNames, ExpressionAttributeValues, 'UpdateItem')
+            item = pickle.loads(pickle.dumps(old)) if old else dict(_normalize(Key))
+            touched = _apply_update(item, UpdateExpression, ExpressionAttributeNames, ExpressionAttributeValues) \
+                if UpdateExpression else set()
+            self._save(TableName, _normalize(item))
+        if ReturnValues == 'ALL_NEW':
+            return {'Attributes': item}
+        if ReturnValues == 'ALL_OLD':
+            return {'Attributes': old} if old else {}
+        if ReturnValues == 'UPDATED_NEW':
+            return {'Attributes': {name: item[name] for name in touched if name in item}}
+        if ReturnValues == 'UPDATED_OLD':
+            return {'Attributes': {name: old[name] for name in touched if old and name in old}}
+        return {}
+
+    def delete_item(self, TableName, Key, ConditionExpression=None, ExpressionAttributeNames=None,
+                    ExpressionAttributeValues=None, ReturnValues='NONE', **kwargs):
+        with self.store.lock:
+            old = self._load(TableName, Key)
+            self._check(old, ConditionExpression, ExpressionAttributeNames, ExpressionAttributeValues, 'DeleteItem')
+            self.store.execute('DELETE FROM items WHERE tbl = ? AND pk = ? AND sk = ?',
+                                  (TableName, Key[KEY_SCHEMA[0]], Key[KEY_SCHEMA[1]]))
+        return {'Attributes': old} if ReturnValues == 'ALL_OLD' and old else {}
+
+    def _page(self, rows, condition, filter_condition, projection, limit, select):
+        # rows: (pk, sk, pickled item) in key order, already past ExclusiveStartKey
+        items = []
+        evaluated = 0
+        last = None
+        for pk, sk, data in rows:
+            item = pickle.loads(data)
+            if not condition(item):
+                continue
+            evaluated += 1
+            last = item
+            if filter_condition(item):
+                items.append(_project(item, projection))
+            if limit is not None and evaluated >= limit:
+                break
+        response = {'Count': len(items), 'ScannedCount': evaluated}
+        if select != 'COUNT':
+            response['Items'] = items
+        if limit is not None and evaluated >= limit and last is not None:
+            response['LastEvaluatedKey'] = {name: last[name] for name in KEY_SCHEMA}
+        return response
+
+    def query(self, TableName, KeyConditionExpression, ExpressionAttributeNames=None, ExpressionAttributeValues=None,
+              FilterExpression=None, ProjectionExpression=None, ExclusiveStartKey=None, Limit=None,
+              ScanIndexForward=True, Select=None, **kwargs):
+        expression, names, values = _expression(KeyConditionExpression, ExpressionAttributeNames,
+                                                ExpressionAttributeValues, True)
+        condition = _condition(expression, names, values)
+        # The partition key equality selects the rows; the full condition still filters them
+        partition = None
+        for name, placeholder in re.findall(r'(#?[A-Za-z_]\w*)\s*=\s*(:[A-Za-z_]\w*)', expression):
+            if names.get(name, name) == KEY_SCHEMA[0]:
+                partition = values[placeholder]
+        if partition is None:
+            raise _error('ValidationException', f"Query condition missed key schema element: {KEY_SCHEMA[0]}", 'Query')
+        order = 'ASC' if ScanIndexForward else 'DESC'
+        sql = 'SELECT pk, sk, item FROM items WHERE tbl = ? AND pk = ?'
+        parameters = [TableName, partition]
+        if ExclusiveStartKey:
+            sql += ' AND sk > ?' if ScanIndexForward else ' AND sk < ?'
+            parameters.append(ExclusiveStartKey[KEY_SCHEMA[1]])
+        rows = self.store.execute(sql + f' ORDER BY sk {order}', parameters)
+        return self._page(rows, condition,
+                          _condition(FilterExpression, names, values),
+                          _projection(ProjectionExpression, names), Limit, Select)
+
+    def scan(self, TableName, FilterExpression=None, ProjectionExpression=None, ExpressionAttributeNames=None,
+             ExpressionAttributeValues=None, ExclusiveStartKey=None, Limit=None, Segment=None, TotalSegments=None,
+             Select=None, **kwargs):
+        sql = 'SELECT pk, sk, item FROM items WHERE tbl = ?'
+        parameters = [TableName]
+        if ExclusiveStartKey:
+            sql += ' AND (pk > ? OR (pk = ? AND sk > ?))'
+            start = ExclusiveStartKey
+            parameters += [start[KEY_SCHEMA[0]], start[KEY_SCHEMA[0]], start[KEY_SCHEMA[1]]]
+        rows = self.store.execute(sql + ' ORDER BY pk, sk', parameters)
+        if TotalSegments:
+            rows = (row for row in rows if zlib.crc32(row[0].encode('utf-8')) % TotalSegments == Segment)
+        return self._page(rows, lambda item: True,
+                          _condition(FilterExpression, ExpressionAttributeNames, ExpressionAttributeValues),
+                          _projection(ProjectionExpression, ExpressionAttributeNames), Limit, Select)
+
+    def batch_get_item(self, RequestItems, **kwargs):
+        responses = {}
+        for table, request in RequestItems.items():
+            projection = _projection(request.get('ProjectionExpression'), request.get('ExpressionAttributeNames'))
+            items = (self._load(table, key) for key in request['Keys'])
+            responses[table] = [_project(item, projection) for item in items if item is not None]
+        return {'Responses': responses, 'UnprocessedKeys': {}}
+
+    def batch_write_item(self, RequestItems, **kwargs):
+        for table, requests in RequestItems.items():
+            for request in requests:
+                if 'PutRequest' in request:
+                    self.put_item(TableName=table, Item=request['PutRequest']['Item'])
+                else:
+                    self.delete_item(TableName=table, Key=request['DeleteRequest']['Key'])
+        return {'UnprocessedItems': {}}
+
+
+class LocalQueues:
+    # In-process SQS queues keyed by queue URL, with visibility timeouts and receive counts
+
+    def __init__(self):
+        self._queues = {}  # url -> {message_id: message}
+        self._condition = threading.Condition()
+        self.dead_letters = []
+
+    def _queue(self, url):
+        return self._queues.setdefault(url, {})
+
+    def send_message(self, QueueUrl, MessageBody, **kwargs):
+        message_id = str(uuid.uuid4())
+        with self._condition:
+            self._queue(QueueUrl)[message_id] = {'MessageId': message_id, 'Body': MessageBody,
+                                                 'visible_at': time.monotonic() + kwargs.get('DelaySeconds', 0),
+                                                 'receives': 0}
+            self._condition.notify_all()
+        return {'MessageId': message_id, 'MD5OfMessageBody': hashlib.md5(MessageBody.encode('utf-8')).hexdigest()}
+
+    def send_message_batch(self, QueueUrl, Entries, **kwargs):
+        successful = []
+        for entry in Entries:
+            response = self.send_message(QueueUrl, entry['MessageBody'], DelaySeconds=entry.get('DelaySeconds', 0))
+            successful.append({'Id': entry['Id'], 'MessageId': response['MessageId']})
+        return {'Successful': successful, 'Failed': []}
+
+    def receive_message(self, QueueUrl, MaxNumberOfMessages=1, VisibilityTimeout=30, WaitTimeSeconds=0, **kwargs):
+        deadline = time.monotonic() + WaitTimeSeconds
+        with self._condition:
+            while True:
+                now = time.monotonic()
+                messages = []
+                for message in list(self._queue(QueueUrl).values()):
+                    if len(messages) >= MaxNumberOfMessages:
+                        break
+                    if message['visible_at'] > now:
+                        continue
+                    message['receives'] += 1
+                    if message['receives'] > MAX_RECEIVES:
+                        del self._queue(QueueUrl)[message['MessageId']]
+                        self.dead_letters.append(message)
+                        logger.error(f"Dropping message {message['MessageId']} after {MAX_RECEIVES} receives")
+                        continue
+                    message['visible_at'] = now + VisibilityTimeout
+                    message['receipt'] = uuid.uuid4().hex
+                    messages.append({'MessageId': message['MessageId'], 'ReceiptHandle': f"{message['MessageId']}:{message['receipt']}",
+                                     'Body': message['Body'], 'Attributes': {'ApproximateReceiveCount': str(message['receives'])}})
+                if messages or now >= deadline:
+                    return {'Messages': messages} if messages else {}
+                self._condition.wait(min(deadline - now, 0.1))
+
+    def delete_message(self, QueueUrl, ReceiptHandle, **kwargs):
+        message_id, receipt = ReceiptHandle.split(':', 1)
+        with self._condition:
+            message = self._queue(QueueUrl).get(message_id)
+            if message is not None and message.get('receipt') == receipt:
+                del self._queue(QueueUrl)[message_id]
+        return {}
+
+    def change_message_visibility(self, QueueUrl, ReceiptHandle, VisibilityTimeout, **kwargs):
+        message_id, _ = ReceiptHandle.split(':', 1)
+        with self._condition:
+            message = self._queue(QueueUrl).get(message_id)
+            if message is not None:
+                message['visible_at'] = time.monotonic() + VisibilityTimeout
+                self._condition.notify_all()
+        return {}
+
+    def create_queue(self, QueueName, **kwargs):
+        url = f"local://queue/{QueueName}"
+        self._queue(url)
+        return {'QueueUrl': url}
+
+    def get_queue_url(self, QueueName, **kwargs):
+        return self.create_queue(QueueName)
+
+    def deliver(self, queue_url, handler, batch_size=10, wait_seconds=0, retry_seconds=1):
+        # One poll of an SQS event source mapping: hand a batch to an SQS-triggered handler,
+        # delete what it processed and make reported failures visible again after retry_seconds.
+        # Returns the number of messages delivered.
+        messages = self.receive_message(queue_url, MaxNumberOfMessages=batch_size, WaitTimeSeconds=wait_seconds).get('Messages', [])
+        if not messages:
+            return 0
+        records = [{'messageId': message['MessageId'], 'receiptHandle': message['ReceiptHandle'], 'body': message['Body'],
+                    'eventSource': 'aws:sqs', 'attributes': message['Attributes']} for message in messages]
+        try:
+            failures = {failure['itemIdentifier'] for failure in (handler({'Records': records}) or {}).get('batchItemFailures', [])}
+        except Exception as e:
+            logger.error(f"Queue consumer failed on a batch of {len(records)}: {e}")
+            failures = {record['messageId'] for record in records}
+        for message in messages:
+            if message['MessageId'] in failures:
+                self.change_message_visibility(queue_url, message['ReceiptHandle'], retry_seconds)
+            else:
+                self.delete_message(queue_url, message['ReceiptHandle'])
+        return len(messages)
+
+    def start_consumer(self, queue_url, handler, batch_size=10):
+        # Background thread delivering batches to handler for as long as the process runs
+        def run():
+            while True:
+                self.deliver(queue_url, handler, batch_size, wait_seconds=1)
+        thread = threading.Thread(target=run, daemon=True, name=f"consumer {queue_url}")
+        thread.start()
+        return thread
+
+
+_store = None
+_store_lock = threading.Lock()
+
+
+def store():
+    global _store
+    with _store_lock:
+        if _store is None:
+            _store = Store(LOCAL_STORAGE_DIR)
+        return _store
+
+
+def client(name):
+    # Local counterpart of aws_clients.client(name)
+    if name == 's3':
+        return LocalS3(store())
+    if name == 'dynamodb_document':
+        return LocalDynamoDB(store())
+    if name == 'sqs':
+        return LocalQueues()
+    raise ValueError(f"No local backend for {name}")
@@ -0,0 +1,136 @@
+import os
+import sys
+import json
+import base64
+import argparse
+import logging
+from urllib.parse import urlsplit, parse_qsl, unquote, quote_plus
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+# Self-hosted deployment on the local storage backend: serves the API Gateway routes with the
+# unchanged Lambda handlers and runs compress_notes as an in-process queue consumer. Presigned
+# URLs point at /s3/<bucket>/<key>, and PUTs under uploads/ are announced on the queue the way
+# the S3 bucket notification does.
+#
+#   python local_server.py --port 8080 --storage-dir ./local_storage
+
+logger = logging.getLogger()
+
+ROUTES = {
+    '/notes': 'upload_notes',
+    '/notes/bulk': 'bulk_upload_notes',
+    '/retrieve': 'retrieve_note',
+    '/retrieve/bulk': 'bulk_retrieve_notes',
+    '/metrics': 'get_metrics',
+}
+
+
+def object_created_event(bucket, key, size):
+    # Body of the SQS message an S3 object-created notification sends
+    return json.dumps({'Records': [{
+        'eventSource': 'aws:s3',
+        'eventName': 'ObjectCreated:Put',
+        's3': {'bucket': {'name': bucket}, 'object': {'key': quote_plus(key, safe='/'), 'size': size}}
+    }]})
+
+
+def make_handler(handlers, queue_url):
+    import aws_clients
+
+    class RequestHandler(BaseHTTPRequestHandler):
+        def objects(self, url):
+            bucket, _, key = unquote(url.path[len('/s3/'):]).partition('/')
+            params = dict(parse_qsl(url.query))
+            try:
+                if self.command == 'PUT':
+                    data = self.rfile.read(int(self.headers.get('Content-Length') or 0))
+                    aws_clients.s3.put_object(Bucket=bucket, Key=key, Body=data)
+                    if key.startswith('uploads/'):
+                        aws_clients.sqs.send_message(QueueUrl=queue_url, MessageBody=object_created_event(bucket, key, len(data)))
+                    self.respond({'statusCode': 200, 'body': ''})
+                    return
+                obj = aws_clients.s3.get_object(Bucket=bucket, Key=key)
+            except Exception as e:
+                self.respond({'statusCode': 404, 'body': json.dumps({'error': str(e)})})
+                return
+            headers = {'Content-Type': params.get('response-content-type', 'application/octet-stream')}
+            if params.get('response-content-encoding'):
+                headers['Content-Encoding'] = params['response-content-encoding']
+            self.respond({'statusCode': 200, 'headers': headers, 'body': bytes(obj['Body'].read())})
+
+        def dispatch(self):
+            url = urlsplit(self.path)
+            if url.path.startswith('/s3/') and self.command in ('GET', 'PUT'):
+                self.objects(url)
+                return
+            module = handlers.get(url.path.rstrip('/') or '/')
+            if module is None:
+                self.respond({'statusCode': 404, 'body': json.dumps({'error': 'Not Found'})})
+                return
+            length = int(self.headers.get('Content-Length') or 0)
+            event = {
+                'httpMethod': self.command,
+                'path': url.path,
+                'headers': dict(self.headers),
+                'queryStringParameters': dict(parse_qsl(url.query)) or None,
+                'body': self.rfile.read(length).decode('utf-8') if length else None
+            }
+            try:
+                response = module.lambda_handler(event, None)
+            except Exception as e:
+                logger.exception(f"Handler {module.__name__} failed")
+                response = {'statusCode': 502, 'body': json.dumps({'error': f'Handler failed: {e}'})}
+            self.respond(response)
+
+        def respond(self, response):
+            body = response.get('body') or ''
+            if response.get('isBase64Encoded'):
+                body = base64.b64decode(body)
+            body = body.encode('utf-8') if isinstance(body, str) else body
+            self.send_response(response.get('statusCode', 200))
+            headers = response.get('headers') or {}
+            headers.setdefault('Content-Type', 'application/json')
+            for name, value in headers.items():
+                self.send_header(name, value)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        do_GET = do_POST = do_PUT = do_DELETE = dispatch
+
+        def log_message(self, format, *args):
+            logger.info(f"{self.address_string()} {format % args}")
+
+    return RequestHandler
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Serve the note API on the local storage backend")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--storage-dir', default=os.environ.get('LOCAL_STORAGE_DIR', 'local_storage'))
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO)
+
+    # Handlers read their configuration at import time
+    os.environ.update({'STORAGE_BACKEND': 'local', 'LOCAL_STORAGE_DIR': args.storage_dir})
+    os.environ.setdefault('NOTES_BUCKET', 'notes')
+    os.environ.setdefault('NOTES_TABLE', 'notes')
+    os.environ.setdefault('NOTES_QUEUE_URL', 'local://queue/notes')
+    os.environ.setdefault('LOCAL_PRESIGN_BASE_URL', f"http://{args.host}:{args.port}/s3")
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    import aws_clients
+    import compress_notes
+    handlers = {path: __import__(name) for path, name in ROUTES.items()}
+
+    aws_clients.sqs.start_consumer(os.environ['NOTES_QUEUE_URL'], compress_notes.lambda_handler)
+    server = ThreadingHTTPServer((args.host, args.port), make_handler(handlers, os.environ['NOTES_QUEUE_URL']))
+    logger.info(f"Serving on http://{args.host}:{args.port} with storage in {args.storage_dir}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
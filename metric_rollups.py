@@ -0,0 +1,276 @@
+import os
+import time
+import random
+import logging
+import threading
+from collections import Counter
+from botocore.exceptions import ClientError
+import instrumentation
+import post_invocation
+from read_metrics import LatencySketch, to_decimal
+
+# Rollups of the per-version metrics, kept current with atomic ADD updates as versions are
+# stored and read, so get_metrics reports totals, averages, storage savings and latency
+# percentiles with a few item reads instead of listing the table.
+#
+# A rollup is an item in the notes table with note_id '#rollup:<scope>' and version '0': one
+# global, one per note ('note:<note_id>') and one per bucket of uncompressed size
+# ('size:<bucket>'). Every writer updates the global and size rollups, so each of them is
+# spread over METRIC_ROLLUP_SHARDS items ('#rollup:global#<n>'), written at random and summed by
+# read(); one item would cap all writers at a single partition's throughput. It holds only counters: version, byte and ratio totals, reads, and per
+# latency metric a count, a sum and the buckets of a LatencySketch, one attribute per bucket, so
+# updates from any number of writers merge by addition. min and max cannot be kept that way and
+# are only reported per version.
+#
+# Writers report how a version's contribution changed (changes(note_id, new, old)), so an
+# overwritten or recompressed version moves the totals instead of adding to them. Writes that
+# cannot see the old item (bulk uploads over existing versions), concurrent redeliveries and
+# failed rollup updates leave drift, which rebuild_rollups.py corrects from a scan. Upload
+# handlers queue their changes in a RollupBuffer, added after the response (post_invocation);
+# changes still buffered when a container shuts down are drift as well.
+
+# 'off' stops handlers from updating rollups (get_metrics then reports what was recorded so far)
+METRIC_ROLLUPS = os.environ.get('METRIC_ROLLUPS', 'on') != 'off'
+ROLLUP_ID_PREFIX = '#rollup:'
+ROLLUP_VERSION = '0'
+GLOBAL_SCOPE = 'global'
+# Upper bound of each size bucket (uncompressed bytes) and its name
+SIZE_BUCKETS = [(4 * 1024, '4KiB'), (64 * 1024, '64KiB'), (1024 * 1024, '1MiB'), (16 * 1024 * 1024, '16MiB'),
+                (None, 'larger')]
+LATENCY_METRICS = ['decompression_latency', 'read_latency', 'reconstruction_latency']
+# Items each of the global and size rollups is spread over
+METRIC_ROLLUP_SHARDS = int(os.environ.get('METRIC_ROLLUP_SHARDS', '16'))
+# Seconds a RollupBuffer collects changes before adding them
+METRIC_ROLLUPS_FLUSH_INTERVAL = float(os.environ.get('METRIC_ROLLUPS_FLUSH_INTERVAL', '10'))
+# DynamoDB BatchGetItem limit
+BATCH_GET_SIZE = 100
+BATCH_GET_ATTEMPTS = 5
+# Counters added per update_item, to keep update expressions well below DynamoDB's 4 KB limit
+ADD_BATCH = 50
+
+logger = logging.getLogger()
+
+
+def rollup_key(scope):
+    return {'note_id': f"{ROLLUP_ID_PREFIX}{scope}", 'version': ROLLUP_VERSION}
+
+
+def is_rollup_item(item):
+    return str(item.get('note_id', '')).startswith(ROLLUP_ID_PREFIX)
+
+
+def is_sharded(scope):
+    return scope == GLOBAL_SCOPE or scope.startswith('size:')
+
+
+def rollup_keys(scope):
+    # Keys of the items holding a scope's counters; sharded scopes also keep the item written
+    # before they were sharded
+    keys = [rollup_key(scope)]
+    if is_sharded(scope):
+        keys += [rollup_key(f"{scope}#{shard}") for shard in range(METRIC_ROLLUP_SHARDS)]
+    return keys
+
+
+def item_scope(item):
+    # Scope of a rollup item, without its shard
+    scope = item['note_id'][len(ROLLUP_ID_PREFIX):]
+    base, _, shard = scope.rpartition('#')
+    if base and is_sharded(base) and shard.isdigit():
+        return base
+    return scope
+
+
+def size_bucket(size):
+    for upper_bound, name in SIZE_BUCKETS:
+        if upper_bound is None or size <= upper_bound:
+            return name
+
+
+def scopes(note_id, size):
+    return [GLOBAL_SCOPE, f"note:{note_id}", f"size:{size_bucket(size)}"]
+
+
+def size_scopes():
+    return [f"size:{name}" for _, name in SIZE_BUCKETS]
+
+
+def contribution(item):
+    # Counters a stored version adds to its rollups; versions still waiting for compression add none
+    if not item or item.get('compression_status') != 'compressed':
+        return Counter()
+    uncompressed = int(item.get('uncompressed_size') or 0)
+    ratio = item.get('compression_ratio')
+    if item.get('compressed_size') is not None:
+        compressed = int(item['compressed_size'])
+    elif item.get('inline_data') is not None:
+        compressed = len(item['inline_data'])
+    else:
+        compressed = round(float(ratio or 0) * uncompressed)
+    deduplicated = bool(item.get('deduplicated'))
+    counters = Counter({
+        'versions': 1,
+        'uncompressed_bytes': uncompressed,
+        'compressed_bytes': compressed,
+        # References to a blob store nothing of their own
+        'stored_bytes': 0 if deduplicated else compressed,
+        # Versions looked up by content hash, and those that found a stored blob
+        'hashed_versions': int(item.get('content_hash') is not None),
+        'deduplicated_versions': int(deduplicated)
+    })
+    if ratio is not None:
+        counters.update(ratio_sum=to_decimal(float(ratio)), ratio_count=1)
+    return counters
+
+
+def changes(note_id, new=None, old=None):
+    # {scope: counters to add} for a version whose stored form went from old to new (items or
+    # attribute dicts, None for a version that did not exist or is not stored)
+    result = {}
+    for item, sign in ((new, 1), (old, -1)):
+        counters = contribution(item)
+        if not counters:
+            continue
+        for scope in scopes(note_id, counters['uncompressed_bytes']):
+            target = result.setdefault(scope, Counter())
+            for name, value in counters.items():
+                target[name] += sign * value
+    return {scope: counters for scope, counters in result.items() if any(counters.values())}
+
+
+def read_changes(note_id, size, reads, stats):
+    # {scope: counters to add} for buffered reads of one version; stats maps metric -> LatencyStats
+    counters = Counter({'reads': reads})
+    for metric, buffered in stats.items():
+        counters[f"{metric}_count"] += buffered.count
+        counters[f"{metric}_sum"] += to_decimal(buffered.total)
+        for index, count in buffered.sketch.buckets.items():
+            counters[f"{metric}_b{index}"] += count
+    return {scope: Counter(counters) for scope in scopes(note_id, size)}
+
+
+def merge(into, other):
+    for scope, counters in other.items():
+        into.setdefault(scope, Counter()).update(counters)
+    return into
+
+
+def add(table, scope, counters):
+    # ADDs counters (name -> number) to the rollup item of scope, or to one of its shards
+    key = rollup_key(f"{scope}#{random.randrange(METRIC_ROLLUP_SHARDS)}" if is_sharded(scope) else scope)
+    names = [name for name, value in counters.items() if value]
+    for start in range(0, len(names), ADD_BATCH):
+        batch = names[start:start + ADD_BATCH]
+        with instrumentation.stage('ddb_write'):
+            table.update_item(
+                Key=key,
+                UpdateExpression='ADD ' + ', '.join(f"#c{i} :c{i}" for i in range(len(batch))),
+                ExpressionAttributeNames={f"#c{i}": name for i, name in enumerate(batch)},
+                ExpressionAttributeValues={f":c{i}": counters[name] for i, name in enumerate(batch)})
+
+
+def apply(table, pending):
+    # Adds pending ({scope: counters}) to the rollups. Failures are logged and left to
+    # rebuild_rollups.py: rollups never fail the write they describe.
+    if not METRIC_ROLLUPS:
+        return True
+    ok = True
+    for scope, counters in pending.items():
+        try:
+            add(table, scope, counters)
+        except ClientError as e:
+            logger.warning(f"Failed to update rollup {scope}: {e.response['Error']['Message']}")
+            ok = False
+    return ok
+
+
+def record(table, note_id, new=None, old=None):
+    return apply(table, changes(note_id, new, old))
+
+
+class RollupBuffer:
+    # Changes queued by handlers on a request's path and added after the response, merged, once
+    # METRIC_ROLLUPS_FLUSH_INTERVAL has passed
+
+    def __init__(self, table):
+        self.table = table
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._last_flush = time.monotonic()
+        post_invocation.register(self.flush_if_due)
+
+    def add(self, changes):
+        if not METRIC_ROLLUPS:
+            return
+        with self._lock:
+            merge(self._pending, changes)
+
+    def flush_if_due(self):
+        with self._lock:
+            if not self._pending or time.monotonic() - self._last_flush < METRIC_ROLLUPS_FLUSH_INTERVAL:
+                return
+        self.flush()
+
+    def flush(self):
+        with self._lock:
+            pending, self._pending = self._pending, {}
+            self._last_flush = time.monotonic()
+        apply(self.table, pending)
+
+
+def read(dynamodb, table_name, scopes):
+    # {scope: counters} summed over the items of each scope (empty if nothing was recorded).
+    # Raises RuntimeError if DynamoDB keeps throttling the reads.
+    current = {scope: Counter() for scope in scopes}
+    keys = [key for scope in scopes for key in rollup_keys(scope)]
+    for start in range(0, len(keys), BATCH_GET_SIZE):
+        request = {table_name: {'Keys': keys[start:start + BATCH_GET_SIZE]}}
+        for attempt in range(BATCH_GET_ATTEMPTS):
+            response = dynamodb.batch_get_item(RequestItems=request)
+            for item in response.get('Responses', {}).get(table_name, []):
+                current.setdefault(item_scope(item), Counter()).update(counters_of(item))
+            request = response.get('UnprocessedKeys')
+            if not request:
+                break
+            time.sleep(0.05 * 2 ** attempt)
+        if request:
+            raise RuntimeError("rollup reads throttled")
+    return current
+
+
+def counters_of(item):
+    # The counters held by a rollup item
+    return Counter({name: value for name, value in (item or {}).items() if name not in ('note_id', 'version')})
+
+
+def summary(item):
+    # Totals, averages, storage savings and latency percentiles of one rollup item (or None: nothing recorded)
+    counters = counters_of(item)
+    uncompressed = int(counters['uncompressed_bytes'])
+    result = {
+        'versions': int(counters['versions']),
+        'uncompressed_bytes': uncompressed,
+        'compressed_bytes': int(counters['compressed_bytes']),
+        'stored_bytes': int(counters['stored_bytes']),
+        'hashed_versions': int(counters['hashed_versions']),
+        'deduplicated_versions': int(counters['deduplicated_versions']),
+        'dedupe_hit_rate': int(counters['deduplicated_versions']) / int(counters['hashed_versions']) if counters['hashed_versions'] else None,
+        # Mean of the per-version ratios, and the ratio of the totals
+        'compression_ratio': float(counters['ratio_sum']) / int(counters['ratio_count']) if counters['ratio_count'] else None,
+        'overall_compression_ratio': int(counters['compressed_bytes']) / uncompressed if uncompressed else None,
+        'storage_savings': 1 - int(counters['stored_bytes']) / uncompressed if uncompressed else None,
+        'reads': int(counters['reads'])
+    }
+    for metric in LATENCY_METRICS:
+        count = int(counters[f"{metric}_count"])
+        prefix = f"{metric}_b"
+        sketch = LatencySketch({int(name[len(prefix):]): int(value) for name, value in counters.items()
+                                if name.startswith(prefix) and value})
+        result[metric] = {
+            'count': count,
+            'mean': float(counters[f"{metric}_sum"]) / count if count else None,
+            'p50': sketch.quantile(0.50),
+            'p95': sketch.quantile(0.95),
+            'p99': sketch.quantile(0.99)
+        }
+    return result
@@ -0,0 +1,143 @@
+import os
+import time
+import uuid
+import hashlib
+from botocore.exceptions import ClientError
+import instrumentation
+import note_codec
+
+# Content-addressed storage of note versions. A version whose content was stored before points
+# at the shared compressed blob instead of storing, queueing and compressing its own copy.
+#
+# A blob is an immutable object blobs/<sha256>.zst plus an item in the notes table with
+# note_id '#blob:<sha256>' and version '0', holding the blob's storage attributes (codec, level,
+# dictionary_id, frames, sizes). A version that reuses a blob copies those attributes and
+# compressed_key onto its own item, so reads never look the blob item up. Only self-contained
+# encodings (no delta base) become blobs. Streamed versions are hashed while they are written,
+# so theirs are adopted under blobs/streamed/<id>.zst. collect_blobs.py deletes blobs no version
+# refers to.
+
+# Versions of at least this many bytes are hashed and deduplicated (0 disables). Inline notes are
+# never deduplicated: their copy is already on the item.
+DEDUPE_MIN_BYTES = int(os.environ.get('DEDUPE_MIN_BYTES', '0'))
+BLOB_PREFIX = 'blobs/'
+BLOB_ID_PREFIX = '#blob:'
+BLOB_VERSION = '0'
+
+# Attributes of the blob item that describe the blob itself, not its stored form
+BOOKKEEPING = ('note_id', 'version', 'references', 'last_claimed')
+
+
+def is_dedupable(size):
+    return DEDUPE_MIN_BYTES > 0 and size >= DEDUPE_MIN_BYTES
+
+
+def content_hash(note_data):
+    return hashlib.sha256(note_data).hexdigest()
+
+
+def blob_key(digest):
+    return f"{BLOB_PREFIX}{digest}.zst"
+
+
+def streamed_blob_key():
+    # Key of content written before its digest is known (see adopt)
+    return f"{BLOB_PREFIX}streamed/{uuid.uuid4().hex}.zst"
+
+
+def blob_item_key(digest):
+    return {'note_id': f"{BLOB_ID_PREFIX}{digest}", 'version': BLOB_VERSION}
+
+
+def is_blob_item(item):
+    return str(item.get('note_id', '')).startswith(BLOB_ID_PREFIX)
+
+
+def is_shareable(attributes):
+    # Stored forms that decode without anything else of the note can be shared
+    return attributes.get('codec') not in (None, note_codec.CODEC_NONE) and attributes.get('delta_base') is None
+
+
+def reference_attributes(blob, digest):
+    # What a version item records when it reuses a blob
+    attributes = {name: value for name, value in blob.items() if name not in BOOKKEEPING}
+    attributes.update(blob=digest, content_hash=digest, deduplicated=True)
+    return attributes
+
+
+def claim(table, digest):
+    # Takes a reference to a stored blob; returns the version's attributes, or None if there is no blob
+    try:
+        with instrumentation.stage('ddb_write'):
+            response = table.update_item(
+                Key=blob_item_key(digest),
+                UpdateExpression='ADD #r :one SET #c = :now',
+                ConditionExpression='attribute_exists(#k)',
+                ExpressionAttributeNames={'#r': 'references', '#c': 'last_claimed', '#k': 'compressed_key'},
+                ExpressionAttributeValues={':one': 1, ':now': int(time.time())},
+                ReturnValues='ALL_NEW')
+    except ClientError as e:
+        if e.response['Error']['Code'] == 'ConditionalCheckFailedException':
+            return None  # no blob yet, or one still being written
+        raise
+    return reference_attributes(response['Attributes'], digest)
+
+
+def reserve(table, digest, attributes):
+    # Registers a blob about to be written; False if it already exists or is being written.
+    # Claims only succeed once publish() has recorded its key.
+    item = blob_item_key(digest)
+    item.update({name: value for name, value in attributes.items() if name not in BOOKKEEPING})
+    item.update(references=1, last_claimed=int(time.time()))
+    try:
+        with instrumentation.stage('ddb_write'):
+            table.put_item(Item=item, ConditionExpression='attribute_not_exists(note_id)')
+    except ClientError as e:
+        if e.response['Error']['Code'] == 'ConditionalCheckFailedException':
+            return False
+        raise
+    return True
+
+
+def publish(table, digest, key=None):
+    with instrumentation.stage('ddb_write'):
+        table.update_item(
+            Key=blob_item_key(digest),
+            UpdateExpression='SET #k = :key',
+            ExpressionAttributeNames={'#k': 'compressed_key'},
+            ExpressionAttributeValues={':key': key or blob_key(digest)})
+
+
+def release(table, digest):
+    # Drops a reservation whose object could not be written
+    with instrumentation.stage('ddb_write'):
+        table.delete_item(Key=blob_item_key(digest), ConditionExpression='attribute_not_exists(compressed_key)')
+
+
+def store(s3, bucket, table, digest, stored, attributes):
+    # Writes a new blob and returns its key, or None when another writer owns the digest (the
+    # caller then stores its own copy). Adds the blob reference to attributes.
+    if not reserve(table, digest, attributes):
+        return None
+    try:
+        with instrumentation.stage('s3_put'):
+            s3.put_object(Bucket=bucket, Key=blob_key(digest), Body=stored)
+        publish(table, digest)
+    except ClientError:
+        try:
+            release(table, digest)
+        except ClientError:
+            pass  # left to collect_blobs
+        raise
+    attributes.update(blob=digest)
+    return blob_key(digest)
+
+
+def adopt(table, digest, key, attributes):
+    # Registers an object already written to a streamed_blob_key() as the blob of digest; False
+    # when the digest has another writer (the object then stays the version's own copy)
+    if not reserve(table, digest, attributes):
+        return False
+    publish(table, digest, key)
+    attributes.update(blob=digest)
+    return True
@@ -0,0 +1,161 @@
+import os
+
+# Write policy for new versions, shared by upload_notes and compress_notes:
+#   NONE         store notes uncompressed
+#   ZSTD         zstd at the default level
+#   TRAINED_ZSTD zstd with the current trained dictionary
+#   ADAPTIVE     pick codec and level per note (see choose_encoding)
+# Reads never depend on it: each version item records how it was encoded.
+COMPRESSION_ALGO = os.environ.get('COMPRESSION_ALGO', 'ZSTD')
+
+# Codecs recorded on version items ('codec' attribute)
+CODEC_NONE = 'none'
+CODEC_ZSTD = 'zstd'
+CODEC_ZSTD_DICT = 'zstd_dict'
+CODEC_ZSTD_DELTA = 'zstd_delta'
+
+DEFAULT_LEVEL = 3
+# ADAPTIVE: notes smaller than this are stored raw, zstd framing would outweigh any saving
+RAW_MAX_BYTES = int(os.environ.get('ADAPTIVE_RAW_MAX_BYTES', '64'))
+# ADAPTIVE: bytes of the note trial-compressed to estimate its compressibility
+SAMPLE_BYTES = int(os.environ.get('ADAPTIVE_SAMPLE_BYTES', str(16 * 1024)))
+# ADAPTIVE: store raw if the sample does not shrink below this ratio
+INCOMPRESSIBLE_RATIO = float(os.environ.get('ADAPTIVE_INCOMPRESSIBLE_RATIO', '0.9'))
+# ADAPTIVE: the trained dictionary is only tried on notes up to this size
+DICTIONARY_MAX_BYTES = int(os.environ.get('ADAPTIVE_DICTIONARY_MAX_BYTES', str(32 * 1024)))
+# ADAPTIVE: (note size upper bound, level). Small notes are cheap to compress hard;
+# large ones use a fast level to bound CPU time per note.
+ADAPTIVE_LEVELS = [(16 * 1024, 19), (256 * 1024, 9), (None, DEFAULT_LEVEL)]
+
+
+def _zstd():
+    # pyzstd and the dictionary registry are imported on first use, so NONE deployments
+    # and code paths that never touch a zstd codec don't load them on cold start
+    import pyzstd
+    return pyzstd
+
+
+def _dictionaries():
+    import zstd_dictionaries
+    return zstd_dictionaries
+
+
+def is_compressing(algo=None):
+    return (algo or COMPRESSION_ALGO) != "NONE"
+
+
+def delta_prefix(base_content):
+    return _zstd().ZstdDict(base_content, is_raw=True).as_prefix
+
+
+class Encoding:
+    # How one version is (to be) encoded: codec, level and the dictionary or delta base used
+
+    def __init__(self, codec, level=None, dictionary=None, base_version=None, base_content=None):
+        self.codec = codec
+        self.level = level
+        self.dictionary = dictionary
+        self.base_version = base_version
+        self._prefix = delta_prefix(base_content) if codec == CODEC_ZSTD_DELTA else None
+
+    def compress(self, data):
+        if self.codec == CODEC_NONE:
+            return bytes(data)
+        if self.codec == CODEC_ZSTD_DICT:
+            return self.dictionary.compress(data, self.level)
+        if self.codec == CODEC_ZSTD_DELTA:
+            return _zstd().compress(data, self.level, zstd_dict=self._prefix)
+        return _zstd().compress(data, self.level)
+
+    def metadata(self):
+        # Attributes stored on the version item so reads can dispatch on them
+        metadata = {'codec': self.codec}
+        if self.codec != CODEC_NONE:
+            metadata['level'] = self.level if self.level is not None else DEFAULT_LEVEL
+        if self.dictionary is not None:
+            metadata['dictionary_id'] = self.dictionary.dictionary_id
+        if self.base_version is not None:
+            metadata['delta_base'] = self.base_version
+        return metadata
+
+
+def adaptive_level(size):
+    for upper_bound, level in ADAPTIVE_LEVELS:
+        if upper_bound is None or size <= upper_bound:
+            return level
+
+
+def choose_encoding(note_data, base_version=None, base_content=None, algo=None, size=None):
+    # size is the note's length when note_data is only its beginning (streamed notes)
+    algo = algo or COMPRESSION_ALGO
+    if algo == "NONE":
+        return Encoding(CODEC_NONE)
+    if algo != "ADAPTIVE":
+        level = None
+        if base_version is not None:
+            # The previous version is a far closer match than any trained dictionary
+            return Encoding(CODEC_ZSTD_DELTA, level, base_version=base_version, base_content=base_content)
+        if algo == "TRAINED_ZSTD":
+            dictionary = _dictionaries().current_dictionary()
+            return Encoding(CODEC_ZSTD_DICT, dictionary.level, dictionary=dictionary)
+        return Encoding(CODEC_ZSTD, level)
+
+    # ADAPTIVE: decide from the size and a fast trial compression of a sample
+    size = len(note_data) if size is None else size
+    if size <= RAW_MAX_BYTES:
+        return Encoding(CODEC_NONE)
+    level = adaptive_level(size)
+    if base_version is not None:
+        return Encoding(CODEC_ZSTD_DELTA, level, base_version=base_version, base_content=base_content)
+    start = max(0, (len(note_data) - SAMPLE_BYTES) // 2)
+    sample = note_data[start:start + SAMPLE_BYTES]
+    plain_ratio = len(_zstd().compress(sample, 1)) / len(sample)
+    if size <= DICTIONARY_MAX_BYTES:
+        try:
+            dictionary = _dictionaries().current_dictionary()
+        except Exception:
+            dictionary = None  # no trained dictionary published
+        if dictionary is not None and len(dictionary.compress(sample, 1)) / len(sample) < plain_ratio * 0.95:
+            return Encoding(CODEC_ZSTD_DICT, level, dictionary=dictionary)
+    if plain_ratio >= INCOMPRESSIBLE_RATIO:
+        return Encoding(CODEC_NONE)
+    return Encoding(CODEC_ZSTD, level)
+
+
+def item_codec(item):
+    # Versions written before codecs were recorded are inferred from their attributes
+    # and, for trained-dictionary notes without dictionary_id, the deployment setting
+    codec = item.get('codec')
+    if codec:
+        return codec
+    if item.get('delta_base') is not None:
+        return CODEC_ZSTD_DELTA
+    if item.get('dictionary_id') is not None:
+        return CODEC_ZSTD_DICT
+    if item.get('inline_data') is not None or item.get('compressed_key'):
+        return CODEC_ZSTD_DICT if COMPRESSION_ALGO == "TRAINED_ZSTD" else CODEC_ZSTD
+    return CODEC_NONE
+
+
+def is_self_contained(item):
+    # Stored bytes any zstd decoder can read without a dictionary or delta base, so they
+    # can be handed to clients still compressed
+    return item_codec(item) == CODEC_ZSTD
+
+
+def decompress(item, data, base_content=None):
+    codec = item_codec(item)
+    if codec == CODEC_NONE:
+        return bytes(data)
+    if codec == CODEC_ZSTD_DELTA:
+        return _zstd().decompress(data, zstd_dict=delta_prefix(base_content))
+    if codec == CODEC_ZSTD_DICT:
+        dictionary_id = item.get('dictionary_id')
+        if dictionary_id is not None:
+            dictionary = _dictionaries().get_dictionary(dictionary_id)
+        else:
+            dictionary = _dictionaries().current_dictionary()
+        return dictionary.decompress(data)
+    if codec == CODEC_ZSTD:
+        return _zstd().decompress(data)
+    raise ValueError(f"Unsupported codec: {codec}")
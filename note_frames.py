@@ -0,0 +1,48 @@
+import os
+
+# Notes are compressed as a sequence of independent zstd frames, each covering
+# NOTE_FRAME_SIZE bytes of uncompressed content. Concatenated frames are still a
+# valid zstd stream, so whole-note reads decompress the object in one call, while
+# ranged reads fetch and decompress only the frames that overlap the range.
+FRAME_SIZE = int(os.environ.get('NOTE_FRAME_SIZE', str(32 * 1024)))
+
+
+def compress_frames(data, compress, frame_size=FRAME_SIZE):
+    # Returns (compressed_bytes, frames) where each frame is
+    # [compressed_offset, compressed_length, uncompressed_length]
+    chunks = []
+    frames = []
+    offset = 0
+    for start in range(0, max(len(data), 1), frame_size):
+        chunk = data[start:start + frame_size]
+        compressed = compress(chunk)
+        chunks.append(compressed)
+        frames.append([offset, len(compressed), len(chunk)])
+        offset += len(compressed)
+    return b''.join(chunks), frames
+
+
+def frames_for_range(frames, offset, length):
+    # Returns (first_frame, last_frame, uncompressed offset of first_frame) covering
+    # [offset, offset + length) of the uncompressed note, or None if offset is past the end
+    position = 0
+    first = None
+    first_position = 0
+    end = offset + length
+    for index, (_, _, frame_length) in enumerate(frames):
+        frame_end = position + int(frame_length)
+        if first is None and frame_end > offset:
+            first, first_position = index, position
+        if first is not None and frame_end >= end:
+            return first, index, first_position
+        position = frame_end
+    if first is None:
+        return None
+    return first, len(frames) - 1, first_position
+
+
+def byte_range(frames, first, last):
+    # Inclusive S3 byte range of the compressed frames first..last
+    start = int(frames[first][0])
+    end = int(frames[last][0]) + int(frames[last][1]) - 1
+    return start, end
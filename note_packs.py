@@ -0,0 +1,54 @@
+import os
+import time
+import uuid
+
+# Small compressed versions are stored together in shared pack objects instead of one S3
+# object each. A packed version's item keeps compressed_key = the pack's key plus pack_offset
+# and pack_length, the span of its stored bytes in the pack, so it is read with one ranged GET.
+# Packs are never modified; compact_packs.py rewrites them to reclaim the space of versions
+# that moved or were deleted, and to merge small packs.
+
+# Versions whose stored (compressed) form is at most this many bytes are packed (0 disables)
+PACK_MAX_NOTE_BYTES = int(os.environ.get('PACK_MAX_NOTE_BYTES', '0'))
+PACK_PREFIX = 'packs/'
+
+
+def new_pack_key():
+    # Time-ordered, so a listing returns packs oldest first
+    now = time.time()
+    return f"{PACK_PREFIX}{time.strftime('%Y/%m/%d', time.gmtime(now))}/{int(now * 1000):013d}-{uuid.uuid4().hex[:12]}.pack"
+
+
+def is_packed(item):
+    return item.get('pack_offset') is not None
+
+
+def build_pack(blobs):
+    # Returns (pack_bytes, [(offset, length)]) for the blobs in order
+    spans = []
+    offset = 0
+    for blob in blobs:
+        spans.append((offset, len(blob)))
+        offset += len(blob)
+    return b''.join(blobs), spans
+
+
+def stored_range(item, byte_range=None):
+    # S3 Range header for a version's stored bytes, or for the inclusive byte_range (end may be
+    # None) of them; None when the whole object is the version
+    if not is_packed(item):
+        if byte_range is None:
+            return None
+        return f"bytes={byte_range[0]}-{byte_range[1] if byte_range[1] is not None else ''}"
+    offset, length = int(item['pack_offset']), int(item['pack_length'])
+    start, end = byte_range or (0, None)
+    end = length - 1 if end is None else min(end, length - 1)
+    return f"bytes={offset + start}-{offset + end}"
+
+
+def read_stored(s3, bucket, key, item, byte_range=None):
+    # A version's stored bytes from its own object or its pack
+    range_header = stored_range(item, byte_range)
+    if range_header is None:
+        return s3.get_object(Bucket=bucket, Key=key)['Body'].read()
+    return s3.get_object(Bucket=bucket, Key=key, Range=range_header)['Body'].read()
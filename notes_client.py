@@ -0,0 +1,288 @@
+import time
+import json
+import random
+import asyncio
+import hashlib
+import logging
+from functools import partial
+from urllib.parse import unquote
+from concurrent.futures import ThreadPoolExecutor
+import requests
+from requests.adapters import HTTPAdapter
+
+# Client library for the notes API. NotesClient sends every call through one requests.Session
+# whose pool keeps up to pool_size keep-alive connections, and retries throttled (429), failed
+# (5xx) and dropped requests with exponential backoff and full jitter, honouring Retry-After.
+# Notes are read as a stream: with pyzstd installed it sends Accept-Encoding: zstd, so
+# plain-zstd notes arrive as stored (or as a presigned URL) and are decompressed chunk by chunk.
+# note_digest() hashes a note while reading it, so callers verify reads against
+# content_digest() of what they wrote instead of keeping the text.
+#
+# AsyncNotesClient makes the same calls from asyncio, with at most `concurrency` in flight. requests
+# is blocking, so they run on a thread pool the size of the connection pool; no other HTTP
+# library is needed.
+#
+#   with NotesClient('https://<api-id>.execute-api.<region>.amazonaws.com/<stage>') as client:
+#       client.put_note('n1', '1', 'Some text')
+#       assert client.note_digest('n1', '1') == content_digest('Some text')
+
+# Paths of the endpoints under the base URL; any of them can be replaced by a full URL
+ENDPOINTS = {
+    'notes': '/notes',
+    'notes_bulk': '/notes/bulk',
+    'retrieve': '/retrieve',
+    'retrieve_bulk': '/retrieve/bulk',
+    'metrics': '/metrics',
+}
+RETRY_STATUSES = frozenset([429, 500, 502, 503, 504])
+# Bytes read from a streamed response at a time
+CHUNK_BYTES = 64 * 1024
+
+logger = logging.getLogger(__name__)
+
+
+class NotesAPIError(Exception):
+    def __init__(self, status, message):
+        super().__init__(f"{status}: {message}")
+        self.status = status
+        self.message = message
+
+
+def zstd_available():
+    try:
+        import pyzstd  # noqa: F401
+        return True
+    except ImportError:
+        return False
+
+
+def content_digest(content):
+    # (sha256 hex digest, size) of the UTF-8 note, as note_digest() reports it
+    data = content.encode('utf-8') if isinstance(content, str) else content
+    return hashlib.sha256(data).hexdigest(), len(data)
+
+
+def payload(response):
+    # JSON body of a response. API Gateway's non-proxy integrations wrap the handler's response
+    # as {"statusCode": ..., "body": "<json>"}; the status inside counts.
+    status = response.status_code
+    try:
+        data = response.json()
+    except ValueError:
+        data = {'error': response.text}
+    if isinstance(data, dict) and 'statusCode' in data and isinstance(data.get('body'), str):
+        status = int(data['statusCode'])
+        try:
+            data = json.loads(data['body']) if data['body'] else {}
+        except ValueError:
+            data = {'error': data['body']}
+    if status >= 400:
+        raise NotesAPIError(status, data.get('error', data) if isinstance(data, dict) else data)
+    return data
+
+
+def read_stream(response, sink, zstd=False):
+    # Passes a streamed body to sink chunk by chunk, decompressing zstd (any number of frames)
+    decompressor = None
+    if zstd:
+        import pyzstd
+        decompressor = pyzstd.EndlessZstdDecompressor()
+    try:
+        # Content-Encoding: zstd is the stored note, not transport compression: read it raw
+        for chunk in response.raw.stream(CHUNK_BYTES, decode_content=False):
+            sink(decompressor.decompress(chunk) if decompressor else chunk)
+    finally:
+        response.close()
+    if decompressor is not None and not decompressor.at_frame_edge:
+        raise NotesAPIError(response.status_code, "truncated zstd body")
+
+
+class NotesClient:
+    def __init__(self, base_url='', endpoints=None, pool_size=10, attempts=5, backoff_base=0.1, backoff_cap=10.0,
+                 timeout=(5, 60), zstd=None):
+        self.urls = {name: base_url.rstrip('/') + path for name, path in ENDPOINTS.items()}
+        self.urls.update(endpoints or {})
+        self.attempts = attempts
+        self.backoff_base = backoff_base
+        self.backoff_cap = backoff_cap
+        self.timeout = timeout
+        self.zstd = zstd_available() if zstd is None else zstd
+        self.session = requests.Session()
+        # pool_block: callers beyond pool_size wait for a connection instead of opening one that is thrown away
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, pool_block=True, max_retries=0)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+
+    def close(self):
+        self.session.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def retry_delay(self, attempt, response=None):
+        # Full jitter: uniform in [0, min(cap, base * 2^attempt)], but no less than Retry-After
+        delay = random.uniform(0, min(self.backoff_cap, self.backoff_base * 2 ** attempt))
+        retry_after = response.headers.get('Retry-After', '') if response is not None else ''
+        if retry_after.isdigit():
+            delay = max(delay, min(self.backoff_cap, int(retry_after)))
+        return delay
+
+    def request(self, method, endpoint, retry_statuses=RETRY_STATUSES, **kwargs):
+        # Sends a request to an endpoint name or a URL, retrying retry_statuses and connection
+        # errors, and returns the response. The last failure is raised as NotesAPIError.
+        url = self.urls.get(endpoint, endpoint)
+        for attempt in range(self.attempts):
+            response = None
+            try:
+                response = self.session.request(method, url, timeout=self.timeout, **kwargs)
+                if response.status_code not in retry_statuses:
+                    return response
+                error = NotesAPIError(response.status_code, response.text[:200])
+                response.close()
+            except (requests.ConnectionError, requests.Timeout) as e:
+                error = NotesAPIError(None, str(e))
+            if attempt + 1 < self.attempts:
+                delay = self.retry_delay(attempt, response)
+                logger.debug(f"{method} {url} failed ({error}), retrying in {delay:.2f}s")
+                time.sleep(delay)
+        raise error
+
+    def put_note(self, note_id, version, content, title='', update=False):
+        # POST (or PUT with update) of one version
+        response = self.request('PUT' if update else 'POST', 'notes',
+                                json={'note_id': note_id, 'version': version, 'content': content, 'title': title})
+        return payload(response)
+
+    def upload_note(self, note_id, version, content, title='', update=False):
+        # Large notes: the version is registered, then its content is PUT to the presigned URL
+        # (compressed asynchronously, readable once compressed)
+        response = self.request('PUT' if update else 'POST', 'notes',
+                                json={'note_id': note_id, 'version': version, 'title': title, 'upload': 'presigned'})
+        result = payload(response)
+        data = content.encode('utf-8') if isinstance(content, str) else content
+        upload = self.request(result.get('upload_method', 'PUT'), result['upload_url'], data=data)
+        if upload.status_code >= 400:
+            raise NotesAPIError(upload.status_code, upload.text[:200])
+        return result
+
+    def put_notes(self, notes, update=False):
+        # Bulk write of [{note_id, version, content, title}]; returns the per-note results
+        return payload(self.request('PUT' if update else 'POST', 'notes_bulk', json={'notes': notes}))
+
+    def stream_note(self, note_id, version, sink, wait=False, **params):
+        # Streams a version's UTF-8 content into sink(bytes) and returns the response's other
+        # fields. wait retries 404s too: versions are not readable until they are compressed.
+        headers = {'Accept-Encoding': 'zstd'} if self.zstd and not params else {}
+        response = self.request('GET', 'retrieve', params=dict(note_id=note_id, version=version, **params),
+                                headers=headers, stream=True,
+                                retry_statuses=RETRY_STATUSES | {404} if wait else RETRY_STATUSES)
+        if response.status_code == 200 and response.headers.get('Content-Encoding') == 'zstd':
+            fields = {'note_id': unquote(response.headers.get('X-Note-Id', note_id)),
+                      'version': unquote(response.headers.get('X-Note-Version', version)),
+                      'title': unquote(response.headers.get('X-Note-Title', ''))}
+            read_stream(response, sink, zstd=True)
+            return fields
+        fields = payload(response)
+        if 'url' in fields:
+            stored = self.request('GET', fields['url'], stream=True)
+            if stored.status_code >= 400:
+                stored.close()
+                raise NotesAPIError(stored.status_code, "presigned read failed")
+            read_stream(stored, sink, zstd=fields.get('content_encoding') == 'zstd')
+        else:
+            sink(fields.pop('content', '').encode('utf-8'))
+        return fields
+
+    def get_note(self, note_id, version, wait=False, **params):
+        # The version's fields with its content; params: offset, length, delivery
+        chunks = []
+        fields = self.stream_note(note_id, version, chunks.append, wait=wait, **params)
+        fields['content'] = b''.join(chunks).decode('utf-8')
+        return fields
+
+    def note_digest(self, note_id, version, wait=False):
+        # (sha256 hex digest, size) of the version's content, hashed as it streams in
+        digest = hashlib.sha256()
+        size = 0
+
+        def sink(chunk):
+            nonlocal size
+            digest.update(chunk)
+            size += len(chunk)
+
+        self.stream_note(note_id, version, sink, wait=wait)
+        return digest.hexdigest(), size
+
+    def get_notes(self, keys):
+        # Bulk read of [(note_id, version)], following up on versions returned as unprocessed
+        results = []
+        pending = [{'note_id': note_id, 'version': version} for note_id, version in keys]
+        while pending:
+            response = payload(self.request('POST', 'retrieve_bulk', json={'notes': pending}))
+            results.extend(response.get('results', []))
+            if len(response.get('unprocessed') or []) >= len(pending):
+                raise NotesAPIError(413, "bulk read made no progress")
+            pending = response.get('unprocessed') or []
+        return results
+
+    def metrics(self, **params):
+        # GET /metrics: the rollup summary, or one page of note_id=... / list='all'
+        return payload(self.request('GET', 'metrics', params=params or None))
+
+    def list_metrics(self, **params):
+        # Per-version metrics of every page of note_id=... or list='all'
+        versions = []
+        while True:
+            page = self.metrics(**params)
+            versions.extend(page.get('notes_metrics', []))
+            if not page.get('next_token'):
+                return versions
+            params['next_token'] = page['next_token']
+
+
+class AsyncNotesClient:
+    # NotesClient's calls as coroutines, at most concurrency at a time
+
+    def __init__(self, base_url='', concurrency=16, **kwargs):
+        self.client = NotesClient(base_url, pool_size=concurrency, **kwargs)
+        self.executor = ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix='notes-client')
+
+    async def call(self, function, *args, **kwargs):
+        return await asyncio.get_running_loop().run_in_executor(self.executor, partial(function, *args, **kwargs))
+
+    async def put_note(self, *args, **kwargs):
+        return await self.call(self.client.put_note, *args, **kwargs)
+
+    async def upload_note(self, *args, **kwargs):
+        return await self.call(self.client.upload_note, *args, **kwargs)
+
+    async def put_notes(self, *args, **kwargs):
+        return await self.call(self.client.put_notes, *args, **kwargs)
+
+    async def get_note(self, *args, **kwargs):
+        return await self.call(self.client.get_note, *args, **kwargs)
+
+    async def note_digest(self, *args, **kwargs):
+        return await self.call(self.client.note_digest, *args, **kwargs)
+
+    async def get_notes(self, *args, **kwargs):
+        return await self.call(self.client.get_notes, *args, **kwargs)
+
+    async def metrics(self, **params):
+        return await self.call(self.client.metrics, **params)
+
+    async def list_metrics(self, **params):
+        return await self.call(self.client.list_metrics, **params)
+
+    def close(self):
+        self.executor.shutdown(wait=True)
+        self.client.close()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await asyncio.get_running_loop().run_in_executor(None, self.close)
@@ -0,0 +1,105 @@
+import os
+import json
+import logging
+import threading
+import urllib.request
+from functools import wraps
+
+# Work done after a Lambda invocation has returned its response, so it adds nothing to the
+# request's latency: buffered read metrics (read_metrics) and rollup changes (metric_rollups).
+# A module registers a callback, and the handlers that feed it are decorated with handler().
+# In Lambda the decorator registers an internal extension during init; after each invocation
+# Lambda returns the response, then waits for the extension to run the callbacks before it
+# freezes the container. That time counts towards the invocation's billed duration. Elsewhere
+# (local_server.py) a background thread runs the callbacks every BACKGROUND_INTERVAL seconds.
+# Callbacks decide for themselves whether they have anything due.
+
+# Set by Lambda
+RUNTIME_API = os.environ.get('AWS_LAMBDA_RUNTIME_API')
+# Seconds between runs of the callbacks outside Lambda
+BACKGROUND_INTERVAL = 1.0
+
+logger = logging.getLogger()
+
+_callbacks = []
+_invocations = threading.Semaphore(0)  # released when a decorated handler returns
+_wake = threading.Event()
+_thread = None
+_lock = threading.Lock()
+
+
+def register(callback):
+    with _lock:
+        if callback not in _callbacks:
+            _callbacks.append(callback)
+
+
+def wake():
+    # Runs the callbacks now instead of at the next interval (outside Lambda)
+    _wake.set()
+
+
+def handler(function):
+    # Decorator for a lambda_handler. Applied at import time, which is the Lambda init phase,
+    # when extensions must register.
+    start()
+
+    @wraps(function)
+    def run(event, context=None):
+        try:
+            return function(event, context)
+        finally:
+            _invocations.release()
+    return run
+
+
+def start():
+    global _thread
+    with _lock:
+        if _thread is not None:
+            return
+        target, args = _background, ()
+        if RUNTIME_API:
+            try:
+                extension_id = extension_request('register', {'Lambda-Extension-Name': 'post-invocation'},
+                                                 {'events': ['INVOKE']})
+                target, args = _extension, (extension_id,)
+            except OSError as e:
+                logger.warning(f"Post-invocation extension not registered, using a background thread: {e}")
+        _thread = threading.Thread(target=target, args=args, name='post-invocation', daemon=True)
+        _thread.start()
+
+
+def run_callbacks():
+    with _lock:
+        callbacks = list(_callbacks)
+    for callback in callbacks:
+        try:
+            callback()
+        except Exception as e:
+            logger.error(f"Post-invocation work failed: {e}")
+
+
+def _extension(extension_id):
+    while True:
+        # Returns when an invocation starts; the invocation ends once this loop asks again
+        extension_request('event/next', {'Lambda-Extension-Identifier': extension_id})
+        _invocations.acquire()
+        run_callbacks()
+
+
+def _background():
+    while True:
+        _wake.wait(BACKGROUND_INTERVAL)
+        _wake.clear()
+        run_callbacks()
+
+
+def extension_request(path, headers, body=None):
+    # Lambda Extensions API call (POST with a body, else GET); returns the extension ID header
+    request = urllib.request.Request(f"http://{RUNTIME_API}/2020-01-01/extension/{path}",
+                                     data=json.dumps(body).encode('utf-8') if body is not None else None,
+                                     headers=headers, method='POST' if body is not None else 'GET')
+    with urllib.request.urlopen(request) as response:
+        response.read()
+        return response.headers.get('Lambda-Extension-Identifier')
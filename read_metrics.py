@@ -0,0 +1,312 @@
+import os
+import re
+import math
+import time
+import threading
+import logging
+from decimal import Decimal
+from botocore.exceptions import ClientError
+import post_invocation
+
+# Seconds between writes of buffered read metrics to DynamoDB
+FLUSH_INTERVAL = float(os.environ.get('READ_METRICS_FLUSH_INTERVAL', '30'))
+# Flush early once this many versions have buffered samples
+MAX_PENDING = int(os.environ.get('READ_METRICS_MAX_PENDING', '500'))
+# A flush stops after this many seconds; versions it did not reach wait for the next one
+FLUSH_MAX_SECONDS = float(os.environ.get('READ_METRICS_FLUSH_MAX_SECONDS', '2'))
+# Characters of an update expression filled with sketch bucket increments (DynamoDB allows 4 KB)
+MAX_EXPRESSION_LENGTH = 3500
+
+logger = logging.getLogger()
+
+
+class LatencySketch:
+    # Mergeable quantile sketch: a histogram with logarithmically sized buckets, so any
+    # quantile is estimated within RELATIVE_ACCURACY of the true value (DDSketch-style).
+    RELATIVE_ACCURACY = 0.02
+    GAMMA = (1 + RELATIVE_ACCURACY) / (1 - RELATIVE_ACCURACY)
+    MIN_VALUE = 1e-3  # smaller samples share the lowest bucket
+
+    def __init__(self, buckets=None):
+        self.buckets = dict(buckets or {})  # bucket index -> count
+
+    def add(self, value, count=1):
+        index = math.ceil(math.log(max(value, self.MIN_VALUE), self.GAMMA))
+        self.buckets[index] = self.buckets.get(index, 0) + count
+
+    def merge(self, other):
+        for index, count in other.buckets.items():
+            self.buckets[index] = self.buckets.get(index, 0) + count
+
+    def quantile(self, q):
+        total = sum(self.buckets.values())
+        if total == 0:
+            return None
+        rank = q * (total - 1)
+        seen = 0
+        for index in sorted(self.buckets):
+            seen += self.buckets[index]
+            if seen > rank:
+                return 2 * self.GAMMA ** index / (self.GAMMA + 1)
+        return 2 * self.GAMMA ** max(self.buckets) / (self.GAMMA + 1)
+
+    def to_item(self):
+        return {str(index): count for index, count in self.buckets.items()}
+
+    @classmethod
+    def from_item(cls, value):
+        return cls({int(index): int(count) for index, count in (value or {}).items()})
+
+
+class LatencyStats:
+    # count/sum/min/max plus a quantile sketch for one latency metric of one version
+
+    def __init__(self, count=0, total=0.0, minimum=None, maximum=None, sketch=None):
+        self.count = count
+        self.total = total
+        self.minimum = minimum
+        self.maximum = maximum
+        self.sketch = sketch or LatencySketch()
+
+    def add(self, value):
+        self.count += 1
+        self.total += value
+        self.minimum = value if self.minimum is None else min(self.minimum, value)
+        self.maximum = value if self.maximum is None else max(self.maximum, value)
+        self.sketch.add(value)
+
+    def merge(self, other):
+        self.count += other.count
+        self.total += other.total
+        if other.minimum is not None:
+            self.minimum = other.minimum if self.minimum is None else min(self.minimum, other.minimum)
+        if other.maximum is not None:
+            self.maximum = other.maximum if self.maximum is None else max(self.maximum, other.maximum)
+        self.sketch.merge(other.sketch)
+
+    def mean(self):
+        return self.total / self.count if self.count else None
+
+    def summary(self):
+        return {
+            'count': self.count,
+            'mean': self.mean(),
+            'min': self.minimum,
+            'max': self.maximum,
+            'p50': self.sketch.quantile(0.50),
+            'p95': self.sketch.quantile(0.95),
+            'p99': self.sketch.quantile(0.99)
+        }
+
+    def to_item(self):
+        return {
+            'count': self.count,
+            'sum': to_decimal(self.total),
+            'min': to_decimal(self.minimum),
+            'max': to_decimal(self.maximum),
+            'sketch': self.sketch.to_item()
+        }
+
+    @classmethod
+    def from_item(cls, value):
+        if not value:
+            return cls()
+        return cls(
+            count=int(value.get('count', 0)),
+            total=float(value.get('sum', 0)),
+            minimum=float(value['min']) if value.get('min') is not None else None,
+            maximum=float(value['max']) if value.get('max') is not None else None,
+            sketch=LatencySketch.from_item(value.get('sketch'))
+        )
+
+
+def to_decimal(value):
+    return Decimal(str(round(value, 6))) if value is not None else None
+
+
+def stats_attribute(metric):
+    # DynamoDB attribute holding the aggregate of a metric, e.g. read_latency_stats
+    return f"{metric}_stats"
+
+
+class ReadMetricsBuffer:
+    # Collects read-path latencies in memory and adds them to each version's aggregates in
+    # DynamoDB after the response (see post_invocation), once READ_METRICS_FLUSH_INTERVAL has
+    # passed or READ_METRICS_MAX_PENDING versions have samples. A flush gives up after
+    # READ_METRICS_FLUSH_MAX_SECONDS and keeps what it did not write; samples still buffered
+    # when a container is shut down are lost. Each version also gets read_count and last_read
+    # (epoch seconds), which recompress_notes uses to tell hot versions from cold, and each
+    # flush adds its reads and latencies to the metric rollups (see metric_rollups).
+
+    def __init__(self, table):
+        self.table = table
+        self._pending = {}  # (note_id, version) -> {metric: LatencyStats}
+        self._access = {}  # (note_id, version) -> [reads, last read time, uncompressed size]
+        self._lock = threading.Lock()
+        self._last_flush = time.monotonic()
+        post_invocation.register(self.flush_if_due)
+
+    def record(self, note_id, version, size=None, **latencies):
+        # size: the version's uncompressed size, for the rollups; latencies: metric name ->
+        # milliseconds, e.g. read_latency=12.5
+        with self._lock:
+            stats = self._pending.setdefault((note_id, version), {})
+            for metric, value in latencies.items():
+                if value is not None:
+                    stats.setdefault(metric, LatencyStats()).add(float(value))
+            access = self._access.setdefault((note_id, version), [0, 0, None])
+            access[0] += 1
+            access[1] = int(time.time())
+            if size is not None:
+                access[2] = int(size)
+            if len(self._pending) >= MAX_PENDING:
+                post_invocation.wake()
+
+    def flush_if_due(self):
+        with self._lock:
+            due = time.monotonic() - self._last_flush >= FLUSH_INTERVAL or len(self._pending) >= MAX_PENDING
+            if not due or not self._pending:
+                return
+            self._last_flush = time.monotonic()
+        self.flush(deadline=time.monotonic() + FLUSH_MAX_SECONDS)
+
+    def flush(self, deadline=None):
+        import metric_rollups  # imported here: metric_rollups imports this module
+        with self._lock:
+            pending, self._pending = self._pending, {}
+            access, self._access = self._access, {}
+        rollups = {}
+        for (note_id, version), stats in list(pending.items()):
+            if deadline is not None and time.monotonic() >= deadline:
+                break
+            reads, last_read, size = access.pop((note_id, version), (0, 0, None))
+            del pending[(note_id, version)]
+            try:
+                written = self._write(note_id, version, stats, reads, last_read)
+            except ClientError as e:
+                logger.error(f"Failed to flush read metrics for note_id={note_id}, version={version}: {e.response['Error']['Message']}")
+                continue
+            if written:
+                metric_rollups.merge(rollups, metric_rollups.read_changes(note_id, size or 0, reads, stats))
+        if pending:
+            logger.warning(f"Read metrics flush stopped after {FLUSH_MAX_SECONDS}s, {len(pending)} versions left for the next one")
+            self._restore(pending, access)
+        # One update per rollup for the whole flush
+        metric_rollups.apply(self.table, rollups)
+
+    def _restore(self, pending, access):
+        # Puts unwritten samples back, merged with those recorded meanwhile
+        with self._lock:
+            for key, stats in pending.items():
+                merged = self._pending.setdefault(key, {})
+                for metric, buffered in stats.items():
+                    merged.setdefault(metric, LatencyStats()).merge(buffered)
+                reads, last_read, size = access.get(key, (0, 0, None))
+                current = self._access.setdefault(key, [0, 0, None])
+                current[0] += reads
+                current[1] = max(current[1], last_read)
+                current[2] = current[2] if current[2] is not None else size
+
+    def _write(self, note_id, version, stats, reads, last_read):
+        # Adds the buffered samples to the stored aggregates in one update: read_count with ADD,
+        # and count, sum and sketch buckets incremented in place inside each {metric}_stats map,
+        # so concurrent containers never overwrite each other. min/max are only set if missing;
+        # the stored values come back with the update, and a buffered value beyond them is
+        # written with a second, conditional update. Returns False if the version is gone.
+        key = {'note_id': note_id, 'version': version}
+        names = {'#nid': 'note_id', '#rc': 'read_count', '#lr': 'last_read', '#c': 'count', '#t': 'sum',
+                 '#lo': 'min', '#hi': 'max', '#k': 'sketch'}
+        values = {':rc': reads, ':lr': last_read, ':z': 0}
+        assignments = ['#lr = :lr']
+        buckets = []
+        for i, (metric, buffered) in enumerate(stats.items()):
+            names[f'#s{i}'] = stats_attribute(metric)
+            assignments += [f'#s{i}.#c = #s{i}.#c + :c{i}', f'#s{i}.#t = #s{i}.#t + :t{i}',
+                            f'#s{i}.#lo = if_not_exists(#s{i}.#lo, :lo{i})', f'#s{i}.#hi = if_not_exists(#s{i}.#hi, :hi{i})']
+            values.update({f':c{i}': buffered.count, f':t{i}': to_decimal(buffered.total),
+                           f':lo{i}': to_decimal(buffered.minimum), f':hi{i}': to_decimal(buffered.maximum)})
+            for index, count in buffered.sketch.buckets.items():
+                name = f'#b{index}'.replace('-', 'm')  # placeholders are alphanumeric
+                names[name] = str(index)
+                path = f'#s{i}.#k.{name}'
+                placeholder = f':n{len(buckets)}'
+                buckets.append((f'{path} = if_not_exists({path}, :z) + {placeholder}', placeholder, count))
+        try:
+            stored = self._update(key, assignments, list(buckets), names, values)
+        except ClientError as e:
+            if e.response['Error']['Code'] == 'ConditionalCheckFailedException':
+                return False
+            if e.response['Error']['Code'] != 'ValidationException':
+                raise
+            # First samples of a metric for this version: create its empty map, then add to it
+            self._create_maps(key, stats)
+            stored = self._update(key, assignments, list(buckets), names, values)
+        for metric, buffered in stats.items():
+            # A stored value that is not returned is not known to be beyond the buffered one
+            current = stored.get(stats_attribute(metric), {})
+            if current.get('min') is None or to_decimal(buffered.minimum) < current['min']:
+                self._set_extreme(key, metric, '#lo', '>', buffered.minimum)
+            if current.get('max') is None or to_decimal(buffered.maximum) > current['max']:
+                self._set_extreme(key, metric, '#hi', '<', buffered.maximum)
+        return True
+
+    def _update(self, key, assignments, buckets, names, values):
+        # Sends the assignments with as many bucket increments as fit in one update expression;
+        # any left over go in further updates. Returns the aggregates as stored after the first.
+        stored = None
+        while stored is None or buckets:
+            clauses = list(assignments) if stored is None else []
+            batch_values = dict(values) if stored is None else {':z': 0}
+            while buckets and sum(len(clause) + 2 for clause in clauses) + len(buckets[0][0]) < MAX_EXPRESSION_LENGTH:
+                clause, placeholder, count = buckets.pop(0)
+                clauses.append(clause)
+                batch_values[placeholder] = count
+            expression = ('ADD #rc :rc SET ' if stored is None else 'SET ') + ', '.join(clauses)
+            response = self.table.update_item(
+                Key=key,
+                UpdateExpression=expression,
+                # A version deleted since it was read gets no metrics (and is not recreated)
+                ConditionExpression='attribute_exists(#nid)',
+                **placeholders(expression + ' #nid', names, batch_values),
+                ReturnValues='UPDATED_NEW'
+            )
+            if stored is None:
+                stored = response.get('Attributes', {})
+        return stored
+
+    def _create_maps(self, key, stats):
+        # Empty aggregates for the metrics that have none yet; a map another container created
+        # in the meantime is kept
+        names = {'#nid': 'note_id'}
+        assignments = []
+        for i, metric in enumerate(stats):
+            names[f'#s{i}'] = stats_attribute(metric)
+            assignments.append(f'#s{i} = if_not_exists(#s{i}, :empty)')
+        self.table.update_item(
+            Key=key,
+            UpdateExpression='SET ' + ', '.join(assignments),
+            ConditionExpression='attribute_exists(#nid)',
+            ExpressionAttributeNames=names,
+            ExpressionAttributeValues={':empty': {'count': 0, 'sum': 0, 'sketch': {}}}
+        )
+
+    def _set_extreme(self, key, metric, name, comparison, value):
+        # Lowers min ('>') or raises max ('<') unless another container already went further
+        try:
+            self.table.update_item(
+                Key=key,
+                UpdateExpression=f'SET #s.{name} = :v',
+                ConditionExpression=f'#s.{name} {comparison} :v',
+                ExpressionAttributeNames={'#s': stats_attribute(metric), name: {'#lo': 'min', '#hi': 'max'}[name]},
+                ExpressionAttributeValues={':v': to_decimal(value)}
+            )
+        except ClientError as e:
+            if e.response['Error']['Code'] != 'ConditionalCheckFailedException':
+                raise
+
+
+def placeholders(expression, names, values):
+    # ExpressionAttributeNames/Values limited to the placeholders the expression uses
+    used = set(re.findall(r'[#:]\w+', expression))
+    return {'ExpressionAttributeNames': {name: value for name, value in names.items() if name in used},
+            'ExpressionAttributeValues': {name: value for name, value in values.items() if name in used}}
@@ -0,0 +1,121 @@
+import os
+import sys
+import json
+import logging
+import argparse
+from collections import Counter
+from decimal import Decimal
+import aws_clients
+import instrumentation
+import metric_rollups
+import note_blobs
+from read_metrics import LatencyStats, stats_attribute
+
+# Reconciliation of the metric rollups (see metric_rollups.py). Handlers keep the rollups
+# current with ADD updates, which drift when a bulk upload overwrites a stored version, a
+# message is compressed twice concurrently or a rollup update fails. This job recomputes every
+# rollup from a scan of the version items and ADDs the difference to the rollups that are off,
+# so updates made while it runs are kept. An update that lands between the scan of a version
+# and the read of its rollups is either counted twice or missed; a later run corrects it. Runs
+# on a schedule (lambda_handler) or from the command line:
+#
+#   python rebuild_rollups.py --dry-run
+
+DDB_TABLE = os.environ.get('NOTES_TABLE', 'your-notes-table')
+# Sums that differ by less than this are rounding, not drift
+SUM_TOLERANCE = Decimal('0.001')
+
+logger = logging.getLogger()
+logger.setLevel(instrumentation.LOG_LEVEL)
+
+
+def scan_versions(table):
+    # Returns (version items, scopes of existing rollups)
+    versions = []
+    existing = set()
+    attributes = ['note_id', 'version', 'compression_status', 'uncompressed_size', 'compressed_size',
+                  'compression_ratio', 'deduplicated', 'content_hash', 'read_count'] + \
+        [stats_attribute(metric) for metric in metric_rollups.LATENCY_METRICS]
+    names = {f'#a{i}': name for i, name in enumerate(attributes)}
+    kwargs = {'ProjectionExpression': ', '.join(names), 'ExpressionAttributeNames': names}
+    while True:
+        response = table.scan(**kwargs)
+        for item in response.get('Items', []):
+            if metric_rollups.is_rollup_item(item):
+                existing.add(metric_rollups.item_scope(item))
+            elif not note_blobs.is_blob_item(item):
+                versions.append(item)
+        if 'LastEvaluatedKey' not in response:
+            return versions, existing
+        kwargs['ExclusiveStartKey'] = response['LastEvaluatedKey']
+
+
+def expected(versions):
+    # {scope: counters} recomputed from the version items
+    rollups = {}
+    for item in versions:
+        metric_rollups.merge(rollups, metric_rollups.changes(item['note_id'], item))
+        stats = {metric: LatencyStats.from_item(item[stats_attribute(metric)])
+                 for metric in metric_rollups.LATENCY_METRICS if item.get(stats_attribute(metric))}
+        reads = int(item.get('read_count') or 0)
+        if reads or stats:
+            size = int(item.get('uncompressed_size') or 0)
+            metric_rollups.merge(rollups, metric_rollups.read_changes(item['note_id'], size, reads, stats))
+    return rollups
+
+
+def drift(target, current):
+    # Counters to add to current to reach target
+    difference = Counter()
+    for name in set(target) | set(current):
+        value = target.get(name, 0) - current.get(name, 0)
+        if name.endswith('_sum') and abs(value) < SUM_TOLERANCE:
+            continue
+        if value:
+            difference[name] = value
+    return difference
+
+
+def rebuild(dry_run=False):
+    table = aws_clients.table(DDB_TABLE)
+    with instrumentation.stage('ddb_read'):
+        versions, existing = scan_versions(table)
+    targets = expected(versions)
+    with instrumentation.stage('ddb_read'):
+        current = metric_rollups.read(aws_clients.dynamodb, DDB_TABLE, set(targets) | existing)
+    stats = {
+        'versions': len(versions),
+        'rollups': len(set(targets) | existing),
+        'rollups_corrected': 0,
+        'dry_run': dry_run
+    }
+    for scope in sorted(set(targets) | existing):
+        difference = drift(targets.get(scope, Counter()), current.get(scope, Counter()))
+        if not difference:
+            continue
+        stats['rollups_corrected'] += 1
+        logger.info(f"Rollup {scope} drifted: {json.dumps({name: float(value) for name, value in difference.items()})}")
+        if not dry_run:
+            metric_rollups.add(table, scope, difference)
+    return stats
+
+
+@instrumentation.instrumented('rebuild_rollups')
+def lambda_handler(event, context=None):
+    stats = rebuild(dry_run=bool((event or {}).get('dry_run')))
+    instrumentation.annotate(**{key: value for key, value in stats.items() if key != 'dry_run'})
+    logger.info(f"Rollup rebuild: {json.dumps(stats)}")
+    return stats
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Recompute the metric rollups and correct their drift")
+    parser.add_argument('--dry-run', action='store_true', help="report the rollups that drifted without correcting them")
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s %(message)s')
+    print(json.dumps(rebuild(dry_run=args.dry_run), indent=2))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
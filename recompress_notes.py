@@ -0,0 +1,427 @@
+import os
+import re
+import sys
+import json
+import time
+import logging
+import uuid
+import argparse
+from decimal import Decimal
+from botocore.exceptions import ClientError
+import aws_clients
+import instrumentation
+import metric_rollups
+import note_blobs
+import note_codec
+import note_frames
+import note_packs
+import zstd_dictionaries
+from upload_notes import note_key
+from version_chain import VersionReader
+
+# Access-driven recompression. A version's level is chosen once, when it is written; this job
+# revisits it with the read_count and last_read that retrieve_note records:
+#
+#   cold  not read (or written) for RECOMPRESS_COLD_SECONDS: recompressed at
+#         RECOMPRESS_COLD_LEVEL, with the current trained dictionary if that is smaller, and
+#         kept only if it saves at least RECOMPRESS_MIN_SAVING of the stored bytes
+#   hot   at least RECOMPRESS_HOT_READS reads, the last within RECOMPRESS_HOT_SECONDS, and
+#         stored above RECOMPRESS_HOT_LEVEL: recompressed at that fast level
+#
+# The new form is written to a new object (or pack), then the item is switched to it with one
+# conditional update of compressed_key and the encoding attributes, so readers see either the
+# old or the new form, never a mix. The old object is not deleted then: readers may still hold
+# the old item or a presigned URL for it. Each run lists the objects it superseded in a manifest
+# under SUPERSEDED_PREFIX, and a run at least RECOMPRESS_DELETE_GRACE_SECONDS later deletes them
+# unless their version points at them again. Deduplicated blobs and inline notes are left alone. The job
+# paces itself to RECOMPRESS_BYTES_PER_SECOND and stops after RECOMPRESS_MAX_VERSIONS or when
+# the Lambda is about to time out. Runs on a schedule (lambda_handler) or from the command line:
+#
+#   python recompress_notes.py --dry-run
+
+DDB_TABLE = os.environ.get('NOTES_TABLE', 'your-notes-table')
+S3_BUCKET = os.environ.get('NOTES_BUCKET', 'your-notes-bucket')
+RECOMPRESS_COLD_SECONDS = int(os.environ.get('RECOMPRESS_COLD_SECONDS', str(30 * 24 * 3600)))
+RECOMPRESS_COLD_LEVEL = int(os.environ.get('RECOMPRESS_COLD_LEVEL', '19'))
+# Fraction of the stored size a cold rewrite must save to be kept
+RECOMPRESS_MIN_SAVING = float(os.environ.get('RECOMPRESS_MIN_SAVING', '0.05'))
+RECOMPRESS_HOT_SECONDS = int(os.environ.get('RECOMPRESS_HOT_SECONDS', str(24 * 3600)))
+RECOMPRESS_HOT_READS = int(os.environ.get('RECOMPRESS_HOT_READS', '20'))
+RECOMPRESS_HOT_LEVEL = int(os.environ.get('RECOMPRESS_HOT_LEVEL', str(note_codec.DEFAULT_LEVEL)))
+# Versions rewritten per run, and uncompressed bytes processed per second
+RECOMPRESS_MAX_VERSIONS = int(os.environ.get('RECOMPRESS_MAX_VERSIONS', '500'))
+RECOMPRESS_BYTES_PER_SECOND = int(os.environ.get('RECOMPRESS_BYTES_PER_SECOND', str(8 * 1024 * 1024)))
+# Superseded objects are kept this long before a run deletes them; must exceed
+# PRESIGNED_URL_EXPIRY and the read Lambda timeout
+RECOMPRESS_DELETE_GRACE_SECONDS = int(os.environ.get('RECOMPRESS_DELETE_GRACE_SECONDS', '3600'))
+# Stop once the Lambda has less time left than this
+DEADLINE_MARGIN_MS = 30000
+
+# Manifests of the objects each run superseded, named by creation time
+SUPERSEDED_PREFIX = 'notes/superseded/'
+SUPERSEDED_TIME = re.compile(r'/(\d{13})-[0-9a-f]+\.json$')
+
+logger = logging.getLogger()
+logger.setLevel(instrumentation.LOG_LEVEL)
+
+
+def scan_versions(table):
+    # Compressed versions with their own stored object or pack span
+    items = []
+    names = {f'#a{i}': name for i, name in enumerate(
+        ['note_id', 'version', 'compressed_key', 'compressed_size', 'uncompressed_size', 'codec', 'level',
+         'dictionary_id', 'delta_base', 'frames', 'pack_offset', 'pack_length', 'read_count', 'last_read',
+         'compressed_at', 'recompressed_at', 'storage_tier', 'compression_ratio'])}
+    names.update({'#st': 'compression_status', '#blob': 'blob', '#inline': 'inline_data'})
+    kwargs = {
+        # Blobs and the versions referring to them share one object, which is never rewritten here
+        'FilterExpression': '#st = :compressed AND attribute_exists(#a2) AND attribute_not_exists(#blob) AND '
+                            'attribute_not_exists(#inline) AND NOT begins_with(#a0, :blob_prefix)',
+        'ProjectionExpression': ', '.join(name for name in names if name.startswith('#a')),
+        'ExpressionAttributeNames': names,
+        'ExpressionAttributeValues': {':compressed': 'compressed', ':blob_prefix': note_blobs.BLOB_ID_PREFIX}
+    }
+    while True:
+        response = table.scan(**kwargs)
+        items.extend(response.get('Items', []))
+        if 'LastEvaluatedKey' not in response:
+            return items
+        kwargs['ExclusiveStartKey'] = response['LastEvaluatedKey']
+
+
+def stored_bytes(item):
+    # Versions written before compressed_size was recorded only have their ratio
+    if item.get('compressed_size') is not None:
+        return int(item['compressed_size'])
+    return round(float(item.get('compression_ratio') or 1) * int(item.get('uncompressed_size') or 0))
+
+
+def current_dictionary():
+    try:
+        return zstd_dictionaries.current_dictionary()
+    except Exception:
+        return None  # no trained dictionary published
+
+
+def tier(item, now):
+    # 'hot', 'cold' or None
+    last_read = int(item.get('last_read') or 0)
+    if int(item.get('read_count') or 0) >= RECOMPRESS_HOT_READS and now - last_read <= RECOMPRESS_HOT_SECONDS:
+        return 'hot'
+    last_active = max(last_read, int(item.get('compressed_at') or 0), int(item.get('recompressed_at') or 0))
+    if now - last_active >= RECOMPRESS_COLD_SECONDS:
+        return 'cold'
+    return None
+
+
+def needs_recompression(item, item_tier, dictionary):
+    codec = note_codec.item_codec(item)
+    if codec == note_codec.CODEC_NONE:
+        return False
+    level = int(item.get('level') or note_codec.DEFAULT_LEVEL)
+    if item_tier == 'hot':
+        return level > RECOMPRESS_HOT_LEVEL
+    if item_tier != 'cold':
+        return False
+    # A cold version is done unless it is below the cold level or a newer dictionary could help
+    newer_dictionary = dictionary is not None and codec != note_codec.CODEC_ZSTD_DELTA and \
+        item.get('dictionary_id') != dictionary.dictionary_id
+    if item.get('storage_tier') == 'cold':
+        return newer_dictionary
+    return level < RECOMPRESS_COLD_LEVEL or newer_dictionary
+
+
+def candidate_encodings(item, item_tier, dictionary, base_content):
+    codec = note_codec.item_codec(item)
+    level = RECOMPRESS_HOT_LEVEL if item_tier == 'hot' else RECOMPRESS_COLD_LEVEL
+    if codec == note_codec.CODEC_ZSTD_DELTA:
+        # The delta base stays; only the level changes
+        return [note_codec.Encoding(codec, level, base_version=item['delta_base'], base_content=base_content)]
+    if item_tier == 'hot':
+        if codec == note_codec.CODEC_ZSTD_DICT:
+            return [note_codec.Encoding(codec, level, dictionary=zstd_dictionaries.get_dictionary(item['dictionary_id']))]
+        return [note_codec.Encoding(codec, level)]
+    encodings = [note_codec.Encoding(note_codec.CODEC_ZSTD, level)]
+    if dictionary is not None:
+        encodings.append(note_codec.Encoding(note_codec.CODEC_ZSTD_DICT, level, dictionary=dictionary))
+    return encodings
+
+
+def recompress(reader, item, item_tier, dictionary):
+    # Returns (encoding, stored, frames) of the best candidate, or None if it is not worth keeping
+    note_data = reader.load(item['note_id'], item['version'])
+    base_content = reader.load(item['note_id'], item['delta_base']) if item.get('delta_base') is not None else None
+    best = None
+    with instrumentation.stage('compress'):
+        for encoding in candidate_encodings(item, item_tier, dictionary, base_content):
+            stored, frames = note_frames.compress_frames(note_data, encoding.compress)
+            if best is None or len(stored) < len(best[1]):
+                best = (encoding, stored, frames)
+    if item_tier == 'cold' and len(best[1]) > stored_bytes(item) * (1 - RECOMPRESS_MIN_SAVING):
+        return None
+    return best
+
+
+def switch(table, item, compressed_key, encoding, stored, frames, item_tier, pack_span=None):
+    # Points the version at its new form unless it changed since it was scanned
+    uncompressed_size = int(item['uncompressed_size'])
+    values = {
+        ':key': compressed_key,
+        ':size': len(stored),
+        ':ratio': Decimal(len(stored)) / Decimal(uncompressed_size) if uncompressed_size else None,
+        ':frames': frames,
+        ':tier': item_tier,
+        ':at': int(time.time()),
+        ':old_key': item['compressed_key']
+    }
+    names = {'#k': 'compressed_key', '#s': 'compressed_size', '#r': 'compression_ratio', '#f': 'frames',
+             '#t': 'storage_tier', '#at': 'recompressed_at', '#o': 'pack_offset', '#l': 'pack_length'}
+    assignments = ['#k = :key', '#s = :size', '#r = :ratio', '#f = :frames', '#t = :tier', '#at = :at']
+    removals = []
+    metadata = encoding.metadata()
+    for name in ('codec', 'level', 'dictionary_id'):
+        names[f'#{name}'] = name
+        if name in metadata:
+            assignments.append(f'#{name} = :{name}')
+            values[f':{name}'] = metadata[name]
+        else:
+            removals.append(f'#{name}')
+    if pack_span is not None:
+        assignments += ['#o = :offset', '#l = :length']
+        values.update({':offset': pack_span[0], ':length': pack_span[1]})
+    else:
+        # A version leaving a pack must not keep its span, or reads would range into the new object
+        removals += ['#o', '#l']
+    if note_packs.is_packed(item):
+        condition = '#k = :old_key AND #o = :old_offset'
+        values[':old_offset'] = item['pack_offset']
+    else:
+        condition = '#k = :old_key AND attribute_not_exists(#o)'
+    expression = 'SET ' + ', '.join(assignments)
+    if removals:
+        expression += ' REMOVE ' + ', '.join(removals)
+    try:
+        with instrumentation.stage('ddb_write'):
+            table.update_item(
+                Key={'note_id': item['note_id'], 'version': item['version']},
+                UpdateExpression=expression,
+                ConditionExpression=condition,
+                ExpressionAttributeNames=names,
+                ExpressionAttributeValues=values)
+        return True
+    except ClientError as e:
+        if e.response['Error']['Code'] == 'ConditionalCheckFailedException':
+            return False
+        raise
+
+
+def new_object_key(item):
+    return note_key(item['note_id'], item['version']).replace('.txt', f".r{int(time.time() * 1000)}.zst")
+
+
+def superseded_created(key):
+    # Creation time encoded in a manifest key, None for foreign objects
+    match = SUPERSEDED_TIME.search(key)
+    return int(match.group(1)) / 1000 if match else None
+
+
+def record_superseded(s3, superseded):
+    # One manifest per run: [{note_id, version, key}] of the objects versions no longer use
+    key = f"{SUPERSEDED_PREFIX}{int(time.time() * 1000):013d}-{uuid.uuid4().hex[:12]}.json"
+    try:
+        with instrumentation.stage('s3_put'):
+            s3.put_object(Bucket=S3_BUCKET, Key=key, Body=json.dumps(superseded).encode('utf-8'))
+    except ClientError as e:
+        logger.error(f"Failed to record superseded objects, not deleted: {[entry['key'] for entry in superseded]}: "
+                     f"{e.response['Error']['Message']}")
+
+
+def still_used(table, entry):
+    # A version written again may have been stored under the same key
+    item = table.get_item(Key={'note_id': entry['note_id'], 'version': entry['version']},
+                          ProjectionExpression='#k', ExpressionAttributeNames={'#k': 'compressed_key'}).get('Item')
+    return item is not None and item.get('compressed_key') == entry['key']
+
+
+def delete_superseded(s3, table, stats):
+    # Deletes the objects listed in manifests older than RECOMPRESS_DELETE_GRACE_SECONDS
+    now = time.time()
+    kwargs = {'Bucket': S3_BUCKET, 'Prefix': SUPERSEDED_PREFIX}
+    while True:
+        with instrumentation.stage('s3_list'):
+            response = s3.list_objects_v2(**kwargs)
+        for obj in response.get('Contents', []):
+            created = superseded_created(obj['Key'])
+            if created is None or now - created < RECOMPRESS_DELETE_GRACE_SECONDS:
+                continue
+            try:
+                with instrumentation.stage('s3_get'):
+                    entries = json.loads(s3.get_object(Bucket=S3_BUCKET, Key=obj['Key'])['Body'].read())
+                with instrumentation.stage('s3_delete'):
+                    for entry in entries:
+                        if not still_used(table, entry):
+                            s3.delete_object(Bucket=S3_BUCKET, Key=entry['key'])
+                            stats['superseded_deleted'] += 1
+                    s3.delete_object(Bucket=S3_BUCKET, Key=obj['Key'])
+            except ClientError as e:
+                # The manifest stays, so the next run tries again
+                logger.warning(f"Failed to delete objects listed in {obj['Key']}: {e.response['Error']['Message']}")
+        if not response.get('IsTruncated'):
+            return
+        kwargs['ContinuationToken'] = response['NextContinuationToken']
+
+
+class Pacer:
+    # Sleeps so that processed bytes stay under bytes_per_second
+    def __init__(self, bytes_per_second):
+        self.bytes_per_second = bytes_per_second
+        self.start = time.monotonic()
+        self.processed = 0
+
+    def add(self, size):
+        self.processed += size
+        if self.bytes_per_second > 0:
+            delay = self.processed / self.bytes_per_second - (time.monotonic() - self.start)
+            if delay > 0:
+                time.sleep(delay)
+
+
+def run(dry_run=False, now=None, context=None):
+    s3 = aws_clients.s3
+    table = aws_clients.table(DDB_TABLE)
+    reader = VersionReader(table, s3, S3_BUCKET)
+    now = time.time() if now is None else now
+    dictionary = current_dictionary()
+    with instrumentation.stage('ddb_read'):
+        items = scan_versions(table)
+    candidates = []
+    for item in items:
+        item_tier = tier(item, now)
+        if item_tier and needs_recompression(item, item_tier, dictionary):
+            candidates.append((item_tier, item))
+    # Hot versions first (they are read now), then the largest cold ones (most to save)
+    candidates.sort(key=lambda candidate: (candidate[0] != 'hot', -stored_bytes(candidate[1])))
+    stats = {
+        'versions': len(items),
+        'hot_candidates': sum(1 for item_tier, _ in candidates if item_tier == 'hot'),
+        'cold_candidates': sum(1 for item_tier, _ in candidates if item_tier == 'cold'),
+        'recompressed': 0,
+        'not_worth_it': 0,
+        'conflicts': 0,
+        'failed': 0,
+        'bytes_before': 0,
+        'bytes_after': 0,
+        'bytes_saved': 0,
+        'superseded_deleted': 0,
+        'dry_run': dry_run
+    }
+    if not dry_run:
+        delete_superseded(s3, table, stats)
+    superseded = []
+    pacer = Pacer(RECOMPRESS_BYTES_PER_SECOND)
+    packable = []
+    for item_tier, item in candidates[:RECOMPRESS_MAX_VERSIONS]:
+        if context is not None and context.get_remaining_time_in_millis() < DEADLINE_MARGIN_MS:
+            break
+        try:
+            best = recompress(reader, item, item_tier, dictionary)
+        except Exception as e:
+            # One unreadable or undecodable version must not stop the run
+            logger.error(f"Failed to recompress note_id={item['note_id']}, version={item['version']}: {e}")
+            stats['failed'] += 1
+            continue
+        pacer.add(int(item.get('uncompressed_size') or 0))
+        if best is None:
+            stats['not_worth_it'] += 1
+            continue
+        if dry_run:
+            stats['recompressed'] += 1
+            stats['bytes_before'] += stored_bytes(item)
+            stats['bytes_after'] += len(best[1])
+        elif 0 < len(best[1]) <= note_packs.PACK_MAX_NOTE_BYTES:
+            packable.append((item_tier, item, best))
+        else:
+            store(s3, table, item, item_tier, best, stats, superseded)
+    if packable:
+        store_pack(s3, table, packable, stats, superseded)
+    if superseded:
+        record_superseded(s3, superseded)
+    stats['bytes_saved'] = stats['bytes_before'] - stats['bytes_after']
+    return stats
+
+
+def finish(table, item, item_tier, best, compressed_key, stats, superseded, pack_span=None):
+    encoding, stored, frames = best
+    if not switch(table, item, compressed_key, encoding, stored, frames, item_tier, pack_span):
+        stats['conflicts'] += 1
+        return False
+    stats['recompressed'] += 1
+    stats['bytes_before'] += stored_bytes(item)
+    stats['bytes_after'] += len(stored)
+    old = dict(item, compression_status='compressed', compressed_size=stored_bytes(item))
+    uncompressed_size = int(item['uncompressed_size'])
+    new = dict(old, compressed_size=len(stored),
+               compression_ratio=Decimal(len(stored)) / Decimal(uncompressed_size) if uncompressed_size else None)
+    metric_rollups.record(table, item['note_id'], new, old)
+    # Packs are reclaimed by compact_packs; shared objects are never rewritten here
+    if not note_packs.is_packed(item):
+        superseded.append({'note_id': item['note_id'], 'version': item['version'], 'key': item['compressed_key']})
+    return True
+
+
+def store(s3, table, item, item_tier, best, stats, superseded):
+    compressed_key = new_object_key(item)
+    try:
+        with instrumentation.stage('s3_put'):
+            s3.put_object(Bucket=S3_BUCKET, Key=compressed_key, Body=best[1])
+        if not finish(table, item, item_tier, best, compressed_key, stats, superseded):
+            with instrumentation.stage('s3_delete'):
+                s3.delete_object(Bucket=S3_BUCKET, Key=compressed_key)
+    except ClientError as e:
+        logger.error(f"Failed to recompress note_id={item['note_id']}, version={item['version']}: {e.response['Error']['Message']}")
+        stats['failed'] += 1
+    except Exception as e:
+        logger.error(f"Failed to recompress note_id={item['note_id']}, version={item['version']}: {e}")
+        stats['failed'] += 1
+
+
+def store_pack(s3, table, packable, stats, superseded):
+    pack_key = note_packs.new_pack_key()
+    data, spans = note_packs.build_pack([best[1] for _, _, best in packable])
+    try:
+        with instrumentation.stage('s3_put'):
+            s3.put_object(Bucket=S3_BUCKET, Key=pack_key, Body=data)
+    except ClientError as e:
+        logger.error(f"Failed to write pack {pack_key}: {e.response['Error']['Message']}")
+        stats['failed'] += len(packable)
+        return
+    for (item_tier, item, best), span in zip(packable, spans):
+        try:
+            finish(table, item, item_tier, best, pack_key, stats, superseded, span)
+        except ClientError as e:
+            logger.error(f"Failed to recompress note_id={item['note_id']}, version={item['version']}: {e.response['Error']['Message']}")
+            stats['failed'] += 1
+        except Exception as e:
+            logger.error(f"Failed to recompress note_id={item['note_id']}, version={item['version']}: {e}")
+            stats['failed'] += 1
+
+
+@instrumentation.instrumented('recompress_notes')
+def lambda_handler(event, context=None):
+    stats = run(dry_run=bool((event or {}).get('dry_run')), context=context)
+    instrumentation.annotate(**{key: value for key, value in stats.items() if key != 'dry_run'})
+    logger.info(f"Recompression: {json.dumps(stats)}")
+    return stats
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Recompress cold versions hard and hot versions fast")
+    parser.add_argument('--dry-run', action='store_true', help="compress candidates and report the savings without writing")
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s %(message)s')
+    print(json.dumps(run(dry_run=args.dry_run), indent=2))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,40 +1,199 @@
 import os
 import json
-import boto3
-import pyzstd as zstd
+import base64
+from urllib.parse import quote
 from botocore.exceptions import ClientError
 import logging
 import time 
 from decimal import Decimal, getcontext
+import aws_clients
+import instrumentation
+import post_invocation
+import note_frames
+import version_cache
+import read_metrics
+import version_chain
+import note_codec
+import note_packs
 
 # Environment variables (set in Lambda console or SAM/CloudFormation)
 S3_BUCKET = os.environ.get('NOTES_BUCKET', 'your-notes-bucket')
 DDB_TABLE = os.environ.get('NOTES_TABLE', 'your-notes-table')
-#COMPRESSION_ALGO = "TRAINED_ZSTD"
-#COMPRESSION_ALGO = "NONE"
-COMPRESSION_ALGO = "ZSTD"
+# Each version item records its codec (see note_codec), so reads don't depend on a deployment setting
+# Byte budget of the in-container cache of note versions (0 disables it)
+READ_CACHE_MAX_BYTES = int(os.environ.get('READ_CACHE_MAX_BYTES', str(64 * 1024 * 1024)))
+# 'decompressed' caches note content; 'compressed' caches the stored object and decompresses per read
+READ_CACHE_MODE = os.environ.get('READ_CACHE_MODE', 'decompressed')
+# Clients accepting zstd get notes whose stored object is at least this large as a presigned S3 URL
+PRESIGNED_READ_MIN_BYTES = int(os.environ.get('PRESIGNED_READ_MIN_BYTES', str(1024 * 1024)))
+# Seconds a presigned read URL stays valid
+PRESIGNED_URL_EXPIRY = int(os.environ.get('PRESIGNED_URL_EXPIRY', '60'))
 
-dynamodb = boto3.resource('dynamodb')
-table = dynamodb.Table(DDB_TABLE)
-s3 = boto3.client('s3')
+dynamodb = aws_clients.dynamodb
+table = aws_clients.table(DDB_TABLE)
+s3 = aws_clients.s3
 
 
 # Set up logging for Lambda/CloudWatch
 logger = logging.getLogger()
-logger.setLevel(logging.INFO)
+logger.setLevel(instrumentation.LOG_LEVEL)
 
-def get_dictionary_data():
-    response = s3.get_object(Bucket=S3_BUCKET, Key='notes/zstd_dictionary')
-    dictionary_data = response['Body'].read()
-    return dictionary_data
+# Versions never change after upload, so cached entries are served without revalidation
+note_cache = version_cache.VersionCache(READ_CACHE_MAX_BYTES)
+# Latency samples are aggregated per version and written to DynamoDB after invocations, off the request
+metrics_buffer = read_metrics.ReadMetricsBuffer(table)
 
+# Loads delta bases (and their own bases); decoded versions share the read cache
+reader = version_chain.VersionReader(table, s3, S3_BUCKET,
+                                     cache=note_cache if READ_CACHE_MODE == 'decompressed' and READ_CACHE_MAX_BYTES > 0 else None)
+
+def range_response(note_id, version, item, offset, note_bytes):
+    # offset/length are byte positions in the UTF-8 encoded note; a multi-byte character
+    # cut by either end of the range is dropped from the returned content
+    return {
+        'statusCode': 200,
+        'body': json.dumps({
+            'note_id': note_id,
+            'version': version,
+            'title': item.get('title', ''),
+            'offset': offset,
+            'length': len(note_bytes),
+            'total_size': int(item['uncompressed_size']) if item.get('uncompressed_size') is not None else None,
+            'content': str(note_bytes, 'utf-8', errors='ignore') if note_bytes else '',
+        })
+    }
+
+def accepts_zstd(event):
+    # Accept-Encoding lists zstd without q=0
+    headers = event.get('headers') or {}
+    value = next((value for name, value in headers.items() if name.lower() == 'accept-encoding'), None) or ''
+    for coding in value.split(','):
+        name, *parameters = coding.split(';')
+        if name.strip().lower() != 'zstd':
+            continue
+        for parameter in parameters:
+            key, _, weight = parameter.partition('=')
+            if key.strip().lower() == 'q':
+                try:
+                    return float(weight) > 0
+                except ValueError:
+                    return False
+        return True
+    return False
+
+
+def stored_size(item):
+    # Size of the stored object; estimated from the ratio for versions compressed before it was recorded
+    if item.get('compressed_size') is not None:
+        return int(item['compressed_size'])
+    if item.get('frames'):
+        return int(item['frames'][-1][0]) + int(item['frames'][-1][1])
+    if item.get('compression_ratio') is not None and item.get('uncompressed_size') is not None:
+        return int(item['compression_ratio'] * item['uncompressed_size'])
+    return 0
+
+
+def presigned_key(item, presign):
+    # The stored object to hand out as a presigned URL, or None to return the bytes. Packed
+    # versions are a byte range of a shared object, which a presigned URL can't express.
+    compressed_key = item.get('compressed_key') if item.get('inline_data') is None else None
+    if compressed_key and not note_packs.is_packed(item) and (presign or stored_size(item) >= PRESIGNED_READ_MIN_BYTES):
+        return compressed_key
+    return None
+
+
+def compressed_response(note_id, version, item, cached_data, presign, read_start):
+    # The stored zstd frames as a binary response (Content-Encoding: zstd), or a presigned URL
+    # to the S3 object, so the note is never decompressed or copied into JSON here. Returns
+    # None if the version is no longer stored as plain zstd, to be read the usual way.
+    if cached_data is not None and presigned_key(item, presign):
+        # recompress_notes and compact_packs move versions; a URL from a cached item could
+        # point at an object they have since deleted
+        with instrumentation.stage('ddb_read'):
+            item = reader.get_item(note_id, version)
+        if not note_codec.is_self_contained(item):
+            return None
+    compressed_key = presigned_key(item, presign)
+    if compressed_key:
+        with instrumentation.stage('presign'):
+            url = s3.generate_presigned_url('get_object', Params={
+                'Bucket': S3_BUCKET,
+                'Key': compressed_key,
+                'ResponseContentType': 'text/plain; charset=utf-8',
+                'ResponseContentEncoding': 'zstd'
+            }, ExpiresIn=PRESIGNED_URL_EXPIRY)
+        instrumentation.annotate(delivery='url')
+        return {
+            'statusCode': 200,
+            'headers': {'Content-Type': 'application/json', 'Vary': 'Accept-Encoding'},
+            'body': json.dumps({
+                'note_id': note_id,
+                'version': version,
+                'title': item.get('title', ''),
+                'url': url,
+                'content_encoding': 'zstd',
+                'compressed_size': stored_size(item),
+                'uncompressed_size': int(item['uncompressed_size']) if item.get('uncompressed_size') is not None else None,
+                'expires_in': PRESIGNED_URL_EXPIRY
+            })
+        }
+
+    if cached_data is not None and READ_CACHE_MODE == 'compressed':
+        data = cached_data
+    elif item.get('inline_data') is not None:
+        data = item['inline_data'].value
+    else:
+        try:
+            with instrumentation.stage('s3_get'):
+                try:
+                    data = note_packs.read_stored(s3, S3_BUCKET, item['compressed_key'], item)
+                except ClientError as e:
+                    if e.response['Error']['Code'] != 'NoSuchKey':
+                        raise
+                    # compact_packs or recompress_notes moved the version after its item was read
+                    item = reader.get_item(note_id, version)
+                    if not note_codec.is_self_contained(item):
+                        return None
+                    data = note_packs.read_stored(s3, S3_BUCKET, item['compressed_key'], item)
+        except ClientError as e:
+            logger.error(f"Failed to fetch note from S3: {e.response['Error']['Message']}")
+            return {
+                'statusCode': 500,
+                'body': json.dumps({'error': f'Failed to fetch note from S3: {e.response["Error"]["Message"]}'})
+            }
+        if cached_data is None and READ_CACHE_MAX_BYTES > 0 and READ_CACHE_MODE == 'compressed':
+            note_cache.put((note_id, version), item, data)
+    instrumentation.annotate(delivery='zstd')
+    metrics_buffer.record(note_id, version, size=item.get('uncompressed_size'), read_latency=Decimal(time.perf_counter() - read_start) * 1000)
+    headers = {
+        'Content-Type': 'text/plain; charset=utf-8',
+        'Content-Encoding': 'zstd',
+        'Vary': 'Accept-Encoding',
+        'X-Note-Id': quote(note_id),
+        'X-Note-Version': quote(version),
+        'X-Note-Title': quote(item.get('title', ''))
+    }
+    if item.get('uncompressed_size') is not None:
+        headers['X-Uncompressed-Size'] = str(int(item['uncompressed_size']))
+    with instrumentation.stage('serialize'):
+        body = base64.b64encode(data).decode('ascii')
+    return {
+        'statusCode': 200,
+        'headers': headers,
+        'body': body,
+        'isBase64Encoded': True
+    }
+
+
+@instrumentation.instrumented('retrieve_note')
+@post_invocation.handler
 def lambda_handler(event, context=None):
     # Parse query params for note_id and version
     read_start = time.perf_counter() #start time for read
     params = event.get('queryStringParameters', {})
     note_id = params.get('note_id')
     version = params.get('version')
-    logger.info(f"Received retrieval request: note_id={note_id}, version={version}")
+    instrumentation.annotate(note_id=note_id, version=version)
     if not note_id or not version:
         logger.error("Missing note_id or version in query params")
         return {
@@ -42,64 +201,140 @@ def lambda_handler(event, context=None):
             'body': json.dumps({'error': 'Missing note_id or version in query params'})
         }
 
-    # 1. Get metadata from DynamoDB
+    # Optional byte range of the uncompressed note (offset defaults to 0, length to the rest of the note)
     try:
-        logger.info(f"Fetching metadata from DynamoDB: table={DDB_TABLE}, note_id={note_id}, version={version}")
-        response = table.get_item(Key={'note_id': note_id, 'version': version})
-        item = response.get('Item')
-        if not item:
-            logger.warning(f"Note not found in DynamoDB: note_id={note_id}, version={version}")
+        offset = int(params['offset']) if params.get('offset') is not None else None
+        length = int(params['length']) if params.get('length') is not None else None
+        if (offset is not None and offset < 0) or (length is not None and length < 0):
+            raise ValueError("offset and length must not be negative")
+    except ValueError as e:
+        logger.error(f"Invalid range in query params: {e}")
+        return {
+            'statusCode': 400,
+            'body': json.dumps({'error': f'Invalid offset or length: {e}'})
+        }
+    ranged = offset is not None or length is not None
+    offset = offset or 0
+
+    # 1. Look up the version in the warm-container cache, else get metadata from DynamoDB
+    cached = note_cache.get((note_id, version)) if READ_CACHE_MAX_BYTES > 0 else None
+    if cached is not None:
+        item, cached_data = cached
+        instrumentation.annotate(cache_hit=True)
+    else:
+        try:
+            with instrumentation.stage('ddb_read'):
+                response = table.get_item(Key={'note_id': note_id, 'version': version})
+            item = response.get('Item')
+            if not item:
+                logger.warning(f"Note not found in DynamoDB: note_id={note_id}, version={version}")
+                return {
+                    'statusCode': 404,
+                    'body': json.dumps({'error': 'Note not found'})
+                }
+            if item.get('inline_data') is not None:
+                compressed_key = None  # small note stored inline on the item
+            elif item.get('compressed_key') or note_codec.is_compressing():
+                compressed_key = item.get('compressed_key')
+            else:
+                compressed_key = item.get('s3_key') # For NONE compression, use original s3_key
+            if not compressed_key and item.get('inline_data') is None:
+                logger.warning(f"Compressed note not found for note_id={note_id}, version={version}")
+                return {
+                    'statusCode': 404,
+                    'body': json.dumps({'error': 'Compressed note not found'})
+                }
+        except ClientError as e:
+            logger.error(f"Failed to fetch metadata from DynamoDB: {e.response['Error']['Message']}")
+            return {
+                'statusCode': 500,
+                'body': json.dumps({'error': f'Failed to fetch metadata: {e.response["Error"]["Message"]}'})
+            }
+
+    # Clients sending Accept-Encoding: zstd get notes any zstd decoder can read as stored
+    if not ranged and accepts_zstd(event) and note_codec.is_self_contained(item):
+        try:
+            response = compressed_response(note_id, version, item, cached_data if cached is not None else None,
+                                           params.get('delivery') == 'url', read_start)
+        except version_chain.VersionNotFound:
             return {
                 'statusCode': 404,
                 'body': json.dumps({'error': 'Note not found'})
             }
-        if (COMPRESSION_ALGO == "ZSTD") or (COMPRESSION_ALGO == "TRAINED_ZSTD"):
-            compressed_key = item.get('compressed_key')
+        if response is not None:
+            return response
+
+    # 2. Get compressed note from S3 (or the cache). For ranged reads only the frames (or raw
+    # bytes) covering the range are fetched; data_start is the uncompressed offset they start at.
+    compressed = note_codec.item_codec(item) != note_codec.CODEC_NONE
+    frames = item.get('frames')
+    data_start = 0
+    byte_range = None
+    if ranged and compressed and frames:
+        span = note_frames.frames_for_range(frames, offset, length if length is not None else float('inf'))
+        if span is None:
+            return range_response(note_id, version, item, offset, b'')
+        first, last, data_start = span
+        byte_range = note_frames.byte_range(frames, first, last)
+    elif ranged and not compressed:
+        data_start = offset
+        byte_range = (offset, offset + length - 1 if length is not None else None)
+        if length == 0:
+            return range_response(note_id, version, item, offset, b'')
+    note_bytes = None
+    if cached is not None:
+        if READ_CACHE_MODE == 'compressed' and compressed:
+            compressed_data = cached_data[byte_range[0]:byte_range[1] + 1] if byte_range else cached_data
         else:
-            compressed_key = item.get('s3_key') # For NONE compression, use original s3_key
-        if not compressed_key:
-            logger.warning(f"Compressed note not found for note_id={note_id}, version={version}")
+            note_bytes = cached_data
+            data_start = 0
+    elif item.get('inline_data') is not None:
+        compressed_data = item['inline_data'].value
+        data_start = 0
+    else:
+        try:
+            with instrumentation.stage('s3_get'):
+                try:
+                    compressed_data = note_packs.read_stored(s3, S3_BUCKET, compressed_key, item, byte_range)
+                except ClientError as e:
+                    if e.response['Error']['Code'] != 'NoSuchKey' or not item.get('compressed_key'):
+                        raise
+                    # compact_packs or recompress_notes moved the version after its item was read
+                    item = reader.get_item(note_id, version)
+                    compressed_key = item['compressed_key']
+                    compressed_data = note_packs.read_stored(s3, S3_BUCKET, compressed_key, item, byte_range)
+        except version_chain.VersionNotFound:
             return {
                 'statusCode': 404,
-                'body': json.dumps({'error': 'Compressed note not found'})
+                'body': json.dumps({'error': 'Note not found'})
+            }
+        except ClientError as e:
+            if e.response['Error']['Code'] == 'InvalidRange':
+                # Offset is past the end of an uncompressed note
+                return range_response(note_id, version, item, offset, b'')
+            logger.error(f"Failed to fetch note from S3: {e.response['Error']['Message']}")
+            return {
+                'statusCode': 500,
+                'body': json.dumps({'error': f'Failed to fetch note from S3: {e.response["Error"]["Message"]}'})
             }
-        logger.info(f"Found compressed_key in DynamoDB: {compressed_key}")
-    except ClientError as e:
-        logger.error(f"Failed to fetch metadata from DynamoDB: {e.response['Error']['Message']}")
-        return {
-            'statusCode': 500,
-            'body': json.dumps({'error': f'Failed to fetch metadata: {e.response["Error"]["Message"]}'})
-        }
-
-    # 2. Get compressed note from S3
-    try:
-        logger.info(f"Fetching compressed note from S3: bucket={S3_BUCKET}, key={compressed_key}")
-        s3_obj = s3.get_object(Bucket=S3_BUCKET, Key=compressed_key)
-        compressed_data = s3_obj['Body'].read()
-        logger.info(f"Successfully fetched compressed note from S3: {compressed_key}")
-    except ClientError as e:
-        logger.error(f"Failed to fetch note from S3: {e.response['Error']['Message']}")
-        return {
-            'statusCode': 500,
-            'body': json.dumps({'error': f'Failed to fetch note from S3: {e.response["Error"]["Message"]}'})
-        }
 
     # 3. Decompress note if required and measure latency
-    if (COMPRESSION_ALGO == "ZSTD") or (COMPRESSION_ALGO == "TRAINED_ZSTD"):
+    reconstruction_latency = None
+    if note_bytes is not None:
+        decompression_latency = None  # served decompressed from the cache
+    elif compressed:
         try:
-            logger.info(f"Decompressing note for note_id={note_id}, version={version}")
+            base_content = None
+            if item.get('delta_base') is not None:
+                # Delta version: rebuild the chain of earlier versions it was compressed against
+                start_time = time.perf_counter()
+                with instrumentation.stage('reconstruct'):
+                    base_content = reader.load(note_id, item['delta_base'])
+                reconstruction_latency = Decimal(time.perf_counter() - start_time) * 1000  # milliseconds
             start_time = time.perf_counter()
-            if COMPRESSION_ALGO == "ZSTD":
-                note_data = zstd.decompress(compressed_data).decode('utf-8')
-            elif COMPRESSION_ALGO == "TRAINED_ZSTD":
-                dict_data = get_dictionary_data()  # Function to fetch your trained dictionary data
-                zstd_dict = zstd.ZstdDict(dict_data)
-                decompressor = zstd.ZstdDecompressor(zstd_dict=zstd_dict)
-                note_data = decompressor.decompress(compressed_data).decode('utf-8')
-            else:
-                raise Exception("Unsupported compression algorithm")
+            with instrumentation.stage('decompress'):
+                note_bytes = note_codec.decompress(item, compressed_data, base_content)
             decompression_latency = Decimal(time.perf_counter() - start_time) * 1000  # milliseconds
-            logger.info(f"Successfully decompressed note for note_id={note_id}, version={version}. Latency: {decompression_latency:.6f} ms")
         except Exception as e:
             logger.error(f"Failed to decompress note: {e}")
             return {
@@ -107,40 +342,36 @@ def lambda_handler(event, context=None):
                 'body': json.dumps({'error': f'Failed to decompress note: {e}'})
             }
     else:
-        note_data = compressed_data.decode('utf-8')
+        note_bytes = compressed_data
         decompression_latency = 0
-        logger.info(f"No decompression needed for note_id={note_id}, version={version}")
-   
+
+    if ranged:
+        # Latency metrics describe whole-note reads, so partial reads are not recorded
+        start = offset - data_start
+        end = start + length if length is not None else None
+        return range_response(note_id, version, item, offset, note_bytes[start:end])
+
+    if cached is None and READ_CACHE_MAX_BYTES > 0:
+        note_cache.put((note_id, version), item, compressed_data if READ_CACHE_MODE == 'compressed' else note_bytes)
+
+    note_data = str(note_bytes, 'utf-8')  # note_bytes may be a memoryview (local backend)
     read_end = time.perf_counter() #end time for read
     read_latency = Decimal(read_end - read_start) * 1000  # Convert to milliseconds
     
-    # 4. Update DynamoDB with decompression latency and read latency
-    try:
-        logger.info(f"Updating DynamoDB with decompression latency and read latency for note_id={note_id}, version={version}")
-        table.update_item(
-            Key={'note_id': note_id, 'version': version},
-            UpdateExpression="SET decompression_latency = :lat",
-            ExpressionAttributeValues={':lat': decompression_latency}
-        )
-        table.update_item(
-            Key={'note_id': note_id, 'version': version},
-            UpdateExpression="SET read_latency = :lat",
-            ExpressionAttributeValues={':lat': read_latency}
-        )
-        logger.info(f"Successfully updated decompression latency and read latency in DynamoDB for note_id={note_id}, version={version}")
-    except ClientError as e:
-        logger.error(f"Failed to update decompression latency in DynamoDB: {e.response['Error']['Message']}")
-        # Do not fail the request if latency update fails
+    # 4. Record decompression, reconstruction and read latency (flushed to DynamoDB after the response)
+    metrics_buffer.record(note_id, version, size=item.get('uncompressed_size'), decompression_latency=decompression_latency,
+                          read_latency=read_latency, reconstruction_latency=reconstruction_latency)
 
     # 5. Return note content
-    logger.info(f"Returning note content for note_id={note_id}, version={version}")
-    return {
-        'statusCode': 200,
-        'body': json.dumps({
+    with instrumentation.stage('serialize'):
+        body = json.dumps({
             'note_id': note_id,
             'version': version,
             'title': item.get('title', ''),
             'content': note_data,
             #'decompression_latency': float(decompression_latency)
         })
+    return {
+        'statusCode': 200,
+        'body': body
     }
@@ -1,63 +1,266 @@
-import requests
-import logging
+import os
+import sys
+import json
 import time
 import random
-import json
+import logging
+import pathlib
+import argparse
 import pyzstd
+import aws_clients
+import note_frames
+import note_blobs
+import metric_rollups
+import zstd_dictionaries
+from version_chain import VersionReader, VersionNotFound
 
-from client import SAMPLE_URL
+# Trains zstd dictionaries on a stratified sample of notes, evaluates every
+# (dictionary size, level) candidate on a holdout set against plain zstd, writes a
+# report and optionally publishes the winner for TRAINED_ZSTD / ADAPTIVE mode:
+#
+#   python train.py --corpus-dir ./notes --report report.json
+#   python train.py --publish            # sample stored notes from NOTES_TABLE / NOTES_BUCKET
 
-#API_GATEWAY_URL = "https://d22dme7p69.execute-api.ap-south-1.amazonaws.com/production_retrieve/notes"  # Update with your actual endpoint
-#RETRIEVE_NOTE_URL = "https://d22dme7p69.execute-api.ap-south-1.amazonaws.com/production_retrieve/retrieve"  # Update with your actual endpoint for retrieval
+DDB_TABLE = os.environ.get('NOTES_TABLE', 'your-notes-table')
+S3_BUCKET = os.environ.get('NOTES_BUCKET', 'your-notes-bucket')
 
-SAMPLE_URLS = ["https://www.gutenberg.org/files/1342/1342-0.txt",
-               "https://www.gutenberg.org/files/2701/2701-0.txt",
-               "https://www.gutenberg.org/files/84/84-0.txt",
-               "https://www.gutenberg.org/files/100/100-0.txt",
-               "https://www.gutenberg.org/files/2641/2641-0.txt",
-               "https://www.gutenberg.org/files/37106/37106-0.txt",
-               "https://www.gutenberg.org/files/98/98-0.txt",
-               "https://www.gutenberg.org/files/1400/1400-0.txt",
-               "https://www.gutenberg.org/files/768/768-0.txt",
-               "https://www.gutenberg.org/files/2554/2554-0.txt"]
+# Upper bounds of the note size buckets used for stratified sampling (last bucket is open)
+SIZE_BUCKETS = [1024, 4 * 1024, 16 * 1024, 64 * 1024, None]
+DEFAULT_DICT_SIZES = [16 * 1024, 64 * 1024, 110 * 1024]
+DEFAULT_LEVELS = [3, 9, 19]
 
-# Set up logging for Lambda/CloudWatch
 logger = logging.getLogger()
-logger.setLevel(logging.INFO)
-logging.basicConfig(level=logging.INFO,filename="training.log",encoding='utf-8')
-
-filepath = "/Users/nikhilniranjan/andromeda/training-files/"
-data_files_count = 10
-training_set_count = 10000
-training_note_size = 500
-sample_text = []
-samples = []
-
-# Download sample text
-for i in range(len(SAMPLE_URLS)):
-    response = requests.get(SAMPLE_URLS[i])
-    sample_text.append(response.text)
-    print(len(sample_text[i]))
-    
-for i in range(training_set_count):
-    note_length = random.randint(100, training_note_size)
-    #vary start point randomly
-    which_file = random.randint(0, data_files_count - 1)
-    start_point = random.randint(0, len(sample_text[which_file]) - note_length)
-    content = sample_text[which_file][start_point:start_point + note_length]
-    samples.append(b"content")
-
-    #filename = f"{filepath}{str(i)}.txt"
-    #with open(filename, "w", encoding="utf-8") as f:
-        #f.write(content)
-        
-    dictionary_data = pyzstd.train_dict(samples, dict_size = 1024)
-    
-    with open(f"{filepath}zstd_dictionary_110kB", "wb") as f:
-        f.write(dictionary_data)
-        
-        
-
-
-        
-        
+logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s %(message)s')
+
+
+def size_bucket(size):
+    for index, upper_bound in enumerate(SIZE_BUCKETS):
+        if upper_bound is None or size <= upper_bound:
+            return index
+
+
+def bucket_label(index):
+    lower = SIZE_BUCKETS[index - 1] if index else 0
+    upper = SIZE_BUCKETS[index]
+    return f"{lower}-{upper}" if upper is not None else f">{lower}"
+
+
+def corpus_notes(corpus_dir):
+    # (name, size, loader) for every file below corpus_dir
+    for root, _, files in os.walk(corpus_dir):
+        for name in files:
+            path = os.path.join(root, name)
+            yield path, os.path.getsize(path), lambda path=path: pathlib.Path(path).read_bytes()
+
+
+def stored_notes(table, reader):
+    # (name, size, loader) for every stored version; content is only read for sampled versions
+    kwargs = {
+        'ProjectionExpression': '#n, #v, #s',
+        'ExpressionAttributeNames': {'#n': 'note_id', '#v': 'version', '#s': 'uncompressed_size'}
+    }
+    while True:
+        response = table.scan(**kwargs)
+        for item in response.get('Items', []):
+            # Shared blobs and metric rollups are not note versions (blobs hold content another
+            # version already stored)
+            if item.get('uncompressed_size') is None or note_blobs.is_blob_item(item) or \
+                    metric_rollups.is_rollup_item(item):
+                continue
+            note_id, version = item['note_id'], item['version']
+            yield f"{note_id}/{version}", int(item['uncompressed_size']), \
+                lambda note_id=note_id, version=version: reader.load(note_id, version)
+        if 'LastEvaluatedKey' not in response:
+            return
+        kwargs['ExclusiveStartKey'] = response['LastEvaluatedKey']
+
+
+def stratified_sample(notes, per_bucket, holdout_fraction, rng):
+    # Reservoir-samples up to per_bucket notes from each size bucket, then splits every
+    # bucket into training and holdout notes so both sets cover all sizes
+    reservoirs = [[] for _ in SIZE_BUCKETS]
+    seen = [0] * len(SIZE_BUCKETS)
+    for note in notes:
+        if note[1] == 0:
+            continue
+        bucket = size_bucket(note[1])
+        seen[bucket] += 1
+        if len(reservoirs[bucket]) < per_bucket:
+            reservoirs[bucket].append(note)
+        else:
+            slot = rng.randrange(seen[bucket])
+            if slot < per_bucket:
+                reservoirs[bucket][slot] = note
+    training, holdout = [], []
+    for bucket, sampled in enumerate(reservoirs):
+        rng.shuffle(sampled)
+        held = int(round(len(sampled) * holdout_fraction)) if len(sampled) > 1 else 0
+        for index, (name, _, load) in enumerate(sampled):
+            try:
+                content = load()
+            except (OSError, VersionNotFound) as e:
+                logger.warning(f"Skipping {name}: {e}")
+                continue
+            (holdout if index < held else training).append((bucket, content))
+        logger.info(f"Bucket {bucket_label(bucket)}: {seen[bucket]} notes, sampled {len(sampled)}, holdout {held}")
+    return training, holdout
+
+
+def training_samples(notes):
+    # Notes are compressed frame by frame, so the dictionary is trained on frame-sized pieces
+    samples = []
+    for _, content in notes:
+        for start in range(0, len(content), note_frames.FRAME_SIZE):
+            samples.append(content[start:start + note_frames.FRAME_SIZE])
+    return samples
+
+
+def evaluate(notes, compress, decompress):
+    # Compresses each holdout note the way compress_notes stores it and decodes it frame by frame
+    result = {'uncompressed_bytes': 0, 'compressed_bytes': 0, 'compress_seconds': 0.0, 'decompress_seconds': 0.0,
+              'buckets': {}}
+    for bucket, content in notes:
+        start = time.perf_counter()
+        compressed, frames = note_frames.compress_frames(content, compress)
+        result['compress_seconds'] += time.perf_counter() - start
+        start = time.perf_counter()
+        for offset, length, _ in frames:
+            decompress(compressed[offset:offset + length])
+        result['decompress_seconds'] += time.perf_counter() - start
+        result['uncompressed_bytes'] += len(content)
+        result['compressed_bytes'] += len(compressed)
+        totals = result['buckets'].setdefault(bucket_label(bucket), [0, 0])
+        totals[0] += len(content)
+        totals[1] += len(compressed)
+    megabytes = result['uncompressed_bytes'] / (1024 * 1024)
+    return {
+        'ratio': result['compressed_bytes'] / result['uncompressed_bytes'],
+        'compressed_bytes': result['compressed_bytes'],
+        'compress_mb_s': megabytes / result['compress_seconds'] if result['compress_seconds'] else None,
+        'decompress_mb_s': megabytes / result['decompress_seconds'] if result['decompress_seconds'] else None,
+        'bucket_ratios': {label: compressed / size for label, (size, compressed) in result['buckets'].items()}
+    }
+
+
+def run(training, holdout, dict_sizes, levels, min_compress_mb_s=0):
+    samples = training_samples(training)
+    logger.info(f"Training on {len(samples)} samples from {len(training)} notes, evaluating on {len(holdout)} notes")
+    report = {
+        'training_notes': len(training),
+        'training_samples': len(samples),
+        'holdout_notes': len(holdout),
+        'holdout_bytes': sum(len(content) for _, content in holdout),
+        'frame_size': note_frames.FRAME_SIZE,
+        'baseline': {},
+        'candidates': []
+    }
+    for level in levels:
+        report['baseline'][str(level)] = evaluate(holdout, lambda data, level=level: pyzstd.compress(data, level),
+                                                  pyzstd.decompress)
+    dictionaries = {}
+    for dict_size in dict_sizes:
+        try:
+            trained = pyzstd.train_dict(samples, dict_size)
+        except pyzstd.ZstdError as e:
+            logger.warning(f"Training a {dict_size} byte dictionary failed: {e}")
+            continue
+        dictionary = zstd_dictionaries.ZstdDictionary(trained.dict_content, None)
+        dictionaries[dictionary.dictionary_id] = trained.dict_content
+        for level in levels:
+            candidate = evaluate(holdout, lambda data, level=level: dictionary.compress(data, level), dictionary.decompress)
+            candidate.update({
+                'dictionary_id': dictionary.dictionary_id,
+                'dict_size': dict_size,
+                'dictionary_bytes': len(trained.dict_content),
+                'level': level,
+                'baseline_ratio': report['baseline'][str(level)]['ratio']
+            })
+            report['candidates'].append(candidate)
+    # The smallest output wins; a candidate only qualifies if it beats plain zstd at its level
+    # and compresses fast enough for compress_notes
+    qualifying = [c for c in report['candidates']
+                  if c['ratio'] < c['baseline_ratio'] and (c['compress_mb_s'] or 0) >= min_compress_mb_s]
+    winner = min(qualifying, key=lambda c: (c['ratio'], -(c['compress_mb_s'] or 0)), default=None)
+    report['min_compress_mb_s'] = min_compress_mb_s
+    report['winner'] = winner
+    return report, dictionaries
+
+
+def print_report(report):
+    print(f"{'dict':>8} {'level':>5} {'ratio':>7} {'plain':>7} {'comp MB/s':>10} {'decomp MB/s':>12}")
+    for c in report['candidates']:
+        print(f"{c['dict_size']:>8} {c['level']:>5} {c['ratio']:>7.3f} {c['baseline_ratio']:>7.3f} "
+              f"{c['compress_mb_s'] or 0:>10.1f} {c['decompress_mb_s'] or 0:>12.1f}")
+    winner = report['winner']
+    if winner:
+        print(f"Winner: dictionary {winner['dictionary_id']} ({winner['dict_size']} bytes) at level {winner['level']}")
+    else:
+        print("No dictionary beat plain zstd on the holdout set at the required speed")
+
+
+def publish(s3, report, dictionaries):
+    # New dictionaries get their own key, so notes compressed with earlier ones stay readable;
+    # the pointer switches new writes over within ZSTD_DICTIONARY_REFRESH_SECONDS
+    winner = report['winner']
+    dictionary_id = winner['dictionary_id']
+    key = zstd_dictionaries.dictionary_key(dictionary_id)
+    s3.put_object(Bucket=S3_BUCKET, Key=key, Body=dictionaries[dictionary_id])
+    report_key = f"{zstd_dictionaries.ZSTD_DICTIONARY_PREFIX}reports/{dictionary_id}.json"
+    s3.put_object(Bucket=S3_BUCKET, Key=report_key, Body=json.dumps(report, indent=2).encode('utf-8'),
+                  ContentType='application/json')
+    pointer = {
+        'dictionary_id': dictionary_id,
+        'level': winner['level'],
+        'key': key,
+        'report_key': report_key,
+        'published_at': int(time.time())
+    }
+    s3.put_object(Bucket=S3_BUCKET, Key=zstd_dictionaries.ZSTD_DICTIONARY_POINTER_KEY,
+                  Body=json.dumps(pointer).encode('utf-8'), ContentType='application/json')
+    logger.info(f"Published zstd dictionary {dictionary_id} to s3://{S3_BUCKET}/{key}")
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description="Train, evaluate and publish zstd dictionaries for notes")
+    parser.add_argument('--corpus-dir', help="train on files in this directory instead of stored notes")
+    parser.add_argument('--per-bucket', type=int, default=2000, help="notes sampled per size bucket")
+    parser.add_argument('--holdout', type=float, default=0.2, help="fraction of each bucket held out for evaluation")
+    parser.add_argument('--dict-sizes', type=int, nargs='+', default=DEFAULT_DICT_SIZES)
+    parser.add_argument('--levels', type=int, nargs='+', default=DEFAULT_LEVELS)
+    parser.add_argument('--min-compress-mbps', type=float, default=10.0,
+                        help="ignore candidates compressing the holdout set slower than this")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--report', default='dictionary_report.json', help="where to write the JSON report")
+    parser.add_argument('--publish', action='store_true', help="upload the winner and make it current")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    rng = random.Random(args.seed)
+    s3 = aws_clients.s3
+    if args.corpus_dir:
+        notes = corpus_notes(args.corpus_dir)
+    else:
+        table = aws_clients.table(DDB_TABLE)
+        notes = stored_notes(table, VersionReader(table, s3, S3_BUCKET))
+    training, holdout = stratified_sample(notes, args.per_bucket, args.holdout, rng)
+    if not training or not holdout:
+        logger.error("Not enough notes to train and evaluate a dictionary")
+        return 1
+
+    report, dictionaries = run(training, holdout, args.dict_sizes, args.levels, args.min_compress_mbps)
+    with open(args.report, 'w', encoding='utf-8') as f:
+        json.dump(report, f, indent=2)
+    print_report(report)
+
+    if args.publish:
+        if report['winner'] is None:
+            logger.error("Nothing published: no dictionary beat plain zstd")
+            return 1
+        publish(s3, report, dictionaries)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
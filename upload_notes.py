@@ -1,42 +1,223 @@
 
 import os
 import json
-import boto3
 from botocore.exceptions import ClientError
+from decimal import Decimal
 import logging
+import aws_clients
+import instrumentation
+import metric_rollups
+import post_invocation
+import note_blobs
+import note_codec
 
 # Environment variables (set in Lambda console or SAM/CloudFormation)
 S3_BUCKET = os.environ.get('NOTES_BUCKET', 'your-notes-bucket')
 DDB_TABLE = os.environ.get('NOTES_TABLE', 'your-notes-table')
 SQS_QUEUE_URL = os.environ.get('NOTES_QUEUE_URL', 'https://sqs.region.amazonaws.com/123456789012/your-queue')
-#COMPRESSION_ALGO = "TRAINED_ZSTD"
-#COMPRESSION_ALGO = "NONE"
-COMPRESSION_ALGO = "ZSTD"
+# Codec policy for new versions is note_codec.COMPRESSION_ALGO (COMPRESSION_ALGO env variable)
+# Notes up to this many bytes are compressed synchronously and stored inline in DynamoDB (0 disables)
+INLINE_MAX_BYTES = int(os.environ.get('INLINE_MAX_BYTES', '4096'))
+# Notes up to this many bytes are compressed by this handler and stored in final form, skipping the
+# raw upload, the SQS job and compress_notes (0 disables). Compression time grows with size, so
+# this bounds the CPU and latency added to an upload; larger notes take the queue.
+INGEST_COMPRESS_MAX_BYTES = int(os.environ.get('INGEST_COMPRESS_MAX_BYTES', '0'))
+# Seconds a presigned upload URL stays valid ("upload": "presigned" requests)
+PRESIGNED_UPLOAD_EXPIRY = int(os.environ.get('PRESIGNED_UPLOAD_EXPIRY', '900'))
 
-s3 = boto3.client('s3')
-dynamodb = boto3.resource('dynamodb')
-table = dynamodb.Table(DDB_TABLE)
-sqs = boto3.client('sqs')
+s3 = aws_clients.s3
+table = aws_clients.table(DDB_TABLE)
+sqs = aws_clients.sqs
 
 # Set up logging for Lambda/CloudWatch
 logger = logging.getLogger()
-logger.setLevel(logging.INFO)
+logger.setLevel(instrumentation.LOG_LEVEL)
 
+# Rollup changes of stored versions, added after the response
+rollup_buffer = metric_rollups.RollupBuffer(table)
 
 
+def put_version(item):
+	# Writes a version item and queues moving the metric rollups from the version it replaces, if any
+	with instrumentation.stage('ddb_write'):
+		response = table.put_item(Item=item, ReturnValues='ALL_OLD')
+	rollup_buffer.add(metric_rollups.changes(item['note_id'], item, response.get('Attributes')))
 
+
+def is_reserved_id(note_id):
+	# Blob and rollup items share the notes table
+	return str(note_id).startswith((note_blobs.BLOB_ID_PREFIX, metric_rollups.ROLLUP_ID_PREFIX))
+
+
+def note_key(note_id, version):
+	return f"notes/{note_id}_v{version}.txt"
+
+
+def upload_key(note_id, version):
+	# Presigned uploads land under uploads/, whose S3 object-created events go to the compression queue
+	return f"uploads/{note_id}/{version}.txt"
+
+
+def parse_upload_key(s3_key):
+	# (note_id, version) of an upload_key; the version is the last path segment
+	note_id, _, name = s3_key[len('uploads/'):].rpartition('/')
+	if not s3_key.startswith('uploads/') or not note_id or not name.endswith('.txt'):
+		raise ValueError(f"not an upload key: {s3_key}")
+	return note_id, name[:-len('.txt')]
+
+
+def inline_item(note_id, version, title, note_data):
+	# Small notes skip S3 and the SQS compression pipeline: the compressed bytes are kept on
+	# the version item, so retrieve_note serves them with a single get_item
+	with instrumentation.stage('compress'):
+		encoding = note_codec.choose_encoding(note_data)
+		compressed = encoding.compress(note_data)
+	item = {
+		'note_id': note_id,
+		'version': version,
+		'title': title,
+		'status': 'uploaded',
+		'storage': 'inline',
+		'inline_data': compressed,
+		'compression_status': 'compressed',
+		'compression_ratio': Decimal(len(compressed)) / Decimal(len(note_data)) if note_data else None,
+		'uncompressed_size': len(note_data)
+	}
+	item.update(encoding.metadata())
+	return item
+
+
+def metadata_item(note_id, version, title, s3_key, size=None):
+	item = {
+		'note_id': note_id,
+		'version': version,
+		's3_key': s3_key,
+		'title': title,
+		# 'author': author,
+		'status': 'uploaded'
+	}
+	if size is not None:
+		# Known before compression, so bulk_retrieve_notes can budget raw versions too
+		item['uncompressed_size'] = size
+	return item
+
+
+def compression_message(note_id, version, s3_key):
+	return json.dumps({'note_id': note_id, 'version': version, 's3_key': s3_key})
+
+
+def is_inline(note_data):
+	return note_codec.is_compressing() and len(note_data) <= INLINE_MAX_BYTES
+
+
+def is_ingest_compressed(note_data):
+	return note_codec.is_compressing() and len(note_data) <= INGEST_COMPRESS_MAX_BYTES
+
+
+def content_digest(note_data):
+	# Content hash of notes that are deduplicated (see note_blobs), else None
+	if note_codec.is_compressing() and note_blobs.is_dedupable(len(note_data)):
+		return note_blobs.content_hash(note_data)
+	return None
+
+
+def store_deduplicated(note_id, version, title, digest):
+	# A note whose content is already stored as a blob is recorded as a reference to it, with no
+	# S3 write and no compression job. Returns the blob's key, or None if there is no blob.
+	try:
+		shared = note_blobs.claim(table, digest)
+	except ClientError as e:
+		logger.warning(f"Failed to look up blob {digest}: {e.response['Error']['Message']}")
+		return None
+	if shared is None:
+		return None
+	item = metadata_item(note_id, version, title, note_key(note_id, version))
+	item['compressed_key'] = shared.pop('compressed_key')
+	item.update(shared)
+	put_version(item)
+	return item['compressed_key']
+
+
+def store_compressed(note_id, version, title, note_data, digest=None):
+	# Compress-at-ingest: the same encoding compress_notes would choose (delta bases included),
+	# written straight to the .zst key with the final metadata. Returns the stored object's key.
+	import compress_notes  # imported here: compress_notes imports this module
+	encoding, stored, attributes = compress_notes.encode_note(note_id, version, note_data)
+	s3_key = note_key(note_id, version)
+	compressed_key = None
+	if digest is not None:
+		attributes['content_hash'] = digest
+		if note_blobs.is_shareable(attributes):
+			compressed_key = note_blobs.store(s3, S3_BUCKET, table, digest, stored, attributes)
+	if compressed_key is None:
+		compressed_key = s3_key if encoding.codec == note_codec.CODEC_NONE else s3_key.replace('.txt', '.zst')
+		with instrumentation.stage('s3_put'):
+			s3.put_object(Bucket=S3_BUCKET, Key=compressed_key, Body=stored)
+	item = metadata_item(note_id, version, title, s3_key)
+	item['compressed_key'] = compressed_key
+	item.update(attributes)
+	put_version(item)
+	compress_notes.remember_base(note_id, version, note_data, attributes)
+	return compressed_key
+
+
+def reserve_upload(method, note_id, version, title):
+	# Large notes skip this Lambda: the version is recorded as awaiting its content and the
+	# client PUTs the note straight to S3. The object-created event enqueues compression.
+	s3_key = upload_key(note_id, version)
+	item = metadata_item(note_id, version, title, s3_key)
+	item['status'] = 'awaiting_upload'
+	try:
+		put_version(item)
+	except ClientError as e:
+		logger.error(f"Failed to store metadata in DynamoDB: {e.response['Error']['Message']}")
+		return {
+			'statusCode': 500,
+			'body': json.dumps({'error': f"Failed to store metadata in DynamoDB: {e.response['Error']['Message']}"})
+		}
+	with instrumentation.stage('presign'):
+		upload_url = s3.generate_presigned_url(
+			'put_object',
+			Params={'Bucket': S3_BUCKET, 'Key': s3_key},
+			ExpiresIn=PRESIGNED_UPLOAD_EXPIRY
+		)
+	instrumentation.annotate(storage='presigned')
+	return {
+		'statusCode': 200,
+		'body': json.dumps({
+			'message': f'Note {"update" if method == "PUT" else "upload"} reserved, PUT the content to upload_url',
+			'note_id': note_id,
+			'version': version,
+			's3_key': s3_key,
+			'upload_url': upload_url,
+			'upload_method': 'PUT',
+			'expires_in': PRESIGNED_UPLOAD_EXPIRY
+		})
+	}
+
+
+def store_inline(note_id, version, title, note_data):
+	put_version(inline_item(note_id, version, title, note_data))
+
+
+@instrumentation.instrumented('upload_notes')
+@post_invocation.handler
 def lambda_handler(event, context=None):
 	# Support both POST (create) and PUT (update) requests
 	method = event.get('httpMethod', 'POST')
-	logger.info(f"Received {method} request: {event}")
 	try:
-		body = event['body'] if isinstance(event['body'], dict) else json.loads(event['body'])
+		with instrumentation.stage('parse'):
+			body = event['body'] if isinstance(event['body'], dict) else json.loads(event['body'])
 		note_id = body['note_id']
+		if is_reserved_id(note_id):
+			raise ValueError(f"note_id must not start with {note_blobs.BLOB_ID_PREFIX} or {metric_rollups.ROLLUP_ID_PREFIX}")
 		version = str(body.get('version', '1'))  # Default to version 1 if not provided
-		content = body['content']
+		if body.get('upload') not in (None, 'presigned'):
+			raise ValueError("upload must be 'presigned'")
+		# "upload": "presigned" requests carry no content, it is PUT to S3 afterwards
+		content = body['content'] if body.get('upload') is None else None
 		title = body.get('title', '')
 		#author = body.get('author', '')
-		logger.info(f"Parsed input: note_id={note_id}, version={version}, title={title}")
 	except Exception as e:
 		logger.error(f"Invalid input: {e}")
 		return {
@@ -44,56 +225,110 @@ def lambda_handler(event, context=None):
 			'body': json.dumps({'error': f'Invalid input: {e}'})
 		}
 
+	if content is None:
+		instrumentation.annotate(method=method, note_id=note_id, version=version)
+		logger.info(f"Received presigned {method} request: note_id={note_id}, version={version}")
+		return reserve_upload(method, note_id, version, title)
+
+	note_data = content.encode('utf-8')
+	instrumentation.annotate(method=method, note_id=note_id, version=version, size=len(note_data))
+	logger.info(f"Received {method} request: note_id={note_id}, version={version}, size={len(note_data)}")
+	if is_inline(note_data):
+		try:
+			store_inline(note_id, version, title, note_data)
+		except ClientError as e:
+			logger.error(f"Failed to store note inline in DynamoDB: {e.response['Error']['Message']}")
+			return {
+				'statusCode': 500,
+				'body': json.dumps({'error': f"Failed to store note in DynamoDB: {e.response['Error']['Message']}"})
+			}
+		instrumentation.annotate(storage='inline')
+		return {
+			'statusCode': 200,
+			'body': json.dumps({
+				'message': f'Note {"updated" if method == "PUT" else "uploaded"} successfully',
+				'note_id': note_id,
+				'version': version,
+				's3_key': None
+			})
+		}
+
+	compressed_key = None
+	storage = None
+	digest = content_digest(note_data)
+	if digest is not None:
+		try:
+			compressed_key = store_deduplicated(note_id, version, title, digest)
+		except ClientError as e:
+			logger.error(f"Failed to store metadata in DynamoDB: {e.response['Error']['Message']}")
+			return {
+				'statusCode': 500,
+				'body': json.dumps({'error': f"Failed to store metadata in DynamoDB: {e.response['Error']['Message']}"})
+			}
+		storage = 'dedupe'
+	if compressed_key is None and is_ingest_compressed(note_data):
+		try:
+			compressed_key = store_compressed(note_id, version, title, note_data, digest)
+			storage = 'ingest'
+		except ClientError as e:
+			logger.error(f"Failed to store compressed note: {e.response['Error']['Message']}")
+			return {
+				'statusCode': 500,
+				'body': json.dumps({'error': f"Failed to store note: {e.response['Error']['Message']}"})
+			}
+		except Exception as e:
+			# e.g. the trained dictionary could not be loaded; compress_notes retries it from the queue
+			logger.warning(f"Compression at ingest failed for note_id={note_id}, version={version}, queueing it: {e}")
+	if compressed_key is not None:
+		instrumentation.annotate(storage=storage)
+		return {
+			'statusCode': 200,
+			'body': json.dumps({
+				'message': f'Note {"updated" if method == "PUT" else "uploaded"} successfully',
+				'note_id': note_id,
+				'version': version,
+				's3_key': compressed_key
+			})
+		}
+
 	# 1. Store note in S3 (versioned key)
-	s3_key = f"notes/{note_id}_v{version}.txt"
+	s3_key = note_key(note_id, version)
 	try:
-		logger.info(f"Storing note in S3: bucket={S3_BUCKET}, key={s3_key}")
-		s3.put_object(Bucket=S3_BUCKET, Key=s3_key, Body=content.encode('utf-8'))
-		logger.info(f"Successfully stored note in S3: {s3_key}")
+		with instrumentation.stage('s3_put'):
+			s3.put_object(Bucket=S3_BUCKET, Key=s3_key, Body=note_data)
 	except ClientError as e:
 		logger.error(f"Failed to store note in S3: {e.response['Error']['Message']}")
 		return {
 			'statusCode': 500,
-			'body': json.dumps({'error': f'Failed to store note in S3: {e.response['Error']['Message']}'})
+			'body': json.dumps({'error': f"Failed to store note in S3: {e.response['Error']['Message']}"})
 		}
 
 	# 2. Store/update metadata in DynamoDB (versioned)
 	try:
-		logger.info(f"Storing metadata in DynamoDB: table={DDB_TABLE}, note_id={note_id}, version={version}")
-		table.put_item(Item={
-			'note_id': note_id,
-			'version': version,
-			's3_key': s3_key,
-			'title': title,
-			# 'author': author,
-			'status': 'uploaded'
-		})
-		logger.info(f"Successfully stored metadata in DynamoDB for note_id={note_id}, version={version}")
+		put_version(metadata_item(note_id, version, title, s3_key, len(note_data)))
 	except ClientError as e:
 		logger.error(f"Failed to store metadata in DynamoDB: {e.response['Error']['Message']}")
 		return {
 			'statusCode': 500,
-			'body': json.dumps({'error': f'Failed to store metadata in DynamoDB: {e.response['Error']['Message']}'})
+			'body': json.dumps({'error': f"Failed to store metadata in DynamoDB: {e.response['Error']['Message']}"})
 		}
 
-	if (COMPRESSION_ALGO == "ZSTD" or COMPRESSION_ALGO == "TRAINED_ZSTD"):
+	if note_codec.is_compressing():
 		# 3. Put message in SQS queue (include version)
 		try:
-			logger.info(f"Enqueuing SQS message: queue_url={SQS_QUEUE_URL}, note_id={note_id}, version={version}")
-			sqs.send_message(
-				QueueUrl=SQS_QUEUE_URL,
-				MessageBody=json.dumps({'note_id': note_id, 'version': version, 's3_key': s3_key})
-			)
-			logger.info(f"Successfully enqueued SQS message for note_id={note_id}, version={version}")
+			with instrumentation.stage('sqs_send'):
+				sqs.send_message(
+					QueueUrl=SQS_QUEUE_URL,
+					MessageBody=compression_message(note_id, version, s3_key)
+				)
 		except ClientError as e:
 			logger.error(f"Failed to enqueue SQS message: {e.response['Error']['Message']}")
 			return {
 				'statusCode': 500,
-				'body': json.dumps({'error': f'Failed to enqueue SQS message: {e.response['Error']['Message']}'})
+				'body': json.dumps({'error': f"Failed to enqueue SQS message: {e.response['Error']['Message']}"})
 			}
 
 	# 4. Return success response
-	logger.info(f"Note {note_id} v{version} {'updated' if method == 'PUT' else 'uploaded'} successfully")
 	return {
 		'statusCode': 200,
 		'body': json.dumps({
@@ -0,0 +1,93 @@
+import os
+import logging
+from botocore.exceptions import ClientError
+import note_codec
+import note_packs
+
+# Delta compression: a version is compressed with the previous version as a zstd prefix,
+# except every DELTA_KEYFRAME_INTERVAL-th version (1, K+1, 2K+1, ...), which is a full
+# keyframe. Reconstructing a version therefore reads at most K-1 earlier versions.
+# 0 or 1 disables delta compression.
+KEYFRAME_INTERVAL = int(os.environ.get('DELTA_KEYFRAME_INTERVAL', '0'))
+
+logger = logging.getLogger()
+
+
+class VersionNotFound(Exception):
+    pass
+
+
+def delta_base_version(version):
+    # Version this one should be delta-compressed against, or None for a keyframe
+    if KEYFRAME_INTERVAL <= 1:
+        return None
+    try:
+        number = int(version)
+    except (TypeError, ValueError):
+        return None
+    if number <= 1 or (number - 1) % KEYFRAME_INTERVAL == 0:
+        return None
+    return str(number - 1)
+
+
+class VersionReader:
+    # Loads the content of stored versions, following delta_base links back to the nearest
+    # keyframe. Decoded versions are kept in an optional VersionCache as (item, content).
+
+    def __init__(self, table, s3, bucket, cache=None):
+        self.table = table
+        self.s3 = s3
+        self.bucket = bucket
+        self.cache = cache
+
+    def get_item(self, note_id, version):
+        item = self.table.get_item(Key={'note_id': note_id, 'version': version}, ConsistentRead=True).get('Item')
+        if item is None:
+            raise VersionNotFound(f"note_id={note_id}, version={version}")
+        return item
+
+    def read_stored(self, note_id, version, item):
+        # Returns (item, data, is_final); is_final is False for an upload still waiting in the
+        # compression queue, whose raw content is returned. An uncompressed .txt may be deleted by
+        # compress_notes while we read it, in which case the refreshed item is used.
+        if item.get('inline_data') is not None:
+            return item, item['inline_data'].value, True
+        if item.get('compressed_key'):
+            try:
+                return item, note_packs.read_stored(self.s3, self.bucket, item['compressed_key'], item), True
+            except ClientError as e:
+                if e.response['Error']['Code'] != 'NoSuchKey':
+                    raise
+            # compact_packs or recompress_notes moved the version after its item was read
+            refreshed = self.get_item(note_id, version)
+            if refreshed.get('compressed_key') == item['compressed_key']:
+                raise VersionNotFound(f"content of note_id={note_id}, version={version}")
+            return self.read_stored(note_id, version, refreshed)
+        try:
+            return item, self.s3.get_object(Bucket=self.bucket, Key=item['s3_key'])['Body'].read(), False
+        except ClientError as e:
+            if e.response['Error']['Code'] != 'NoSuchKey':
+                raise
+        item = self.get_item(note_id, version)
+        if not item.get('compressed_key'):
+            raise VersionNotFound(f"content of note_id={note_id}, version={version}")
+        return self.read_stored(note_id, version, item)
+
+    def load(self, note_id, version):
+        # Full content of a version, reconstructing delta versions from their base
+        return self.load_version(note_id, version)[1]
+
+    def load_version(self, note_id, version):
+        # (item, content) of a version
+        cached = self.cache.get((note_id, version)) if self.cache is not None else None
+        if cached is not None:
+            return cached
+        item, data, is_final = self.read_stored(note_id, version, self.get_item(note_id, version))
+        if is_final:
+            base_content = self.load(note_id, item['delta_base']) if item.get('delta_base') is not None else None
+            content = note_codec.decompress(item, data, base_content)
+        else:
+            content = data
+        if self.cache is not None and is_final:
+            self.cache.put((note_id, version), item, content)
+        return item, content
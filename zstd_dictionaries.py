@@ -0,0 +1,162 @@
+import os
+import json
+import time
+import threading
+import logging
+import pyzstd as zstd
+import aws_clients
+from botocore.exceptions import ClientError
+
+# Environment variables (set in Lambda console or SAM/CloudFormation)
+S3_BUCKET = os.environ.get('NOTES_BUCKET', 'your-notes-bucket')
+# Dictionary used for newly compressed notes
+ZSTD_DICTIONARY_KEY = os.environ.get('ZSTD_DICTIONARY_KEY', 'notes/zstd_dictionary')
+# Published dictionaries live under this prefix, keyed by their zstd dictionary ID
+ZSTD_DICTIONARY_PREFIX = os.environ.get('ZSTD_DICTIONARY_PREFIX', 'notes/dictionaries/')
+# Written by train.py --publish: {"dictionary_id": ..., "level": ...}. Takes precedence over
+# ZSTD_DICTIONARY_KEY, which is only used while no dictionary has been published.
+ZSTD_DICTIONARY_POINTER_KEY = os.environ.get('ZSTD_DICTIONARY_POINTER_KEY', f"{ZSTD_DICTIONARY_PREFIX}current.json")
+# How long a warm container writes with the current dictionary before checking for a newer one
+ZSTD_DICTIONARY_REFRESH_SECONDS = float(os.environ.get('ZSTD_DICTIONARY_REFRESH_SECONDS', '300'))
+
+s3 = aws_clients.s3
+
+logger = logging.getLogger()
+
+
+class ZstdDictionary:
+    # A loaded dictionary plus the compression contexts prepared from it.
+    # Instances live for the lifetime of the (warm) Lambda container.
+
+    def __init__(self, dict_data, key):
+        self.key = key
+        self.zstd_dict = zstd.ZstdDict(dict_data)
+        self.dictionary_id = self.zstd_dict.dict_id
+        # Compression level the dictionary was evaluated and published with (None: zstd default)
+        self.level = None
+        # Compressors are reused across notes, one per thread and level
+        self._local = threading.local()
+
+    def _compressor(self, level):
+        compressors = getattr(self._local, 'compressors', None)
+        if compressors is None:
+            compressors = self._local.compressors = {}
+        compressor = compressors.get(level)
+        if compressor is None:
+            compressor = zstd.ZstdCompressor(level_or_option=level, zstd_dict=self.zstd_dict)
+            compressors[level] = compressor
+        return compressor
+
+    def compress(self, data, level=None):
+        return self._compressor(level).compress(data, zstd.ZstdCompressor.FLUSH_FRAME)
+
+    def decompress(self, data):
+        # The digested dictionary is cached inside ZstdDict, so only a light
+        # decompression context is created per call
+        return zstd.decompress(data, zstd_dict=self.zstd_dict)
+
+
+_dictionaries = {}  # dictionary_id -> ZstdDictionary
+_current_dictionary_id = None
+_current_checked_at = None
+_missing = {}  # dictionary_id -> time.monotonic() when it was found in neither place
+_loading = {}  # dictionary_id -> lock held while it is read from S3
+_lock = threading.RLock()
+
+
+def _load_dictionary(key):
+    logger.info(f"Loading zstd dictionary from S3: bucket={S3_BUCKET}, key={key}")
+    response = s3.get_object(Bucket=S3_BUCKET, Key=key)
+    dictionary = ZstdDictionary(response['Body'].read(), key)
+    _dictionaries.setdefault(dictionary.dictionary_id, dictionary)
+    logger.info(f"Loaded zstd dictionary id={dictionary.dictionary_id} from {key}")
+    return _dictionaries[dictionary.dictionary_id]
+
+
+def dictionary_key(dictionary_id):
+    return f"{ZSTD_DICTIONARY_PREFIX}{dictionary_id}"
+
+
+def _resolve_current_dictionary():
+    # Returns the dictionary new notes should use, following the published pointer
+    try:
+        pointer = json.loads(s3.get_object(Bucket=S3_BUCKET, Key=ZSTD_DICTIONARY_POINTER_KEY)['Body'].read())
+    except ClientError as e:
+        if e.response['Error']['Code'] not in ('NoSuchKey', '404'):
+            raise
+        if _current_dictionary_id is not None:
+            return _dictionaries[_current_dictionary_id]
+        return _load_dictionary(ZSTD_DICTIONARY_KEY)
+    dictionary = get_dictionary(pointer['dictionary_id'])
+    dictionary.level = pointer.get('level')
+    return dictionary
+
+
+def current_dictionary():
+    # Dictionary for new writes. Loaded once per container and re-checked every
+    # ZSTD_DICTIONARY_REFRESH_SECONDS so a newly published dictionary is picked up.
+    global _current_dictionary_id, _current_checked_at
+    if _current_dictionary_id is None or time.monotonic() - _current_checked_at >= ZSTD_DICTIONARY_REFRESH_SECONDS:
+        with _lock:
+            if _current_dictionary_id is None or time.monotonic() - _current_checked_at >= ZSTD_DICTIONARY_REFRESH_SECONDS:
+                try:
+                    dictionary = _resolve_current_dictionary()
+                except (ClientError, KeyError, TypeError, ValueError) as e:
+                    # S3 errors, or a malformed pointer or dictionary
+                    if _current_dictionary_id is None:
+                        raise
+                    message = e.response['Error']['Message'] if isinstance(e, ClientError) else repr(e)
+                    logger.warning(f"Keeping zstd dictionary {_current_dictionary_id}, refresh failed: {message}")
+                    dictionary = _dictionaries[_current_dictionary_id]
+                if dictionary.dictionary_id != _current_dictionary_id:
+                    logger.info(f"Current zstd dictionary is now id={dictionary.dictionary_id}")
+                    # A new publication may add dictionaries that were missing
+                    _missing.clear()
+                _current_dictionary_id = dictionary.dictionary_id
+                _current_checked_at = time.monotonic()
+    return _dictionaries[_current_dictionary_id]
+
+
+def _check_missing(dictionary_id):
+    missing_at = _missing.get(dictionary_id)
+    if missing_at is not None and time.monotonic() - missing_at < ZSTD_DICTIONARY_REFRESH_SECONDS:
+        raise KeyError(f"zstd dictionary {dictionary_id} not found")
+
+
+def _find_dictionary(dictionary_id):
+    # Reads the dictionary from S3: published under its ID, or the default dictionary if it
+    # was never published. None if it is in neither place.
+    for key in (dictionary_key(dictionary_id), ZSTD_DICTIONARY_KEY):
+        try:
+            dictionary = _load_dictionary(key)
+        except ClientError as e:
+            if e.response['Error']['Code'] not in ('NoSuchKey', '404'):
+                raise
+            continue
+        if dictionary.dictionary_id == dictionary_id:
+            return dictionary
+    return None
+
+
+def get_dictionary(dictionary_id):
+    # Dictionary a note was compressed with. Older dictionaries are looked up
+    # under ZSTD_DICTIONARY_PREFIX so notes stay readable after a new one is published.
+    # An ID found nowhere is not looked up again for ZSTD_DICTIONARY_REFRESH_SECONDS (or
+    # until the current dictionary changes), and S3 is read under a lock per ID, so loading
+    # one dictionary does not hold up readers of the others.
+    dictionary_id = int(dictionary_id)
+    dictionary = _dictionaries.get(dictionary_id)
+    if dictionary is not None:
+        return dictionary
+    _check_missing(dictionary_id)
+    with _lock:
+        loading = _loading.setdefault(dictionary_id, threading.Lock())
+    with loading:
+        if dictionary_id in _dictionaries:
+            return _dictionaries[dictionary_id]
+        _check_missing(dictionary_id)
+        dictionary = _find_dictionary(dictionary_id)
+        if dictionary is None:
+            _missing[dictionary_id] = time.monotonic()
+            raise KeyError(f"zstd dictionary {dictionary_id} not found")
+        return dictionary